@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+"""Benchmark the migration tools against synthetic data and a throwaway Postgres.
+
+Generates users.db/blog.db/studio.db/messages.db (and a legacy DB for the
+split tools) at a configurable scale, runs migrate-sqlite-to-postgres.py
+(migrate + verify), init/migrate/verify_split_db.py against them and writes
+rows/s, MB/s, peak RSS and per-phase timings (from each tool's --metrics
+records) to a JSON file.
+"""
+from __future__ import annotations
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+TOOLS_DIR = ROOT / "tools"
+WEB_DIR = ROOT / "web"
+MIGRATIONS_DIR = WEB_DIR / "migrations"
+PG_MIGRATE_SCRIPT = WEB_DIR / "scripts" / "migrate-sqlite-to-postgres.py"
+
+# Rows per table at --scale 1; everything else gets DEFAULT_ROWS.
+BASE_ROWS = {
+    "users": 200,
+    "site_visits": 200_000,
+    "unique_visitors": 20_000,
+    "posts": 2_000,
+    "comments": 20_000,
+    "likes": 10_000,
+    "dislikes": 2_000,
+    "favorites": 5_000,
+    "comment_votes": 10_000,
+    "agent_runs": 500,
+    "agent_steps": 5_000,
+    "agent_artifacts": 2_000,
+    "conversations": 1_000,
+    "private_messages": 20_000,
+    "video_tasks": 2_000,
+    "video_results": 2_000,
+}
+DEFAULT_ROWS = 100
+SPLIT_BASE_ROWS = {"comments": 20_000, "messages": 50_000, "video_tasks": 2_000}
+SPLIT_DEFAULT_ROWS = 500
+MIXED_TIMESTAMP_TABLES = {"site_visits", "unique_visitors"}
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def load_pg_migrate_module():
+    spec = importlib.util.spec_from_file_location("migrate_sqlite_to_postgres", PG_MIGRATE_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def mixed_timestamp(i: int) -> str:
+    dt = BASE_TIME + timedelta(seconds=i * 37)
+    kind = i % 4
+    if kind == 0:
+        return dt.strftime("%Y-%m-%d %H:%M:%S")
+    if kind == 1:
+        return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+    if kind == 2:
+        return str(int(dt.timestamp() * 1000))
+    return dt.strftime("%Y/%m/%d %H:%M:%S")
+
+
+def plain_timestamp(i: int) -> str:
+    dt = BASE_TIME + timedelta(seconds=i * 37)
+    return dt.strftime("%Y-%m-%d %H:%M:%S") if i % 2 else dt.isoformat()
+
+
+class TextPool:
+    """Cheap pseudo-random text: slices of one pre-generated block."""
+
+    def __init__(self, rnd: random.Random, size: int = 1 << 20):
+        words = ["migrate", "agent", "artifact", "postgres", "sqlite", "render", "token", "stream", "visit", "frame"]
+        text = " ".join(rnd.choice(words) for _ in range(size // 6))
+        self.text = (text * (size // max(1, len(text)) + 2))[: size * 2]
+        self.rnd = rnd
+
+    def take(self, length: int) -> str:
+        start = self.rnd.randrange(0, len(self.text) - length)
+        return self.text[start : start + length]
+
+
+def pg_catalog(psql: list[str]) -> tuple[dict, dict]:
+    """Column types and column-level foreign keys of the throwaway target."""
+    types: dict[str, dict[str, str]] = {}
+    out = run_psql_query(
+        psql, "SELECT table_name, column_name, data_type FROM information_schema.columns WHERE table_schema = 'public'"
+    )
+    for table, column, data_type in out:
+        types.setdefault(table, {})[column] = data_type
+    fks: dict[tuple[str, str], tuple[str, str]] = {}
+    out = run_psql_query(
+        psql,
+        "SELECT cl.relname, a.attname, pcl.relname, pa.attname FROM pg_constraint c "
+        "JOIN pg_class cl ON cl.oid = c.conrelid JOIN pg_class pcl ON pcl.oid = c.confrelid "
+        "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1] "
+        "JOIN pg_attribute pa ON pa.attrelid = c.confrelid AND pa.attnum = c.confkey[1] "
+        "WHERE c.contype = 'f' AND array_length(c.conkey, 1) = 1",
+    )
+    for table, column, parent, parent_column in out:
+        fks[(table, column)] = (parent, parent_column)
+    return types, fks
+
+
+def generate_pg_sources(out_dir: Path, migrate, types: dict, fks: dict, scale: float, blob_kb: int, seed: int) -> dict:
+    """FK-consistent source DBs in the layout migrate-sqlite-to-postgres.py reads."""
+    rnd = random.Random(seed)
+    pool = TextPool(rnd)
+    values: dict[tuple[str, str], list] = {}
+    counts: dict[str, int] = {}
+    order = [t for t in migrate.IMPORT_ORDER]
+    group_of = {t: db for db, tables in migrate.SOURCE_GROUPS.items() for t in tables}
+    conns = {db: sqlite3.connect(str(out_dir / db)) for db in migrate.SOURCE_GROUPS}
+    referenced = set(fks.values())
+    for table in order:
+        cols = migrate.TABLE_COLUMNS[table]
+        col_types = types.get(table, {})
+        n = max(1, int(BASE_ROWS.get(table, DEFAULT_ROWS) * scale))
+        # Non-user parents first, so unique (parent, username) pairs come out distinct.
+        fk_cols = sorted(
+            (c for c in cols if (table, c) in fks and fks[(table, c)][0] != table),
+            key=lambda c: fks[(table, c)][0] == "users",
+        )
+        text_pk = col_types.get("id") == "text"
+        # Columns other tables point at; their values are kept for the children.
+        parent_cols = [c for c in cols if (table, c) in referenced]
+        for c in parent_cols:
+            values[(table, c)] = []
+        rows = []
+        for i in range(1, n + 1):
+            row = {}
+            radix = i - 1
+            for c in fk_cols:
+                parent_values = values[fks[(table, c)]]
+                row[c] = parent_values[radix % len(parent_values)]
+                radix //= len(parent_values)
+            for c in cols:
+                if c in row:
+                    continue
+                kind = col_types.get(c, "text")
+                if c == "id":
+                    row[c] = f"{table}-{i}" if text_pk else i
+                elif (table, c) in fks:
+                    row[c] = None
+                elif kind.startswith("timestamp"):
+                    row[c] = mixed_timestamp(i) if table in MIXED_TIMESTAMP_TABLES else plain_timestamp(i)
+                elif kind in ("integer", "bigint", "smallint"):
+                    row[c] = rnd.randrange(0, 100)
+                elif kind == "boolean":
+                    row[c] = i % 2
+                elif kind in ("double precision", "real", "numeric"):
+                    row[c] = round(rnd.uniform(0, 1000), 3)
+                elif c.endswith("_json"):
+                    row[c] = json.dumps({"i": i, "tags": ["a", "b"], "note": pool.take(40)})
+                elif table == "agent_artifacts" and c == "content":
+                    row[c] = pool.take(rnd.randint(4, max(4, blob_kb)) * 1024)
+                elif c == "content":
+                    row[c] = pool.take(rnd.randint(20, 400))
+                else:
+                    row[c] = f"{c}-{i}"
+            rows.append([row[c] for c in cols])
+            for c in parent_cols:
+                values[(table, c)].append(row[c])
+        conn = conns[group_of[table]]
+        conn.execute(f"CREATE TABLE {table} ({', '.join(cols)}{', PRIMARY KEY (id)' if 'id' in cols else ''})")
+        conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(cols))})", rows)
+        conn.commit()
+        counts[table] = n
+    for conn in conns.values():
+        conn.close()
+    return counts
+
+
+def generate_split_legacy(path: Path, scale: float, seed: int) -> dict:
+    """A legacy DB holding every split table, filled by declared column type."""
+    sys.path.insert(0, str(TOOLS_DIR))
+    import init_split_db
+
+    rnd = random.Random(seed)
+    pool = TextPool(rnd)
+    conn = sqlite3.connect(str(path))
+    for init in (
+        init_split_db.init_users,
+        init_split_db.init_blog,
+        init_split_db.init_channel,
+        init_split_db.init_studio,
+    ):
+        init(conn)
+    counts = {}
+    tables = [
+        r[0]
+        for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+    ]
+    for table in tables:
+        info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        n = max(1, int(SPLIT_BASE_ROWS.get(table, SPLIT_DEFAULT_ROWS) * scale))
+        rows = []
+        for i in range(1, n + 1):
+            row = []
+            for _cid, name, decl, _notnull, _default, pk in info:
+                decl = (decl or "").upper()
+                if pk and "INT" in decl:
+                    row.append(i)
+                elif name.endswith("_at"):
+                    row.append(mixed_timestamp(i))
+                elif "INT" in decl or "BOOL" in decl:
+                    row.append(rnd.randrange(0, 97))
+                elif "REAL" in decl:
+                    row.append(round(rnd.uniform(0, 100), 2))
+                elif name in ("content", "prompt", "result_json"):
+                    row.append(pool.take(rnd.randint(20, 600)))
+                else:
+                    row.append(f"{name}-{i}")
+            rows.append(row)
+        conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(info))})", rows)
+        counts[table] = n
+    conn.commit()
+    conn.close()
+    return counts
+
+
+def run_checked(cmd: list[str]) -> str:
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{Path(cmd[0]).name} failed: {(proc.stderr or proc.stdout).strip()}")
+    return proc.stdout
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def with_database(url: str, dbname: str) -> str:
+    """`url` pointed at another database; user, host and query options are kept."""
+    return urlunsplit(urlsplit(url)._replace(path=f"/{dbname}"))
+
+
+def pg_tool(pg_bin: str | None, name: str) -> str:
+    found = shutil.which(name, path=pg_bin) if pg_bin else shutil.which(name)
+    if not found:
+        raise RuntimeError(f"{name} not found (put the PostgreSQL bin dir on PATH or pass --pg-bin)")
+    return found
+
+
+class ThrowawayPostgres:
+    """A scratch database: a fresh cluster under the work dir, or a new
+    database on the server --database-url points at. stop() drops the
+    database or stops the cluster and removes its data directory."""
+
+    def __init__(self, work_dir: Path, pg_bin: str | None, admin_url: str | None):
+        self.pg_bin = pg_bin
+        self.admin_url = admin_url
+        self.data_dir = work_dir / "pgdata"
+        self.dbname = f"witweb_bench_{os.getpid()}"
+        self.started = False
+        self.created = False
+
+    def start(self) -> str:
+        psql = pg_tool(self.pg_bin, "psql")
+        if not self.admin_url:
+            port = free_port()
+            initdb, pg_ctl = pg_tool(self.pg_bin, "initdb"), pg_tool(self.pg_bin, "pg_ctl")
+            run_checked([initdb, "-D", str(self.data_dir), "-U", "postgres", "-A", "trust", "-E", "UTF8"])
+            options = f"-p {port} -c listen_addresses=127.0.0.1 -k {self.data_dir} -c fsync=off"
+            log = self.data_dir / "server.log"
+            run_checked([pg_ctl, "-D", str(self.data_dir), "-l", str(log), "-w", "start", "-o", options])
+            self.started = True
+            self.admin_url = f"postgresql://postgres@127.0.0.1:{port}/postgres"
+        run_checked([psql, self.admin_url, "-qc", f'CREATE DATABASE "{self.dbname}"'])
+        self.created = True
+        self.url = with_database(self.admin_url, self.dbname)
+        for migration in sorted(MIGRATIONS_DIR.glob("*.sql")):
+            run_checked([psql, self.url, "-q", "-v", "ON_ERROR_STOP=1", "-f", str(migration)])
+        return self.url
+
+    def psql(self) -> list[str]:
+        return [pg_tool(self.pg_bin, "psql"), self.url]
+
+    def stop(self):
+        if self.created and not self.started:
+            subprocess.run(
+                [pg_tool(self.pg_bin, "psql"), self.admin_url, "-qc", f'DROP DATABASE IF EXISTS "{self.dbname}"'],
+                capture_output=True,
+            )
+        if self.started:
+            subprocess.run(
+                [pg_tool(self.pg_bin, "pg_ctl"), "-D", str(self.data_dir), "-m", "fast", "stop"], capture_output=True
+            )
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def run_psql_query(psql: list[str], sql: str) -> list[list[str]]:
+    out = run_checked(psql + ["-At", "-F", "\x1f", "-c", sql])
+    return [line.split("\x1f") for line in out.splitlines() if line]
+
+
+def tree_rss_kb(pid: int) -> int | None:
+    """Resident memory of `pid` and all its descendants (Linux /proc only)."""
+    total, stack, seen = 0, [pid], False
+    while stack:
+        p = stack.pop()
+        try:
+            status = Path(f"/proc/{p}/status").read_text()
+            children = Path(f"/proc/{p}/task/{p}/children").read_text().split()
+        except OSError:
+            continue
+        match = re.search(r"VmRSS:\s+(\d+)", status)
+        if match:
+            total += int(match.group(1))
+            seen = True
+        stack.extend(int(c) for c in children)
+    return total if seen else None
+
+
+def phase_totals(metrics_file: Path) -> list[dict]:
+    """Seconds, rows and bytes per phase from a tool's --metrics records, in
+    the order phases first appear. Per-table spans of one phase can run in
+    parallel, so their summed seconds may exceed the wall time."""
+    totals = {}
+    try:
+        lines = metrics_file.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return []
+    for line in lines:
+        record = json.loads(line)
+        total = totals.setdefault(record["phase"], {"phase": record["phase"], "spans": 0, "seconds": 0.0})
+        total["spans"] += 1
+        total["seconds"] += record["seconds"]
+        for name in ("rows", "bytes"):
+            if record.get(name) is not None:
+                total[name] = total.get(name, 0) + record[name]
+    for total in totals.values():
+        total["seconds"] = round(total["seconds"], 3)
+    return list(totals.values())
+
+
+def run_tool(
+    name: str, cmd: list[str], env: dict, cwd: Path, rows: int | None = None, source_bytes: int | None = None
+) -> dict:
+    metrics_file = cwd / "metrics" / f"{name}.jsonl"
+    cmd = cmd + ["--metrics", str(metrics_file)]
+    print(f"[bench] {name}: {' '.join(cmd[1:])}")
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env, cwd=str(cwd))
+    peak = {"kb": None}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.05):
+            rss = tree_rss_kb(proc.pid)
+            if rss is not None and (peak["kb"] is None or rss > peak["kb"]):
+                peak["kb"] = rss
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    lines = [line.rstrip("\n") for line in proc.stdout]
+    proc.wait()
+    seconds = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    result = {
+        "command": cmd[1:],
+        "exit_code": proc.returncode,
+        "seconds": round(seconds, 3),
+        "peak_rss_kb": peak["kb"],
+        "phases": phase_totals(metrics_file),
+    }
+    if rows is not None:
+        result["rows"] = rows
+        result["rows_per_s"] = round(rows / seconds, 1) if seconds else None
+    if source_bytes is not None:
+        result["mb_per_s"] = round(source_bytes / 1e6 / seconds, 2) if seconds else None
+    if proc.returncode != 0:
+        result["output_tail"] = lines[-20:]
+        print(f"[bench] {name} exited with {proc.returncode}")
+    return result
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=str(ROOT), check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiplier on the synthetic row counts (site_visits is 200k rows at 1.0)",
+    )
+    parser.add_argument("--blob-kb", type=int, default=64, help="Upper bound of agent_artifacts.content size in KB")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--work-dir",
+        help="Keep generated data and metrics here instead of a temporary directory that is removed afterwards",
+    )
+    parser.add_argument("--pg-bin", help="PostgreSQL bin directory for initdb/pg_ctl/psql")
+    parser.add_argument(
+        "--database-url", help="Create the throwaway database on this server instead of starting a cluster"
+    )
+    parser.add_argument(
+        "--output",
+        help="Results file (default: <work dir>/bench-results.json with --work-dir, else ./bench-results.json)",
+    )
+    parser.add_argument(
+        "--migrate-args", default="", help="Extra arguments for migrate-sqlite-to-postgres.py, e.g. \"--workers 4\""
+    )
+    parser.add_argument("--skip-split", action="store_true", help="Skip the split SQLite tools")
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="witweb-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    source_dir, split_dir = work_dir / "sources", work_dir / "split"
+    for d in (source_dir, split_dir):
+        shutil.rmtree(d, ignore_errors=True)
+        d.mkdir()
+    output = Path(args.output) if args.output else (work_dir if args.work_dir else Path.cwd()) / "bench-results.json"
+
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    if args.pg_bin:
+        env["PATH"] = args.pg_bin + os.pathsep + env.get("PATH", "")
+    results: dict = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "blob_kb": args.blob_kb,
+        "phases": {},
+    }
+    pg = ThrowawayPostgres(work_dir, args.pg_bin, args.database_url)
+    shutil.rmtree(pg.data_dir, ignore_errors=True)
+    try:
+        t = time.perf_counter()
+        url = pg.start()
+        results["phases"]["postgres_setup"] = {"seconds": round(time.perf_counter() - t, 3)}
+
+        t = time.perf_counter()
+        migrate = load_pg_migrate_module()
+        types, fks = pg_catalog(pg.psql())
+        counts = generate_pg_sources(source_dir, migrate, types, fks, args.scale, args.blob_kb, args.seed)
+        source_bytes = sum(p.stat().st_size for p in source_dir.glob("*.db"))
+        results["phases"]["generate"] = {
+            "seconds": round(time.perf_counter() - t, 3),
+            "rows": sum(counts.values()),
+            "bytes": source_bytes,
+            "tables": counts,
+        }
+
+        pg_env = dict(env, DATABASE_URL=url)
+        cache = work_dir / "migrate-cache"
+        base_cmd = [
+            sys.executable, str(PG_MIGRATE_SCRIPT), "--data-dir", str(source_dir), "--schema-cache", "",
+            "--checkpoint-file", str(cache / "checkpoint.json"), "--snapshot-dir", str(cache / "snapshot"),
+            "--deferred-ddl-file", str(cache / "deferred-ddl.json"), "--hwm-file", str(cache / "hwm.json"),
+        ]
+        extra = args.migrate_args.split()
+        rows = sum(counts.values())
+        results["phases"]["pg_migrate"] = run_tool("migrate", base_cmd + extra, pg_env, work_dir, rows, source_bytes)
+        results["phases"]["pg_verify"] = run_tool(
+            "verify",
+            base_cmd[:2] + ["verify"] + base_cmd[2:] + ["--report", str(work_dir / "verify-report.json")],
+            pg_env,
+            work_dir,
+            rows,
+            source_bytes,
+        )
+
+        if not args.skip_split:
+            t = time.perf_counter()
+            legacy = split_dir / "legacy.db"
+            split_counts = generate_split_legacy(legacy, args.scale, args.seed)
+            results["phases"]["split_generate"] = {
+                "seconds": round(time.perf_counter() - t, 3),
+                "rows": sum(split_counts.values()),
+                "bytes": legacy.stat().st_size,
+            }
+            split_env = dict(
+                env,
+                SORA_LEGACY_DB_PATH=str(legacy),
+                SORA_USERS_DB_PATH=str(split_dir / "users.db"),
+                SORA_BLOG_DB_PATH=str(split_dir / "blog.db"),
+                SORA_CHANNEL_DB_PATH=str(split_dir / "channel.db"),
+                SORA_STUDIO_DB_PATH=str(split_dir / "studio.db"),
+                SORA_MIGRATION_MARKER=str(split_dir / ".multi_db_migrated"),
+            )
+            split_rows, split_bytes = sum(split_counts.values()), legacy.stat().st_size
+            results["phases"]["split_init"] = run_tool(
+                "init_split_db", [sys.executable, str(TOOLS_DIR / "init_split_db.py")], split_env, work_dir
+            )
+            results["phases"]["split_migrate"] = run_tool(
+                "migrate_split_db",
+                [sys.executable, str(TOOLS_DIR / "migrate_split_db.py")],
+                split_env,
+                work_dir,
+                split_rows,
+                split_bytes,
+            )
+            results["phases"]["split_verify"] = run_tool(
+                "verify_split_db",
+                [sys.executable, str(TOOLS_DIR / "verify_split_db.py")],
+                split_env,
+                work_dir,
+                split_rows,
+                split_bytes,
+            )
+    finally:
+        pg.stop()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results["ok"] = all(p.get("exit_code", 0) == 0 for p in results["phases"].values())
+    output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print("\nphase                 seconds     rows/s     MB/s  peak RSS MB")
+    for name, phase in results["phases"].items():
+        rss = phase.get("peak_rss_kb")
+        print(
+            f"{name:<20}{phase['seconds']:>9.2f}{phase.get('rows_per_s') or '':>11}{phase.get('mb_per_s') or '':>9}"
+            f"{'' if rss is None else f'{rss / 1024:.0f}':>13}"
+        )
+    print(f"\nResults: {output}")
+    return 0 if results["ok"] else 2
+
+
+if __name__ == "__main__":
+    try:
+        raise SystemExit(main())
+    except RuntimeError as exc:
+        print(f"[error] {exc}")
+        raise SystemExit(1)
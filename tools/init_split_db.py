@@ -1,21 +1,62 @@
 ﻿#!/usr/bin/env python
 """Initialize split SQLite databases (users/blog/channel/studio)."""
 from __future__ import annotations
+import argparse
 import os
+import re
 import sqlite3
 from pathlib import Path
 
+from migration_metrics import Metrics, add_arguments
+from sqlite_profiles import connect
+
 ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT / "data"
 USERS_DB = Path(os.getenv("SORA_USERS_DB_PATH", DATA_DIR / "users.db"))
 BLOG_DB = Path(os.getenv("SORA_BLOG_DB_PATH", DATA_DIR / "blog.db"))
 CHANNEL_DB = Path(os.getenv("SORA_CHANNEL_DB_PATH", DATA_DIR / "channel.db"))
 STUDIO_DB = Path(os.getenv("SORA_STUDIO_DB_PATH", DATA_DIR / "studio.db"))
+PG_MIGRATIONS_DIR = ROOT / "web" / "migrations"
+
+PG_INDEX_RE = re.compile(
+    r"CREATE\s+(UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)\s*"
+    r"(?:USING\s+\w+\s*)?\((.*?)\)\s*(WHERE\b[^;]*)?;",
+    re.IGNORECASE | re.DOTALL,
+)
+PG_DROP_INDEX_RE = re.compile(r"DROP\s+INDEX\s+(?:IF\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+INDEX_COLUMN_RE = re.compile(r"^(\w+)(?:\s+(ASC|DESC))?$", re.IGNORECASE)
+
+# Lookups the app runs on every page view or task poll; `--report` checks each one's plan.
+HOT_QUERIES = [
+    ("users", "SELECT * FROM users WHERE username = ?"),
+    ("users", "SELECT * FROM follows WHERE follower = ?"),
+    ("users", "SELECT * FROM follows WHERE following = ?"),
+    ("blog", "SELECT * FROM posts WHERE slug = ?"),
+    ("blog", "SELECT * FROM posts WHERE author = ? ORDER BY created_at DESC"),
+    ("blog", "SELECT * FROM posts ORDER BY created_at DESC LIMIT 20"),
+    ("blog", "SELECT * FROM comments WHERE post_id = ? ORDER BY created_at"),
+    ("blog", "SELECT COUNT(*) FROM comments WHERE author = ?"),
+    ("blog", "SELECT COUNT(*) FROM likes WHERE post_id = ?"),
+    ("blog", "SELECT 1 FROM likes WHERE post_id = ? AND username = ?"),
+    ("blog", "SELECT COUNT(*) FROM likes WHERE username = ?"),
+    ("blog", "SELECT 1 FROM dislikes WHERE post_id = ? AND username = ?"),
+    ("blog", "SELECT 1 FROM favorites WHERE post_id = ? AND username = ?"),
+    ("blog", "SELECT value FROM comment_votes WHERE comment_id = ? AND username = ?"),
+    ("channel", "SELECT * FROM messages WHERE channel_id = ? ORDER BY created_at DESC LIMIT 50"),
+    ("studio", "SELECT * FROM video_tasks WHERE username = ? ORDER BY created_at DESC LIMIT 20"),
+    ("studio", "SELECT * FROM video_tasks WHERE id = ? AND username = ?"),
+    ("studio", "SELECT * FROM video_results WHERE task_id = ? ORDER BY created_at"),
+    ("studio", "SELECT * FROM characters WHERE username = ? ORDER BY created_at DESC"),
+    ("studio", "SELECT * FROM characters WHERE character_id = ?"),
+    ("studio", "SELECT * FROM studio_history ORDER BY time DESC LIMIT 50"),
+    ("studio", "SELECT ts FROM studio_task_times WHERE task_id = ?"),
+    ("studio", "SELECT value FROM studio_config WHERE key = ?"),
+]
 
 
 def open_db(path: Path) -> sqlite3.Connection:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(str(path))
+    # The serve profile switches new files to WAL, which SQLite persists in the file.
+    return connect(path, "serve")
 
 
 def init_users(db: sqlite3.Connection):
@@ -120,6 +161,7 @@ def init_channel(db: sqlite3.Connection):
       content TEXT NOT NULL,
       created_at DATETIME DEFAULT (datetime('now', 'localtime'))
     );
+    CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at);
     ''')
 
 
@@ -189,21 +231,136 @@ def init_studio(db: sqlite3.Connection):
     ''')
 
 
+def pg_indexes(migrations_dir: Path = PG_MIGRATIONS_DIR) -> dict[str, dict]:
+    """Plain-column indexes the Postgres migrations leave in place, by name.
+
+    Partial and expression indexes are left out; they have no direct SQLite
+    counterpart worth guessing at.
+    """
+    indexes: dict[str, dict] = {}
+    for path in sorted(migrations_dir.glob("*.sql")):
+        sql = re.sub(r"--[^\n]*", "", path.read_text(encoding="utf-8"))
+        events = [(m.start(), m) for m in PG_INDEX_RE.finditer(sql)] + [
+            (m.start(), m) for m in PG_DROP_INDEX_RE.finditer(sql)
+        ]
+        for _pos, m in sorted(events, key=lambda e: e[0]):
+            if m.re is PG_DROP_INDEX_RE:
+                indexes.pop(m.group(1), None)
+                continue
+            if m.group(5):
+                continue
+            columns = [INDEX_COLUMN_RE.match(part.strip()) for part in m.group(4).split(",")]
+            if not all(columns):
+                continue
+            indexes[m.group(2)] = {
+                "table": m.group(3),
+                "unique": bool(m.group(1)),
+                "columns": [(c.group(1), (c.group(2) or "").upper()) for c in columns],
+            }
+    return indexes
+
+
+def index_column_lists(db: sqlite3.Connection, table: str) -> list[list[str]]:
+    lists = []
+    for idx in db.execute(f"PRAGMA index_list({table})").fetchall():
+        lists.append([r[2] for r in db.execute(f"PRAGMA index_info({idx[1]})").fetchall()])
+    # An INTEGER PRIMARY KEY is the rowid and never shows up in index_list.
+    pk = [r[1] for r in sorted(db.execute(f"PRAGMA table_info({table})").fetchall(), key=lambda r: r[5]) if r[5]]
+    if pk:
+        lists.append(pk)
+    return lists
+
+
+def reconcile_indexes(db: sqlite3.Connection, wanted: dict[str, dict]) -> list[str]:
+    """Create the Postgres indexes that no existing index of this DB already
+    covers (same leading columns); returns the names created."""
+    created = []
+    tables = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+    names = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall()}
+    for name, idx in sorted(wanted.items()):
+        table = idx["table"]
+        cols = [c for c, _direction in idx["columns"]]
+        if table not in tables or name in names:
+            continue
+        if not set(cols) <= {r[1] for r in db.execute(f"PRAGMA table_info({table})").fetchall()}:
+            continue
+        if any(existing[: len(cols)] == cols for existing in index_column_lists(db, table)):
+            continue
+        col_sql = ", ".join(f"{c} {direction}".strip() for c, direction in idx["columns"])
+        unique = "UNIQUE " if idx["unique"] else ""
+        try:
+            with db:
+                db.execute(f"CREATE {unique}INDEX {name} ON {table}({col_sql})")
+        except sqlite3.IntegrityError:
+            print(f"[WARN] {table} has duplicates for unique index {name}, creating it non-unique")
+            with db:
+                db.execute(f"CREATE INDEX {name} ON {table}({col_sql})")
+        created.append(name)
+    return created
+
+
+def explain_report(dbs: dict[str, sqlite3.Connection]) -> int:
+    """Print the plan of every hot query and flag full table scans; returns how many were flagged."""
+    flagged = 0
+    for group, sql in HOT_QUERIES:
+        try:
+            plan = [r[3] for r in dbs[group].execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()]
+        except sqlite3.OperationalError as exc:
+            print(f"- [ERROR] {group}: {sql} ({exc})")
+            flagged += 1
+            continue
+        # Walking an index is only cheap when LIMIT stops the walk early.
+        bounded = " LIMIT " in sql.upper()
+        if any(d.startswith("SCAN ") and not (bounded and " USING " in d) for d in plan):
+            status = "FULL SCAN"
+            flagged += 1
+        elif any("TEMP B-TREE" in d for d in plan):
+            status = "TEMP SORT"
+        else:
+            status = "OK"
+        print(f"- [{status}] {group}: {sql}")
+        if status != "OK":
+            print(f"    {'; '.join(plan)}")
+    return flagged
+
+
 def main():
-    users = open_db(USERS_DB)
-    blog = open_db(BLOG_DB)
-    channel = open_db(CHANNEL_DB)
-    studio = open_db(STUDIO_DB)
-
-    init_users(users)
-    init_blog(blog)
-    init_channel(channel)
-    init_studio(studio)
-
-    users.close()
-    blog.close()
-    channel.close()
-    studio.close()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--report", action="store_true", help="EXPLAIN QUERY PLAN the app's hot queries and flag full table scans"
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    metrics = Metrics("init_split_db", args.metrics, args.metrics_format)
+
+    dbs = {
+        "users": open_db(USERS_DB),
+        "blog": open_db(BLOG_DB),
+        "channel": open_db(CHANNEL_DB),
+        "studio": open_db(STUDIO_DB),
+    }
+
+    for group, init in (("users", init_users), ("blog", init_blog), ("channel", init_channel), ("studio", init_studio)):
+        with metrics.span("schema", group):
+            init(dbs[group])
+
+    wanted = pg_indexes()
+    for group, db in dbs.items():
+        with metrics.span("index_build", group) as span:
+            created = reconcile_indexes(db, wanted)
+            span["indexes"] = len(created)
+        for name in created:
+            print(f"[{group}] created index {name} (from Postgres migrations)")
+
+    if args.report:
+        print("\nHot query plans:")
+        with metrics.span("explain") as span:
+            flagged = span["flagged"] = explain_report(dbs)
+        print(f"{flagged} query(s) need a full table scan" if flagged else "No full table scans")
+    metrics.close()
+
+    for db in dbs.values():
+        db.close()
     print("init done")
     return 0
 
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 """One-time migration from legacy single DB to split DBs."""
 from __future__ import annotations
+import argparse
 import os
 import sqlite3
 from pathlib import Path
 from typing import Iterable
 
+from migration_metrics import Metrics, add_arguments
+from sqlite_profiles import connect, profile_applied
+
 ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT / "data"
 LEGACY_DB = Path(os.getenv("SORA_LEGACY_DB_PATH", DATA_DIR / "blog.db"))
@@ -14,6 +18,8 @@ BLOG_DB = Path(os.getenv("SORA_BLOG_DB_PATH", DATA_DIR / "blog.db"))
 CHANNEL_DB = Path(os.getenv("SORA_CHANNEL_DB_PATH", DATA_DIR / "channel.db"))
 STUDIO_DB = Path(os.getenv("SORA_STUDIO_DB_PATH", DATA_DIR / "studio.db"))
 MARKER = Path(os.getenv("SORA_MIGRATION_MARKER", DATA_DIR / ".multi_db_migrated"))
+LEGACY_ALIAS = "legacy"
+BATCH_SIZE = 10000
 
 USERS_TABLES = ["users", "follows"]
 
@@ -42,40 +48,77 @@ def table_count(conn: sqlite3.Connection, table: str) -> int:
     return int(row[0]) if row else 0
 
 
+def table_columns(conn: sqlite3.Connection, table: str, schema: str = "main") -> list[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
 def copy_table(src: sqlite3.Connection, dest: sqlite3.Connection, table: str) -> int:
+    """Copy `table` from the legacy DB attached to `dest` in one transaction.
+
+    Identical column sets are moved inside SQLite with INSERT ... SELECT;
+    otherwise the shared columns are streamed through copy_table_batched.
+    """
     if not table_exists(src, table) or not table_exists(dest, table):
         return 0
-    cols = [r[1] for r in src.execute(f"PRAGMA table_info({table})").fetchall()]
+    cols = table_columns(src, table)
     if not cols:
         return 0
-    placeholders = ",".join(["?"] * len(cols))
-    select_sql = f"SELECT {', '.join(cols)} FROM {table}"
-    insert_sql = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders})"
-    rows = src.execute(select_sql).fetchall()
-    if not rows:
-        return 0
+    dest_cols = table_columns(dest, table)
+    if set(cols) != set(dest_cols):
+        shared = [c for c in cols if c in dest_cols]
+        print(f"  {table}: columns differ, copying {len(shared)} shared column(s) in batches")
+        return copy_table_batched(src, dest, table, shared)
+    col_list = ", ".join(cols)
     with dest:
-        dest.executemany(insert_sql, rows)
-    return len(rows)
+        cur = dest.execute(f"INSERT INTO main.{table} ({col_list}) SELECT {col_list} FROM {LEGACY_ALIAS}.{table}")
+    return cur.rowcount
 
 
-def ensure_path(path: Path):
-    path.parent.mkdir(parents=True, exist_ok=True)
+def copy_table_batched(src: sqlite3.Connection, dest: sqlite3.Connection, table: str, cols: list[str]) -> int:
+    if not cols:
+        return 0
+    placeholders = ",".join(["?"] * len(cols))
+    select_sql = f"SELECT {', '.join(cols)} FROM {table}"
+    insert_sql = f"INSERT INTO main.{table} ({', '.join(cols)}) VALUES ({placeholders})"
+    cur = src.execute(select_sql)
+    total = 0
+    with dest:
+        while True:
+            rows = cur.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            dest.executemany(insert_sql, rows)
+            total += len(rows)
+    return total
 
 
 def open_db(path: Path) -> sqlite3.Connection:
-    ensure_path(path)
-    return sqlite3.connect(str(path))
+    # uri=True so the legacy DB can be attached read-only.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return sqlite3.connect(str(path), uri=True)
 
 
-def migrate_tables(src: sqlite3.Connection, dest: sqlite3.Connection, tables: Iterable[str]) -> dict[str, int]:
+def migrate_tables(
+    src: sqlite3.Connection, dest: sqlite3.Connection, tables: Iterable[str], metrics: Metrics
+) -> dict[str, int]:
     result: dict[str, int] = {}
-    for table in tables:
-        result[table] = copy_table(src, dest, table)
+    dest.execute(f"ATTACH DATABASE ? AS {LEGACY_ALIAS}", (f"{LEGACY_DB.resolve().as_uri()}?mode=ro",))
+    try:
+        for table in tables:
+            # Bulk-load settings only while the table is copied; a crash mid-copy
+            # leaves no marker, so the migration is simply re-run.
+            with metrics.span("copy", table) as span, profile_applied(dest, "bulk-load"):
+                result[table] = span["rows"] = copy_table(src, dest, table)
+    finally:
+        dest.execute(f"DETACH DATABASE {LEGACY_ALIAS}")
     return result
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    args = parser.parse_args()
+
     if not LEGACY_DB.exists():
         print(f"Legacy DB not found: {LEGACY_DB}")
         return 1
@@ -85,7 +128,7 @@ def main():
         print("If you want to re-run migration, delete the marker file.")
         return 1
 
-    legacy = sqlite3.connect(str(LEGACY_DB))
+    legacy = connect(LEGACY_DB, "read-only-analytics")
     users = open_db(USERS_DB)
     blog = open_db(BLOG_DB)
     channel = open_db(CHANNEL_DB)
@@ -98,14 +141,16 @@ def main():
     print("Studio DB:", STUDIO_DB)
 
     summary: dict[str, dict[str, int]] = {}
+    metrics = Metrics("migrate_split_db", args.metrics, args.metrics_format)
 
-    summary["users"] = migrate_tables(legacy, users, USERS_TABLES)
+    summary["users"] = migrate_tables(legacy, users, USERS_TABLES, metrics)
     if is_same_db(LEGACY_DB, BLOG_DB):
         summary["blog"] = {t: 0 for t in BLOG_TABLES}
     else:
-        summary["blog"] = migrate_tables(legacy, blog, BLOG_TABLES)
-    summary["channel"] = migrate_tables(legacy, channel, CHANNEL_TABLES)
-    summary["studio"] = migrate_tables(legacy, studio, STUDIO_TABLES)
+        summary["blog"] = migrate_tables(legacy, blog, BLOG_TABLES, metrics)
+    summary["channel"] = migrate_tables(legacy, channel, CHANNEL_TABLES, metrics)
+    summary["studio"] = migrate_tables(legacy, studio, STUDIO_TABLES, metrics)
+    metrics.close()
 
     legacy.close()
     users.close()
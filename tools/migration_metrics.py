@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Per-phase, per-table timings for the migration tools, as JSON lines or OpenMetrics text."""
+from __future__ import annotations
+import argparse
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, peak memory is left out
+    resource = None
+
+FORMATS = ("jsonl", "openmetrics")
+# Summed per (phase, table) for OpenMetrics; other record fields only appear in JSON lines.
+COUNTERS = ("seconds", "rows", "bytes")
+
+
+def peak_rss_kb() -> int | None:
+    """High-water resident memory of this process so far."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def timed(fn, *args):
+    """Run fn(*args) and return (seconds, peak RSS in KB, result); picklable for process pools."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, peak_rss_kb(), result
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--metrics", help="Write per-phase/per-table timings, rows, bytes and peak memory to this file")
+    parser.add_argument(
+        "--metrics-format",
+        choices=FORMATS,
+        default="jsonl",
+        help="JSON lines (one record per span) or OpenMetrics text (totals per phase and table)",
+    )
+
+
+class Metrics:
+    """Span recorder; without a path every call is a no-op, so callers never check."""
+
+    def __init__(self, tool: str, path: str | Path | None = None, fmt: str = "jsonl"):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown metrics format: {fmt}")
+        self.tool = tool
+        self.path = Path(path) if path else None
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.totals: dict[tuple[str, str], dict] = {}
+        self.out = None
+        if self.path is not None and fmt == "jsonl":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.out = self.path.open("w", encoding="utf-8")
+
+    @contextmanager
+    def span(self, phase: str, table: str | None = None, **fields):
+        """Time the block; the yielded dict collects rows/bytes/anything else to record."""
+        fields.setdefault("rows", None)
+        fields.setdefault("bytes", None)
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException:
+            fields["ok"] = False
+            raise
+        finally:
+            self.record(phase, table, time.perf_counter() - started, **fields)
+
+    def record(self, phase: str, table: str | None = None, seconds: float = 0.0, **fields):
+        if self.path is None:
+            return
+        own_peak = peak_rss_kb()
+        peaks = [p for p in (fields.pop("peak_rss_kb", None), own_peak) if p is not None]
+        entry = {
+            "ts": round(time.time(), 3),
+            "tool": self.tool,
+            "phase": phase,
+            "table": table,
+            "seconds": round(seconds, 6),
+            **fields,
+            "peak_rss_kb": max(peaks) if peaks else None,
+        }
+        with self.lock:
+            total = self.totals.setdefault((phase, table or ""), {"count": 0, "peak_rss_kb": 0})
+            total["count"] += 1
+            for name in COUNTERS:
+                if entry.get(name) is not None:
+                    total[name] = total.get(name, 0) + entry[name]
+            total["peak_rss_kb"] = max(total["peak_rss_kb"], entry["peak_rss_kb"] or 0)
+            if self.out is not None:
+                self.out.write(json.dumps(entry, default=str) + "\n")
+                self.out.flush()
+
+    def openmetrics(self) -> str:
+        def label(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        families = [
+            ("migration_phase_seconds", "counter", "seconds", "Wall time spent in the phase"),
+            ("migration_phase_rows", "counter", "rows", "Rows handled by the phase"),
+            ("migration_phase_bytes", "counter", "bytes", "Bytes handled by the phase"),
+            ("migration_phase_spans", "counter", "count", "Spans recorded for the phase"),
+            (
+                "migration_phase_peak_rss_bytes",
+                "gauge",
+                "peak_rss_kb",
+                "Highest resident memory seen while the phase ran",
+            ),
+        ]
+        lines = []
+        for name, kind, field, help_text in families:
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}.")
+            for (phase, table), total in sorted(self.totals.items()):
+                if field not in total:
+                    continue
+                value = total[field] * 1024 if field == "peak_rss_kb" else total[field]
+                value = value if isinstance(value, int) else round(value, 6)
+                suffix = "_total" if kind == "counter" else ""
+                lines.append(
+                    f'{name}{suffix}{{tool="{label(self.tool)}",phase="{label(phase)}",table="{label(table)}"}} {value}'
+                )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.path is None:
+            return
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(self.openmetrics(), encoding="utf-8")
+        print(f"[metrics] written to {self.path}")
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Named SQLite connection profiles shared by the split-DB tools."""
+from __future__ import annotations
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILES: dict[str, dict[str, object]] = {
+    # App-facing connections: WAL lets readers run alongside the single writer.
+    "serve": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    # One-off loads into files nobody serves yet; a crash means re-running the load.
+    "bulk-load": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -262144,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 30000,
+    },
+    # Long scans next to a live writer; the connection can never take a write lock.
+    "read-only-analytics": {
+        "query_only": "ON",
+        "cache_size": -131072,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+READ_ONLY_PROFILES = {"read-only-analytics"}
+
+
+def connect(path: Path, profile: str = "serve") -> sqlite3.Connection:
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown SQLite profile: {profile}")
+    if profile in READ_ONLY_PROFILES:
+        conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path))
+    apply_profile(conn, profile)
+    return conn
+
+
+def apply_profile(conn: sqlite3.Connection, profile: str) -> dict[str, object]:
+    """Set `profile`'s pragmas on the main database of `conn` (never on attached
+    ones) and return the values they replaced."""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown SQLite profile: {profile}")
+    previous = {}
+    for name, value in PROFILES[profile].items():
+        previous[name] = conn.execute(f"PRAGMA main.{name}").fetchone()[0]
+        conn.execute(f"PRAGMA main.{name} = {value}")
+    return previous
+
+
+@contextmanager
+def profile_applied(conn: sqlite3.Connection, profile: str):
+    """Run the block under `profile`, then restore the previous settings; the
+    journal mode would otherwise stay in the database file."""
+    previous = apply_profile(conn, profile)
+    try:
+        yield conn
+    finally:
+        for name, value in previous.items():
+            conn.execute(f"PRAGMA main.{name} = {value}")
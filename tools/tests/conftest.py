@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent
+
+# The tools import each other as top-level modules, the way they run from tools/.
+sys.path.insert(0, str(TOOLS_DIR))
+
+
+@pytest.fixture
+def split_env(tmp_path):
+    """SORA_* variables pointing the split-DB tools at a legacy DB and split DBs under tmp_path."""
+    split = tmp_path / "split"
+    return {
+        "SORA_LEGACY_DB_PATH": str(tmp_path / "legacy.db"),
+        "SORA_USERS_DB_PATH": str(split / "users.db"),
+        "SORA_BLOG_DB_PATH": str(split / "blog.db"),
+        "SORA_CHANNEL_DB_PATH": str(split / "channel.db"),
+        "SORA_STUDIO_DB_PATH": str(split / "studio.db"),
+        "SORA_MIGRATION_MARKER": str(split / ".multi_db_migrated"),
+    }
+
+
+@pytest.fixture
+def run_tool(split_env):
+    """Run a tool script the way an operator would, against split_env."""
+
+    def run(script, *args):
+        env = dict(os.environ, **split_env)
+        return subprocess.run(
+            [sys.executable, str(TOOLS_DIR / script), *args], env=env, capture_output=True, text=True, timeout=120
+        )
+
+    return run
+
+
+@pytest.fixture
+def legacy_db(split_env):
+    """A legacy single DB with rows in every split group, integer and text keys alike."""
+    import init_split_db
+
+    path = Path(split_env["SORA_LEGACY_DB_PATH"])
+    conn = sqlite3.connect(str(path))
+    inits = (init_split_db.init_users, init_split_db.init_blog, init_split_db.init_channel, init_split_db.init_studio)
+    for init in inits:
+        init(conn)
+    conn.executemany("INSERT INTO users (id, username) VALUES (?, ?)", [(i, f"user{i}") for i in range(1, 4)])
+    conn.execute("INSERT INTO follows (follower, following) VALUES ('user1', 'user2')")
+    conn.executemany(
+        "INSERT INTO posts (id, title, slug, author) VALUES (?, ?, ?, 'user1')",
+        [(i, f"Post {i}", f"post-{i}") for i in range(1, 6)],
+    )
+    conn.execute("INSERT INTO channels (id, name) VALUES (1, 'general')")
+    conn.executemany(
+        "INSERT INTO messages (id, channel_id, username, content) VALUES (?, 1, 'user2', ?)",
+        [(i, f"hello {i}") for i in range(1, 5)],
+    )
+    conn.executemany(
+        "INSERT INTO video_tasks (id, username, task_type) VALUES (?, 'user3', 'text')", [("t1",), ("t2",)]
+    )
+    conn.executemany("INSERT INTO studio_config (key, value) VALUES (?, ?)", [("theme", "dark"), ("lang", "en")])
+    conn.commit()
+    conn.close()
+    return path
@@ -0,0 +1,60 @@
+import sqlite3
+
+import init_split_db
+import migrate_split_db
+from migration_metrics import Metrics
+from sqlite_profiles import connect
+
+
+def make_legacy(path, users=3):
+    conn = sqlite3.connect(str(path))
+    init_split_db.init_users(conn)
+    conn.executemany("INSERT INTO users (id, username) VALUES (?, ?)", [(i, f"user{i}") for i in range(1, users + 1)])
+    conn.execute("INSERT INTO follows (follower, following) VALUES ('user1', 'user2')")
+    conn.commit()
+    conn.close()
+
+
+def test_bulk_load_pragmas_last_only_for_the_copy(tmp_path, monkeypatch):
+    legacy_path = tmp_path / "legacy.db"
+    make_legacy(legacy_path)
+    before = legacy_path.read_bytes()
+    monkeypatch.setattr(migrate_split_db, "LEGACY_DB", legacy_path)
+    dest = migrate_split_db.open_db(tmp_path / "users.db")
+    init_split_db.init_users(dest)
+    legacy = connect(legacy_path, "read-only-analytics")
+
+    result = migrate_split_db.migrate_tables(legacy, dest, migrate_split_db.USERS_TABLES, Metrics("test"))
+
+    assert result == {"users": 3, "follows": 1}
+    assert dest.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    assert dest.execute("PRAGMA synchronous").fetchone()[0] == 2
+    assert [r[1] for r in dest.execute("PRAGMA database_list")] == ["main"]
+    legacy.close()
+    assert legacy_path.read_bytes() == before
+    assert not (tmp_path / "legacy.db-wal").exists()
+
+
+def test_round_trip_copies_every_group_once(legacy_db, split_env, run_tool):
+    assert run_tool("init_split_db.py").returncode == 0
+    done = run_tool("migrate_split_db.py")
+    assert done.returncode == 0, done.stdout + done.stderr
+
+    legacy = sqlite3.connect(str(legacy_db))
+    for env, tables in (
+        ("SORA_USERS_DB_PATH", migrate_split_db.USERS_TABLES),
+        ("SORA_BLOG_DB_PATH", migrate_split_db.BLOG_TABLES),
+        ("SORA_CHANNEL_DB_PATH", migrate_split_db.CHANNEL_TABLES),
+        ("SORA_STUDIO_DB_PATH", migrate_split_db.STUDIO_TABLES),
+    ):
+        split = sqlite3.connect(split_env[env])
+        for table in tables:
+            query = f"SELECT * FROM {table} ORDER BY 1"
+            assert split.execute(query).fetchall() == legacy.execute(query).fetchall(), table
+        split.close()
+    legacy.close()
+    assert "- posts: 5" in done.stdout and "- studio_config: 2" in done.stdout
+
+    # The marker keeps a second run from duplicating the rows.
+    again = run_tool("migrate_split_db.py")
+    assert again.returncode == 1 and "Migration marker exists" in again.stdout
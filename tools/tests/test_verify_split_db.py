@@ -0,0 +1,40 @@
+import sqlite3
+
+import verify_split_db
+
+
+def test_row_hash_tells_types_and_nulls_apart():
+    assert verify_split_db.row_hash(1, "a") == verify_split_db.row_hash(1, "a")
+    assert verify_split_db.row_hash(None) != verify_split_db.row_hash("")
+    assert verify_split_db.row_hash(b"\x01") != verify_split_db.row_hash("\x01")
+    assert 0 <= verify_split_db.row_hash("x" * 1000) < 2**32
+
+
+def test_round_trip_passes_then_names_the_rows_that_drifted(legacy_db, split_env, run_tool):
+    assert run_tool("init_split_db.py").returncode == 0
+    assert run_tool("migrate_split_db.py").returncode == 0
+    clean = run_tool("verify_split_db.py", "--bucket-size", "2", "--workers", "2")
+    assert clean.returncode == 0 and "Verification: PASS" in clean.stdout, clean.stdout + clean.stderr
+
+    blog = sqlite3.connect(split_env["SORA_BLOG_DB_PATH"])
+    blog.execute("UPDATE posts SET title = 'edited' WHERE id = 2")
+    blog.commit()
+    blog.close()
+    channel = sqlite3.connect(split_env["SORA_CHANNEL_DB_PATH"])
+    channel.execute("DELETE FROM messages WHERE id = 3")
+    channel.commit()
+    channel.close()
+    studio = sqlite3.connect(split_env["SORA_STUDIO_DB_PATH"])
+    studio.execute("UPDATE studio_config SET value = 'fr' WHERE key = 'lang'")
+    studio.execute("INSERT INTO video_tasks (id, username, task_type) VALUES ('t3', 'user3', 'text')")
+    studio.commit()
+    studio.close()
+
+    drift = run_tool("verify_split_db.py", "--bucket-size", "2", "--workers", "2")
+    out = drift.stdout
+    assert drift.returncode == 2 and "Verification: FAIL" in out, out + drift.stderr
+    assert "- posts: legacy=5 dest=5 [DIFF]" in out and "id 2..3: changed=[2]" in out
+    assert "- messages: legacy=4 dest=3 [DIFF]" in out and "missing=[3]" in out
+    assert "- studio_config: legacy=2 dest=2 [DIFF]" in out and "changed=['lang']" in out
+    assert "- video_tasks: legacy=2 dest=3 [DIFF]" in out and "extra=['t3']" in out
+    assert "- users: legacy=3 dest=3 [OK]" in out and "- comments: legacy=0 dest=0 [OK]" in out
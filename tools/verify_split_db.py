@@ -1,10 +1,16 @@
 #!/usr/bin/env python
-"""Verify row counts between legacy DB and split DBs."""
+"""Verify legacy DB against split DBs: row counts plus hashed content per key range."""
 from __future__ import annotations
+import argparse
+import hashlib
 import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from migration_metrics import Metrics, add_arguments, timed
+from sqlite_profiles import connect
+
 ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT / "data"
 LEGACY_DB = Path(os.getenv("SORA_LEGACY_DB_PATH", DATA_DIR / "blog.db"))
@@ -33,34 +39,230 @@ def table_count(conn: sqlite3.Connection, table: str) -> int:
     return int(row[0]) if row else 0
 
 
+def encode_values(values) -> bytes:
+    parts = []
+    for v in values:
+        if v is None:
+            parts.append("\\N")
+        elif isinstance(v, bytes):
+            parts.append(v.hex())
+        elif isinstance(v, float):
+            parts.append(repr(v))
+        else:
+            parts.append(str(v))
+    return "\x1f".join(parts).encode("utf-8", errors="surrogatepass")
+
+
+def row_hash(*values) -> int:
+    # 32 bits so SUM() over a bucket can never overflow SQLite's int64.
+    return int.from_bytes(hashlib.blake2b(encode_values(values), digest_size=4).digest(), "big")
+
+
+def key_bucket(*values) -> int:
+    return hashlib.blake2b(encode_values(values), digest_size=1).digest()[0]
+
+
+def open_readonly(path: Path) -> sqlite3.Connection:
+    conn = connect(path, "read-only-analytics")
+    conn.create_function("row_hash", -1, row_hash, deterministic=True)
+    conn.create_function("key_bucket", -1, key_bucket, deterministic=True)
+    return conn
+
+
+def table_plan(legacy: sqlite3.Connection, dest: sqlite3.Connection, table: str, bucket_size: int) -> dict:
+    """Columns both sides have, the key rows are identified by, and the SQL
+    expression that assigns each row to a bucket."""
+    info = legacy.execute(f"PRAGMA table_info({table})").fetchall()
+    dest_cols = {r[1] for r in dest.execute(f"PRAGMA table_info({table})").fetchall()}
+    cols = [r[1] for r in info if r[1] in dest_cols]
+    pk = [r[1] for r in sorted(info, key=lambda r: r[5]) if r[5] and r[1] in dest_cols]
+    int_pk = pk[0] if len(pk) == 1 and [r[2].upper() for r in info if r[1] == pk[0]] == ["INTEGER"] else None
+    keys = pk or cols
+    if int_pk:
+        bucket_sql = f"{int_pk} / {bucket_size}"
+    else:
+        bucket_sql = f"key_bucket({', '.join(keys)})"
+    return {
+        "table": table,
+        "cols": cols,
+        "keys": keys,
+        "int_pk": int_pk,
+        "bucket_sql": bucket_sql,
+        "bucket_size": bucket_size,
+    }
+
+
+def bucket_where(plan: dict, bucket: int) -> tuple[str, list]:
+    if plan["int_pk"]:
+        # Keep the index usable: the range covers every id that truncates to `bucket`.
+        size, pk = plan["bucket_size"], plan["int_pk"]
+        return f"{pk} BETWEEN ? AND ? AND {pk} / {size} = ?", [
+            bucket * size - size + 1,
+            bucket * size + size - 1,
+            bucket,
+        ]
+    return f"{plan['bucket_sql']} = ?", [bucket]
+
+
+def bucket_digests(legacy_path: Path, dest_path: Path, plan: dict, lo: int | None = None, hi: int | None = None):
+    """Per-bucket (rows, hash sum) on both sides, optionally limited to lo <= pk < hi."""
+    where, params = "", []
+    if lo is not None:
+        where, params = f" WHERE {plan['int_pk']} >= ? AND {plan['int_pk']} < ?", [lo, hi]
+    sql = (
+        f"SELECT {plan['bucket_sql']} AS b, COUNT(*), SUM(row_hash({', '.join(plan['cols'])})) "
+        f"FROM {plan['table']}{where} GROUP BY b"
+    )
+    result = []
+    for path in (legacy_path, dest_path):
+        conn = open_readonly(path)
+        try:
+            result.append({b: (n, s) for b, n, s in conn.execute(sql, params)})
+        finally:
+            conn.close()
+    return result
+
+
+def drill_down(legacy_path: Path, dest_path: Path, plan: dict, bucket: int, limit: int):
+    """Compare one bucket row by row and name the keys that differ."""
+    where, params = bucket_where(plan, bucket)
+    sql = f"SELECT {', '.join(plan['keys'])}, row_hash({', '.join(plan['cols'])}) FROM {plan['table']} WHERE {where}"
+    sides = []
+    for path in (legacy_path, dest_path):
+        conn = open_readonly(path)
+        try:
+            sides.append({tuple(r[:-1]): r[-1] for r in conn.execute(sql, params)})
+        finally:
+            conn.close()
+    legacy, dest = sides
+
+    def fmt(keys):
+        return [k[0] if len(k) == 1 else list(k) for k in sorted(keys, key=repr)[:limit]]
+
+    return {
+        "missing": fmt(legacy.keys() - dest.keys()),
+        "extra": fmt(dest.keys() - legacy.keys()),
+        "changed": fmt(k for k in legacy.keys() & dest.keys() if legacy[k] != dest[k]),
+    }
+
+
+def split_ranges(conns, plan: dict, parts: int):
+    """Cut the union of both sides' pk span into up to `parts` bucket-aligned ranges."""
+    spans = [
+        c.execute(f"SELECT MIN({plan['int_pk']}), MAX({plan['int_pk']}) FROM {plan['table']}").fetchone() for c in conns
+    ]
+    lows = [s[0] for s in spans if s[0] is not None]
+    if not lows:
+        return [(None, None)]
+    lo, hi = min(lows), max(s[1] for s in spans if s[1] is not None) + 1
+    size = plan["bucket_size"]
+    step = max(size, -(-(hi - lo) // parts // size) * size)
+    return [(start, min(start + step, hi)) for start in range(lo, hi, step)]
+
+
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bucket-size", type=int, default=1000, help="Integer primary key values per hashed bucket")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="Processes hashing tables and key ranges in parallel"
+    )
+    parser.add_argument(
+        "--max-diffs", type=int, default=20, help="Keys listed per kind when drilling into a mismatched bucket"
+    )
+    parser.add_argument("--counts-only", action="store_true", help="Only compare COUNT(*), skip the content hashes")
+    add_arguments(parser)
+    args = parser.parse_args()
+    metrics = Metrics("verify_split_db", args.metrics, args.metrics_format)
+
     if not LEGACY_DB.exists():
         print(f"Legacy DB not found: {LEGACY_DB}")
         return 1
 
-    legacy = sqlite3.connect(str(LEGACY_DB))
+    legacy = connect(LEGACY_DB, "read-only-analytics")
     ok = True
-
     print("Legacy:", LEGACY_DB)
-    for group, (db_path, tables) in CHECKS.items():
-        if not db_path.exists():
-            print(f"[MISSING] {group} DB: {db_path}")
-            ok = False
-            continue
-        dest = sqlite3.connect(str(db_path))
-        print(f"\n{group} -> {db_path}")
-        for table in tables:
-            legacy_count = table_count(legacy, table)
-            dest_count = table_count(dest, table)
-            status = "OK" if legacy_count == dest_count else "DIFF"
-            if legacy_count < 0 and dest_count < 0:
-                status = "SKIP"
-            if status == "DIFF":
+
+    jobs = []
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        for group, (db_path, tables) in CHECKS.items():
+            if not db_path.exists():
+                jobs.append((group, db_path, None))
+                continue
+            dest = connect(db_path, "read-only-analytics")
+            checks = []
+            for table in tables:
+                with metrics.span("count", table) as span:
+                    legacy_count = table_count(legacy, table)
+                    dest_count = table_count(dest, table)
+                    span["rows"] = max(legacy_count, dest_count, 0)
+                check = {"table": table, "legacy": legacy_count, "dest": dest_count, "futures": []}
+                if not args.counts_only and legacy_count >= 0 and dest_count >= 0:
+                    plan = table_plan(legacy, dest, table, args.bucket_size)
+                    ranges = split_ranges((legacy, dest), plan, args.workers) if plan["int_pk"] else [(None, None)]
+                    check["plan"] = plan
+                    check["futures"] = [
+                        pool.submit(timed, bucket_digests, LEGACY_DB, db_path, plan, lo, hi) for lo, hi in ranges
+                    ]
+                checks.append(check)
+            dest.close()
+            jobs.append((group, db_path, checks))
+
+        for group, db_path, checks in jobs:
+            if checks is None:
+                print(f"[MISSING] {group} DB: {db_path}")
                 ok = False
-            print(f"- {table}: legacy={legacy_count} dest={dest_count} [{status}]")
-        dest.close()
+                continue
+            print(f"\n{group} -> {db_path}")
+            for check in checks:
+                legacy_count, dest_count = check["legacy"], check["dest"]
+                status = "OK" if legacy_count == dest_count else "DIFF"
+                if legacy_count < 0 and dest_count < 0:
+                    status = "SKIP"
+                mismatched = []
+                if check["futures"]:
+                    sides = [{}, {}]
+                    worker_seconds, worker_peak = 0.0, None
+                    for fut in check["futures"]:
+                        seconds, peak, parts = fut.result()
+                        worker_seconds += seconds
+                        worker_peak = max(worker_peak or 0, peak or 0) or None
+                        for merged, part in zip(sides, parts):
+                            for b, (n, s) in part.items():
+                                prev = merged.get(b, (0, 0))
+                                merged[b] = (prev[0] + n, prev[1] + s)
+                    metrics.record(
+                        "hash", check["table"], worker_seconds,
+                        rows=legacy_count + dest_count, ranges=len(check["futures"]), peak_rss_kb=worker_peak,
+                    )
+                    mismatched = sorted(
+                        b for b in sides[0].keys() | sides[1].keys() if sides[0].get(b) != sides[1].get(b)
+                    )
+                    if mismatched:
+                        status = "DIFF"
+                if status == "DIFF":
+                    ok = False
+                print(f"- {check['table']}: legacy={legacy_count} dest={dest_count} [{status}]")
+                if mismatched:
+                    plan = check["plan"]
+                    drills = {
+                        b: pool.submit(timed, drill_down, LEGACY_DB, db_path, plan, b, args.max_diffs)
+                        for b in mismatched[: args.max_diffs]
+                    }
+                    for b, fut in drills.items():
+                        seconds, peak, diff = fut.result()
+                        metrics.record("drill_down", check["table"], seconds, bucket=b, peak_rss_kb=peak)
+                        label = (
+                            f"{plan['int_pk']} {b * plan['bucket_size']}..{(b + 1) * plan['bucket_size'] - 1}"
+                            if plan["int_pk"]
+                            else f"key bucket {b:02x}"
+                        )
+                        details = ", ".join(f"{kind}={keys}" for kind, keys in diff.items() if keys)
+                        print(f"    {label}: {details or 'hash differs'}")
+                    if len(mismatched) > len(drills):
+                        print(f"    ... {len(mismatched) - len(drills)} more mismatched bucket(s)")
 
     legacy.close()
+    metrics.close()
     print("\nVerification:", "PASS" if ok else "FAIL")
     return 0 if ok else 2
 
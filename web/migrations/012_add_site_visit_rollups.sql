@@ -0,0 +1,33 @@
+-- Daily rollups of site_visits, kept up to date by recordSiteVisit.
+-- Analytics read these instead of scanning site_visits, whose older rows may
+-- have been archived out of the database by the SQLite migration.
+
+CREATE TABLE IF NOT EXISTS site_visit_daily_pages (
+  day DATE NOT NULL,
+  page_url TEXT NOT NULL,
+  visits INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, page_url)
+);
+
+CREATE TABLE IF NOT EXISTS site_visit_daily_visitors (
+  day DATE NOT NULL,
+  visitor_id TEXT NOT NULL,
+  visits INTEGER NOT NULL DEFAULT 0,
+  last_visit TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (day, visitor_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_site_visit_daily_visitors_visitor
+  ON site_visit_daily_visitors(visitor_id);
+
+INSERT INTO site_visit_daily_pages (day, page_url, visits)
+SELECT created_at::date, page_url, COUNT(*)
+FROM site_visits
+GROUP BY 1, 2
+ON CONFLICT (day, page_url) DO NOTHING;
+
+INSERT INTO site_visit_daily_visitors (day, visitor_id, visits, last_visit)
+SELECT created_at::date, visitor_id, COUNT(*), MAX(created_at)
+FROM site_visits
+GROUP BY 1, 2
+ON CONFLICT (day, visitor_id) DO NOTHING;
@@ -1,20 +1,38 @@
 #!/usr/bin/env python3
 import argparse
-import csv
+import asyncio
+import codecs
+import cProfile
+import functools
+import itertools
+import json
 import os
+import pstats
+import re
 import sqlite3
+import struct
 import subprocess
 import sys
-import tempfile
-from datetime import datetime, timezone
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
 from urllib.parse import urlparse, unquote
+from zoneinfo import ZoneInfo
 
 try:
-    csv.field_size_limit(sys.maxsize)
-except OverflowError:
-    csv.field_size_limit(2147483647)
+    import psycopg
+except ImportError:  # optional: fall back to the psql CLI
+    psycopg = None
 
+try:
+    import resource
+except ImportError:  # Windows: no getrusage, peak memory is left out of --metrics
+    resource = None
 
 TABLE_COLUMNS = {
     "users": [
@@ -157,6 +175,32 @@ SOURCE_GROUPS = {
     "messages.db": ["conversations", "private_messages"],
 }
 
+WEB_DIR = Path(__file__).resolve().parent.parent
+MIGRATIONS_DIR = WEB_DIR / "migrations"
+DEFAULT_SCHEMA_CACHE = WEB_DIR / ".migrate-cache" / "schema-snapshot.json"
+DEFAULT_HWM_FILE = WEB_DIR / ".migrate-cache" / "high-water-marks.json"
+DEFAULT_CHECKPOINT_FILE = WEB_DIR / ".migrate-cache" / "checkpoint.json"
+DEFAULT_SNAPSHOT_DIR = WEB_DIR / ".migrate-cache" / "snapshot"
+DEFAULT_DEFERRED_DDL_FILE = WEB_DIR / ".migrate-cache" / "deferred-ddl.json"
+DEFAULT_VERIFY_REPORT = WEB_DIR / ".migrate-cache" / "verify-report.json"
+DEFAULT_PROFILE_DIR = WEB_DIR / ".migrate-cache" / "profile"
+DEFAULT_SYNC_STATUS = WEB_DIR / ".migrate-cache" / "sync-status.json"
+DEFAULT_ARCHIVE_DIR = WEB_DIR / ".migrate-cache" / "site-visits-archive"
+PROFILE_SAMPLE_INTERVAL = 0.005
+SCHEMA_SNAPSHOT_VERSION = 3
+
+# Column used as the incremental high-water mark. Tables not listed use
+# updated_at, then an integer id, then created_at; None means the table has no
+# reliable change marker (or is small and mutable) and is fully re-upserted.
+INCREMENTAL_COLUMNS = {
+    "users": None,
+    "unique_visitors": "last_visit",
+    "conversations": "last_time",
+    "studio_config": None,
+    "studio_task_times": None,
+    "studio_active_tasks": None,
+}
+
 IMPORT_ORDER = [
     "users",
     "follows",
@@ -230,6 +274,14 @@ def quote_ident(name: str):
     return '"' + name.replace('"', '""') + '"'
 
 
+def sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    return "'" + str(value).replace("'", "''") + "'"
+
+
 def sqlite_table_exists(conn: sqlite3.Connection, table: str) -> bool:
     row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?", (table,)).fetchone()
     return row is not None
@@ -240,34 +292,615 @@ def sqlite_columns(conn: sqlite3.Connection, table: str):
     return [r[1] for r in rows]
 
 
-def export_table_to_csv(conn: sqlite3.Connection, table: str, csv_path: Path) -> int:
+# Export reads never write; snapshots are immutable, so let SQLite map them and
+# keep a large page cache instead of going through read() for every page.
+SOURCE_READ_PRAGMAS = (
+    "PRAGMA query_only = ON",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+def open_source_db(path: Path, immutable: bool = False, check_same_thread: bool = True) -> sqlite3.Connection:
+    uri = path.resolve().as_uri() + "?mode=ro" + ("&immutable=1" if immutable else "")
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    for pragma in SOURCE_READ_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def snapshot_sources(db_paths, snapshot_dir: Path):
+    """Copy the source databases into `snapshot_dir` as of one point in time.
+
+    A read transaction is opened on every source before any copying starts,
+    so all copies reflect the moment those transactions began; the online
+    backup API then copies them one by one, releasing each source as soon as
+    its copy is done. Only WAL sources keep taking writes meanwhile: in a
+    rollback-journal database the read transaction holds a SHARED lock, so
+    the app's writers wait until that database has been copied.
+    """
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    conns = {}
+    try:
+        for path in db_paths:
+            conns[path] = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True, isolation_level=None)
+            mode = conns[path].execute("PRAGMA journal_mode").fetchone()[0]
+            if mode.lower() != "wal":
+                print(
+                    f"[snapshot] warning: {path.name} uses journal_mode={mode}, writers to it wait until it is copied"
+                )
+        started = time.perf_counter()
+        for conn in conns.values():
+            conn.execute("BEGIN")
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        pinned = time.perf_counter() - started
+        copies = {}
+        for path, conn in conns.items():
+            target = snapshot_dir / path.name
+            for stale in (target, target.with_name(target.name + "-wal"), target.with_name(target.name + "-shm")):
+                stale.unlink(missing_ok=True)
+            dst = sqlite3.connect(str(target))
+            try:
+                conn.backup(dst)
+                # The copy inherits WAL mode from a live source; immutable readers want a plain file.
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+            conn.close()
+            copies[path] = target
+        print(f"[snapshot] {len(copies)} db(s) pinned within {pinned * 1000:.1f} ms, copied to {snapshot_dir}")
+        return copies
+    finally:
+        for conn in conns.values():
+            conn.close()
+
+
+def sqlite_select_sql(conn: sqlite3.Connection, table: str, with_rowid: bool = False, oversized=None) -> str:
+    """SELECT of `table` in TABLE_COLUMNS order, optionally followed by the rowid.
+
+    `oversized` is (columns, threshold): those columns read as NULL when their
+    value is larger than `threshold` bytes, and two more columns follow, the
+    rowid to stream such values by and a bitmask of the ones left out.
+    """
     expected = TABLE_COLUMNS[table]
-    if not sqlite_table_exists(conn, table):
-        return 0
     existing = set(sqlite_columns(conn, table))
+    columns, threshold = oversized or ((), 0)
+    columns = [c for c in columns if c in existing]
     select_list = []
     for c in expected:
-        if c in existing:
+        if c not in existing:
+            select_list.append(f"NULL AS {quote_ident(c)}")
+        elif c in columns:
+            select_list.append(
+                f"CASE WHEN {SQLITE_BYTE_LENGTH.format(quote_ident(c))} > {int(threshold)} THEN NULL ELSE "
+                f"{quote_ident(c)} END"
+            )
+        else:
             select_list.append(quote_ident(c))
+    if with_rowid:
+        select_list.append("rowid")
+    if columns:
+        # Each term is coalesced on its own: a NULL column must not null out the whole mask.
+        flags = " | ".join(
+            f"(coalesce({SQLITE_BYTE_LENGTH.format(quote_ident(c))} > {int(threshold)}, 0) << {expected.index(c)})"
+            for c in columns
+        )
+        select_list += ["rowid", flags]
+    return f"SELECT {', '.join(select_list)} FROM {quote_ident(table)}"
+
+
+def sqlite_chunk_key(conn: sqlite3.Connection, table: str, integer_id: bool):
+    """Pick the column to page `table` by: its integer id, else the rowid, else
+    None for WITHOUT ROWID tables, which are read in one pass."""
+    if integer_id and "id" in sqlite_columns(conn, table):
+        return "id"
+    try:
+        conn.execute(f"SELECT rowid FROM {quote_ident(table)} LIMIT 1").fetchall()
+    except sqlite3.OperationalError:
+        return None
+    return "rowid"
+
+
+def iter_table_batches(
+    conn: sqlite3.Connection, table: str, batch_size: int, where=(), params=(), key=None, after=None, oversized=None
+):
+    """Yield rows of `table` (in TABLE_COLUMNS order) in bounded fetchmany batches.
+
+    With `key`, rows come back ordered by it and start after `after`
+    (keyset paging); a rowid key is appended to each row as an extra column,
+    followed by the columns `oversized` adds (see sqlite_select_sql).
+    """
+    if not sqlite_table_exists(conn, table):
+        return
+    where, params = list(where), list(params)
+    key_sql = quote_ident(key) if key and key != "rowid" else key
+    sql = sqlite_select_sql(conn, table, with_rowid=key == "rowid", oversized=oversized)
+    if key and after is not None:
+        where.append(f"{key_sql} > ?")
+        params.append(after)
+    if where:
+        sql += f" WHERE {' AND '.join(where)}"
+    if key:
+        sql += f" ORDER BY {key_sql}"
+    cur = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def keyset_slices(conn: sqlite3.Connection, table: str, step: int, where=(), params=(), key="id", after=None):
+    """Yield (lower, upper] key ranges holding `step` selected rows each, in key
+    order; the last range is open-ended (upper is None) and may be empty."""
+    key_sql = quote_ident(key) if key != "rowid" else key
+    while True:
+        clauses, args = list(where), list(params)
+        if after is not None:
+            clauses.append(f"{key_sql} > ?")
+            args.append(after)
+        sql = f"SELECT {key_sql} FROM {quote_ident(table)}"
+        if clauses:
+            sql += f" WHERE {' AND '.join(clauses)}"
+        row = conn.execute(f"{sql} ORDER BY {key_sql} LIMIT 1 OFFSET ?", args + [step - 1]).fetchone()
+        upper = row[0] if row else None
+        yield after, upper
+        if upper is None:
+            return
+        after = upper
+
+
+_COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def encode_copy_value(value) -> str:
+    if value is None:
+        return r"\N"
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    return str(value).translate(_COPY_TEXT_ESCAPES)
+
+
+def encode_copy_rows(rows, indexes=None, converters=()) -> bytes:
+    """Encode rows as COPY text format.
+
+    `indexes` projects each row onto the target columns and `converters` is a
+    list of (position, fn) pairs applied to non-NULL values after projection.
+    """
+    lines = []
+    for row in rows:
+        if indexes is not None:
+            row = [row[i] for i in indexes]
+        if converters:
+            row = list(row)
+            for i, convert in converters:
+                if row[i] is not None:
+                    row[i] = convert(row[i])
+        lines.append("\t".join(encode_copy_value(v) for v in row))
+    lines.append("")
+    return "\n".join(lines).encode("utf-8")
+
+
+# COPY ... (FORMAT binary): signature, flags, header extension length / end marker.
+BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_COPY_TRAILER = struct.pack("!h", -1)
+_BINARY_NULL = struct.pack("!i", -1)
+_PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+_BOOL_WORDS = {"t": True, "true": True, "1": True, "y": True, "yes": True, "on": True,
+               "f": False, "false": False, "0": False, "n": False, "no": False, "off": False}
+
+
+def _as_int(value) -> int:
+    # int() would silently truncate 1.5; the text path makes Postgres reject it.
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"invalid integer {value!r}")
+    return int(value)
+
+
+def _binary_struct_encoder(fmt: str, cast):
+    packer = struct.Struct(f"!i{fmt}")
+    size = packer.size - 4
+    return lambda value: packer.pack(size, cast(value))
+
+
+def _binary_text(value) -> bytes:
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def _binary_boolean(value) -> bytes:
+    if isinstance(value, str):
+        flag = _BOOL_WORDS.get(value.strip().lower())
+        if flag is None:
+            raise ValueError(f"invalid boolean {value!r}")
+    else:
+        flag = bool(value)
+    return b"\x00\x00\x00\x01\x01" if flag else b"\x00\x00\x00\x01\x00"
+
+
+def _parse_pg_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    s = str(value).strip()
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        pass
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"cannot encode timestamp {value!r} for binary COPY (rerun with --copy-format text)")
+
+
+def _binary_timestamp_encoders(tz_name: str):
+    tz = ZoneInfo(tz_name)
+    packer = struct.Struct("!iq")
+
+    def timestamptz(value) -> bytes:
+        # Naive input means the session TimeZone, exactly as the text path would read it.
+        dt = _parse_pg_datetime(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=tz)
+        return packer.pack(8, (dt - _PG_EPOCH) // _ONE_MICROSECOND)
+
+    def timestamp(value) -> bytes:
+        # timestamp without time zone ignores any offset in its input.
+        dt = _parse_pg_datetime(value).replace(tzinfo=timezone.utc)
+        return packer.pack(8, (dt - _PG_EPOCH) // _ONE_MICROSECOND)
+
+    return timestamptz, timestamp
+
+
+BINARY_TEXT_TYPES = {"text", "character varying", "character", "json"}
+BINARY_TYPE_ENCODERS = {
+    "smallint": _binary_struct_encoder("h", _as_int),
+    "integer": _binary_struct_encoder("i", _as_int),
+    "bigint": _binary_struct_encoder("q", _as_int),
+    "double precision": _binary_struct_encoder("d", float),
+    "real": _binary_struct_encoder("f", float),
+    "boolean": _binary_boolean,
+}
+
+
+def binary_copy_supported(pg_types) -> bool:
+    timestamps = {"timestamp with time zone", "timestamp without time zone"}
+    return all(t in BINARY_TYPE_ENCODERS or t in BINARY_TEXT_TYPES or t in timestamps for t in pg_types)
+
+
+@functools.lru_cache(maxsize=64)
+def binary_encoders(pg_types: tuple, tz_name: str):
+    timestamptz, timestamp = _binary_timestamp_encoders(tz_name)
+    by_type = {
+        **BINARY_TYPE_ENCODERS,
+        "timestamp with time zone": timestamptz,
+        "timestamp without time zone": timestamp,
+    }
+    return [by_type.get(t, _binary_text) for t in pg_types]
+
+
+def encode_copy_rows_binary(rows, indexes, converters, encoders) -> bytes:
+    """Encode rows as COPY binary tuples (no header/trailer, see copy_into).
+
+    Converters run first, exactly as for the text format, then every non-NULL
+    value goes through the encoder of its target column type.
+    """
+    field_count = struct.pack("!h", len(encoders))
+    out = []
+    for row in rows:
+        if indexes is not None:
+            row = [row[i] for i in indexes]
+        if converters:
+            row = list(row)
+            for i, convert in converters:
+                if row[i] is not None:
+                    row[i] = convert(row[i])
+        out.append(field_count)
+        for value, encode in zip(row, encoders):
+            out.append(_BINARY_NULL if value is None else encode(value))
+    return b"".join(out)
+
+
+# Values larger than --blob-threshold bytes stay out of the export payloads:
+# the SELECT replaces them with NULL, the payload records where they belong,
+# and the COPY writer streams them from SQLite in BLOB_PIECE_BYTES pieces, so a
+# single row never holds more than one piece of such a value in memory.
+DEFAULT_BLOB_THRESHOLD = 1024 * 1024
+BLOB_PIECE_BYTES = 256 * 1024
+OVERSIZED_TYPES = {"text", "character varying", "json", "jsonb"}
+# octet_length() reads the size from the record header instead of loading the value.
+SQLITE_BYTE_LENGTH = "octet_length({})" if sqlite3.sqlite_version_info >= (3, 43, 0) else "length(CAST({} AS BLOB))"
+
+_JSON_STRING_RUN = re.compile(r'[^"\\\x00-\x1f]*')
+# Outside strings: JSON whitespace, punctuation, or a run of anything else
+# (a literal or number if well-formed).
+_JSON_BARE_TOKEN = re.compile(r"[ \t\n\r]+|[{}\[\],:]|[^ \t\n\r{}\[\],:]+")
+_JSON_WORD = re.compile(r"true|false|null|-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+_JSON_HEX = frozenset("0123456789abcdefABCDEF")
+# What JsonMinifier accepts next.
+_JSON_VALUE, _JSON_VALUE_OR_CLOSE, _JSON_KEY, _JSON_KEY_OR_CLOSE = range(4)
+_JSON_COLON, _JSON_COMMA_OR_CLOSE, _JSON_END = range(4, 7)
+
+
+def oversized_columns(schema, table: str, cols):
+    """The columns of `table` that may be streamed past the export payloads.
+
+    Tables with a row transform get none: streamed values skip the transform,
+    so every value of those tables has to stay in its row."""
+    if table in ROW_TRANSFORMS:
+        return []
+    types = {c["name"]: c["type"] for c in schema["columns"][table]}
+    return [c for c in cols if types[c] in OVERSIZED_TYPES]
+
+
+def json_columns(table: str):
+    """Positions (in TABLE_COLUMNS order) of the JSON text columns of `table`."""
+    return [i for i, c in enumerate(TABLE_COLUMNS[table]) if c.endswith("_json")]
+
+
+class JsonMinifier:
+    """Strips insignificant whitespace from JSON text fed in arbitrary pieces.
+
+    It also validates the text against the JSON grammar as it goes (an object
+    or array at the top, exact literals and numbers, no trailing commas,
+    valid escapes, no raw control characters in strings); finish() tells
+    whether the whole text was well-formed.
+    """
+
+    def __init__(self):
+        self.in_string = self.escaped = False
+        self.hex_left = 0
+        # Literal or number seen so far; it may continue in the next piece.
+        self.word = ""
+        self.stack = []
+        self.expect = _JSON_VALUE
+        self.ok = True
+
+    def feed(self, text: str) -> str:
+        out = []
+        i, n = 0, len(text)
+        while i < n:
+            if self.in_string:
+                i = self._string(text, i, out)
+                continue
+            j = text.find('"', i)
+            if j < 0:
+                j = n
+            for m in _JSON_BARE_TOKEN.finditer(text, i, j):
+                token = m.group()
+                if token[0] in " \t\n\r":
+                    self._end_word()
+                elif token in "{}[],:":
+                    self._end_word()
+                    self._token(token)
+                    out.append(token)
+                else:
+                    self.word += token
+                    out.append(token)
+            if j < n:
+                self._end_word()
+                self._token('"')
+                self.in_string = True
+                out.append('"')
+                j += 1
+            i = j
+        return "".join(out)
+
+    def _string(self, text: str, i: int, out) -> int:
+        start, n = i, len(text)
+        while i < n:
+            if self.hex_left:
+                if text[i] not in _JSON_HEX:
+                    self.ok = False
+                self.hex_left -= 1
+                i += 1
+            elif self.escaped:
+                self.escaped = False
+                if text[i] == "u":
+                    self.hex_left = 4
+                elif text[i] not in '"\\/bfnrt':
+                    self.ok = False
+                i += 1
+            else:
+                j = _JSON_STRING_RUN.match(text, i).end()
+                if j == n:
+                    i = j
+                    break
+                i = j + 1
+                if text[j] == '"':
+                    self.in_string = False
+                    break
+                if text[j] == "\\":
+                    self.escaped = True
+                else:
+                    self.ok = False  # raw control character
+        out.append(text[start:i])
+        return i
+
+    def _end_word(self):
+        if self.word:
+            if not _JSON_WORD.fullmatch(self.word):
+                self.ok = False
+            self.word = ""
+            self._token("w")
+
+    def _token(self, kind: str):
+        """Advance the grammar by one token: punctuation, '"' (a string) or "w"."""
+        if not self.ok:
+            return
+        expect = self.expect
+        if kind in "{[":
+            if expect not in (_JSON_VALUE, _JSON_VALUE_OR_CLOSE):
+                self.ok = False
+                return
+            self.stack.append(kind)
+            self.expect = _JSON_KEY_OR_CLOSE if kind == "{" else _JSON_VALUE_OR_CLOSE
+        elif kind in "}]":
+            opener = "{" if kind == "}" else "["
+            if (
+                not self.stack
+                or self.stack[-1] != opener
+                or expect not in (_JSON_COMMA_OR_CLOSE, _JSON_KEY_OR_CLOSE if kind == "}" else _JSON_VALUE_OR_CLOSE)
+            ):
+                self.ok = False
+                return
+            self.stack.pop()
+            self.expect = _JSON_COMMA_OR_CLOSE if self.stack else _JSON_END
+        elif kind == ",":
+            if expect != _JSON_COMMA_OR_CLOSE:
+                self.ok = False
+                return
+            self.expect = _JSON_KEY if self.stack[-1] == "{" else _JSON_VALUE
+        elif kind == ":":
+            if expect != _JSON_COLON:
+                self.ok = False
+                return
+            self.expect = _JSON_VALUE
+        elif kind == '"' and expect in (_JSON_KEY, _JSON_KEY_OR_CLOSE):
+            self.expect = _JSON_COLON
+        elif expect in (_JSON_VALUE, _JSON_VALUE_OR_CLOSE) and self.stack:
+            # A string or literal value; scalars are not accepted at the top.
+            self.expect = _JSON_COMMA_OR_CLOSE
         else:
-            select_list.append(f"NULL AS {quote_ident(c)}")
-    sql = f"SELECT {', '.join(select_list)} FROM {quote_ident(table)}"
-    cur = conn.execute(sql)
-    rows = cur.fetchall()
-    with csv_path.open("w", encoding="utf-8", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(expected)
-        for row in rows:
-            w.writerow([r"\N" if v is None else v for v in row])
-    return len(rows)
+            self.ok = False
 
+    def finish(self) -> bool:
+        if not self.in_string:
+            self._end_word()
+        return self.ok and self.expect == _JSON_END and not self.in_string
 
-def run_psql(conn_info, sql: str):
+
+def compact_json(value):
+    """`value` without insignificant whitespace, or None when it is not
+    well-formed JSON (see JsonMinifier) and has to be kept as it is."""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    minifier = JsonMinifier()
+    text = minifier.feed(str(value))
+    return text if minifier.finish() else None
+
+
+def compact_json_rows(rows, positions):
+    """Compact the JSON columns at `positions`; returns (rows, values left as is)."""
+    out, invalid = [], 0
+    for row in rows:
+        row = list(row)
+        for i in positions:
+            if row[i] is not None:
+                text = compact_json(row[i])
+                if text is None:
+                    invalid += 1
+                else:
+                    row[i] = text
+        out.append(row)
+    return out, invalid
+
+
+def read_blob_pieces(conn: sqlite3.Connection, table: str, column: str, rowid: int):
+    """Yield one stored value as bytes, BLOB_PIECE_BYTES at a time."""
+    if hasattr(conn, "blobopen"):
+        with conn.blobopen(table, column, rowid, readonly=True) as blob:
+            while True:
+                piece = blob.read(BLOB_PIECE_BYTES)
+                if not piece:
+                    return
+                yield piece
+    # Python < 3.11: no incremental blob I/O, fall back to substr() windows.
+    sql = f"SELECT substr(CAST({quote_ident(column)} AS BLOB), ?, ?) FROM {quote_ident(table)} WHERE rowid = ?"
+    offset = 1
+    while True:
+        piece = conn.execute(sql, (offset, BLOB_PIECE_BYTES, rowid)).fetchone()[0]
+        if not piece:
+            return
+        yield piece
+        offset += len(piece)
+
+
+def stream_oversized(path: Path, immutable: bool, table: str, column: str, rowid: int, binary: bool, compact: bool):
+    """Yield the COPY encoding of one oversized source value piece by piece.
+
+    The binary length prefix and the decision whether JSON can be compacted
+    both need the whole value, so in those cases it is read twice instead of
+    being held in memory.
+    """
+    conn = _export_conn(path, immutable)
+
+    def texts():
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for piece in read_blob_pieces(conn, table, column, rowid):
+            yield decoder.decode(piece)
+        yield decoder.decode(b"", final=True)
+
+    minify, size = False, 0
+    if binary or compact:
+        checker = JsonMinifier() if compact else None
+        raw = minified = 0
+        for text in texts():
+            raw += len(text.encode("utf-8"))
+            if checker is not None:
+                minified += len(checker.feed(text).encode("utf-8"))
+        minify = checker is not None and checker.finish()
+        size = minified if minify else raw
+    minifier = JsonMinifier() if minify else None
+    if binary:
+        yield struct.pack("!i", size)
+    for text in texts():
+        if minifier is not None:
+            text = minifier.feed(text)
+        if text:
+            yield text.encode("utf-8") if binary else text.translate(_COPY_TEXT_ESCAPES).encode("utf-8")
+
+
+def encode_oversized_row(row, indexes, converters, encoders, oversized, offset: int):
+    """Encode one row whose fields at the projected positions in `oversized`
+    ({position: (column, rowid)}) are streamed separately. Returns the bytes
+    and (byte offset, column, rowid) for every gap, offsets counted from
+    `offset` so they address the slice payload."""
+    if indexes is not None:
+        row = [row[i] for i in indexes]
+    row = list(row)
+    for i, convert in converters:
+        if row[i] is not None and i not in oversized:
+            row[i] = convert(row[i])
+    out = [struct.pack("!h", len(row))] if encoders is not None else []
+    size = offset + sum(len(b) for b in out)
+    blobs = []
+    for i, value in enumerate(row):
+        if encoders is None and i:
+            out.append(b"\t")
+            size += 1
+        if i in oversized:
+            blobs.append((size, *oversized[i]))
+            continue
+        if encoders is not None:
+            data = _BINARY_NULL if value is None else encoders[i](value)
+        else:
+            data = encode_copy_value(value).encode("utf-8")
+        out.append(data)
+        size += len(data)
+    if encoders is None:
+        out.append(b"\n")
+    return b"".join(out), blobs
+
+
+def psql_env(conn_info):
     env = os.environ.copy()
     if conn_info["password"]:
         env["PGPASSWORD"] = conn_info["password"]
     env["PGCLIENTENCODING"] = "UTF8"
-    cmd = [
+    return env
+
+
+def psql_command(conn_info, *args):
+    return [
         "psql",
         "-h",
         conn_info["host"],
@@ -279,82 +912,735 @@ def run_psql(conn_info, sql: str):
         conn_info["dbname"],
         "-v",
         "ON_ERROR_STOP=1",
-        "-c",
-        sql,
+        *args,
     ]
-    subprocess.run(cmd, check=True, env=env)
+
+
+PSQL_FIELD_SEP = "\x1f"
+PSQL_RECORD_SEP = "\x1e"
+
+
+def run_psql(conn_info, sql: str):
+    subprocess.run(psql_command(conn_info, "-c", sql), check=True, env=psql_env(conn_info))
 
 
 def run_psql_capture(conn_info, sql: str) -> str:
-    env = os.environ.copy()
-    if conn_info["password"]:
-        env["PGPASSWORD"] = conn_info["password"]
-    env["PGCLIENTENCODING"] = "UTF8"
-    cmd = [
-        "psql",
-        "-h",
-        conn_info["host"],
-        "-p",
-        conn_info["port"],
-        "-U",
-        conn_info["user"],
-        "-d",
-        conn_info["dbname"],
-        "-v",
-        "ON_ERROR_STOP=1",
-        "-At",
-        "-c",
-        sql,
-    ]
-    result = subprocess.run(cmd, check=True, env=env, capture_output=True, text=True)
+    cmd = psql_command(conn_info, "-At", "-F", PSQL_FIELD_SEP, "-R", PSQL_RECORD_SEP, "-c", sql)
+    result = subprocess.run(cmd, check=True, env=psql_env(conn_info), capture_output=True, text=True)
     return result.stdout
 
 
-def get_pg_table_columns(conn_info, table: str):
-    sql = (
-        "SELECT column_name "
-        "FROM information_schema.columns "
-        f"WHERE table_schema = 'public' AND table_name = '{table}' "
-        "ORDER BY ordinal_position"
+class PgStats:
+    """Thread-safe accumulator splitting time between connection setup and data transfer."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.query_seconds = 0.0
+        self.copy_seconds = 0.0
+        self.copy_bytes = 0
+
+    def add(self, field: str, seconds: float, size: int = 0):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + seconds)
+            if field == "connect_seconds":
+                self.connects += 1
+            if field == "copy_seconds":
+                self.copy_bytes += size
+
+    def summary(self, driver: str) -> str:
+        mb = self.copy_bytes / (1024 * 1024)
+        transfer = f"queries={self.query_seconds:.2f}s copy={self.copy_seconds:.2f}s ({mb:.1f} MB)"
+        if driver == "psql":
+            return (
+                f"[stats] driver=psql processes={self.connects} {transfer} "
+                "(connection setup is paid inside every psql call)"
+            )
+        return f"[stats] driver={driver} connections={self.connects} connect={self.connect_seconds:.3f}s {transfer}"
+
+
+def peak_rss_kb():
+    """High-water resident memory of this process so far."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _timed(fn, *args):
+    """Run fn(*args) and return (seconds, peak RSS in KB, result); picklable for the export pool."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, peak_rss_kb(), result
+
+
+class Metrics:
+    """--metrics span recorder. The records match tools/migration_metrics.py;
+    this script runs on its own from web/ and tools/ is not importable from
+    here, so the recorder is kept local. Without a path every call is a no-op."""
+
+    COUNTERS = ("seconds", "rows", "bytes")
+
+    def __init__(self, path=None, fmt: str = "jsonl"):
+        self.path = Path(path) if path else None
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.out = None
+        if self.path is not None and fmt == "jsonl":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.out = self.path.open("w", encoding="utf-8")
+
+    @contextmanager
+    def span(self, phase: str, table: str = None, **fields):
+        fields.setdefault("rows", None)
+        fields.setdefault("bytes", None)
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException:
+            fields["ok"] = False
+            raise
+        finally:
+            self.record(phase, table, time.perf_counter() - started, **fields)
+
+    def record(self, phase: str, table: str = None, seconds: float = 0.0, **fields):
+        if self.path is None:
+            return
+        peaks = [p for p in (fields.pop("peak_rss_kb", None), peak_rss_kb()) if p is not None]
+        entry = {
+            "ts": round(time.time(), 3),
+            "tool": "migrate-sqlite-to-postgres",
+            "phase": phase,
+            "table": table,
+            "seconds": round(seconds, 6),
+            **fields,
+            "peak_rss_kb": max(peaks) if peaks else None,
+        }
+        with self.lock:
+            total = self.totals.setdefault((phase, table or ""), {"count": 0, "peak_rss_kb": 0})
+            total["count"] += 1
+            for name in self.COUNTERS:
+                if entry.get(name) is not None:
+                    total[name] = total.get(name, 0) + entry[name]
+            total["peak_rss_kb"] = max(total["peak_rss_kb"], entry["peak_rss_kb"] or 0)
+            if self.out is not None:
+                self.out.write(json.dumps(entry, default=str) + "\n")
+                self.out.flush()
+
+    def openmetrics(self) -> str:
+        def label(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        families = [
+            ("migration_phase_seconds", "counter", "seconds", "Wall time spent in the phase"),
+            ("migration_phase_rows", "counter", "rows", "Rows handled by the phase"),
+            ("migration_phase_bytes", "counter", "bytes", "Bytes handled by the phase"),
+            ("migration_phase_spans", "counter", "count", "Spans recorded for the phase"),
+            (
+                "migration_phase_peak_rss_bytes",
+                "gauge",
+                "peak_rss_kb",
+                "Highest resident memory seen while the phase ran",
+            ),
+        ]
+        lines = []
+        for name, kind, field, help_text in families:
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help_text}.")
+            for (phase, table), total in sorted(self.totals.items()):
+                if field not in total:
+                    continue
+                value = total[field] * 1024 if field == "peak_rss_kb" else total[field]
+                value = value if isinstance(value, int) else round(value, 6)
+                suffix = "_total" if kind == "counter" else ""
+                labels = f'tool="migrate-sqlite-to-postgres",phase="{label(phase)}",table="{label(table)}"'
+                lines.append(f"{name}{suffix}{{{labels}}} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.path is None:
+            return
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(self.openmetrics(), encoding="utf-8")
+        print(f"[metrics] written to {self.path}")
+
+
+def _collapse_stack(frame) -> str:
+    """One sampled stack in flamegraph.pl's collapsed format, root first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+_profile_lock = threading.Lock()
+_profile_busy = {}
+_profile_sampler_pid = None
+_profile_owner = None
+
+
+def _start_cprofile():
+    """Enable a cProfile for the calling thread, or return None when one is
+    already running in this process: Python 3.12+ allows only one active
+    profiler, so concurrent threads fall back to the stack sampler."""
+    global _profile_owner
+    with _profile_lock:
+        if _profile_owner is not None:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # another profiling tool holds sys.monitoring
+            return None
+        _profile_owner = profile
+    return profile
+
+
+def _stop_cprofile(profile):
+    global _profile_owner
+    profile.disable()
+    with _profile_lock:
+        _profile_owner = None
+
+
+def _sample_busy_threads():
+    while True:
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+        frames = sys._current_frames()
+        with _profile_lock:
+            for ident, samples in _profile_busy.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    samples[_collapse_stack(frame)] += 1
+
+
+def _profiled(fn, *args):
+    """Run fn(*args) under cProfile (when no other task of this process holds
+    it) and the stack sampler of this process; returns (pstats dict or None,
+    sampled stacks, result). Submitted to the export pool in place of fn by
+    ProfiledExecutor."""
+    global _profile_sampler_pid
+    ident = threading.get_ident()
+    with _profile_lock:
+        if _profile_sampler_pid != os.getpid():
+            _profile_sampler_pid = os.getpid()
+            threading.Thread(target=_sample_busy_threads, name="profile-sampler", daemon=True).start()
+        _profile_busy[ident] = Counter()
+    profile = _start_cprofile()
+    try:
+        result = fn(*args)
+    finally:
+        if profile is not None:
+            _stop_cprofile(profile)
+        with _profile_lock:
+            samples = _profile_busy.pop(ident)
+    if profile is None:
+        return None, samples, result
+    profile.create_stats()
+    return profile.stats, samples, result
+
+
+class _WorkerStats:
+    """pstats.Stats.add() input for stats collected in an export worker."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """--profile: one cProfile per sequential phase plus a stack sampler for
+    flamegraphs; phases run by several threads at once (read, copy) are
+    covered by the sampler only. Without a directory every call is a no-op."""
+
+    def __init__(self, out_dir=None, top: int = 20):
+        self.dir = Path(out_dir) if out_dir else None
+        self.top = top
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.samples = Counter()
+        self.active = {}
+        self.stop = threading.Event()
+        if self.dir is not None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            self.sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self.sampler.start()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Profile the calling thread for the duration of the block."""
+        if self.dir is None:
+            yield
+            return
+        with self.sampled(name):
+            profile = _start_cprofile()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    _stop_cprofile(profile)
+                    self.add(name, profile)
+
+    @contextmanager
+    def sampled(self, name: str):
+        """Attribute the calling thread's sampled stacks to `name`."""
+        ident = threading.get_ident()
+        with self.lock:
+            self.active[ident] = name
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active.pop(ident, None)
+
+    def call(self, phase: str, fn, *args):
+        """Run fn(*args) in a worker thread under the stack sampler only."""
+        if self.dir is None:
+            return fn(*args)
+        with self.sampled(phase):
+            return fn(*args)
+
+    def add(self, phase: str, profile, samples=None):
+        with self.lock:
+            if profile is not None:
+                if phase not in self.stats:
+                    self.stats[phase] = pstats.Stats()
+                self.stats[phase].add(profile)
+            for stack, n in (samples or {}).items():
+                self.samples[f"{phase};{stack}"] += n
+
+    def _sample(self):
+        while not self.stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, phase in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self.samples[f"{phase};{_collapse_stack(frame)}"] += 1
+
+    def close(self):
+        if self.dir is None:
+            return
+        self.stop.set()
+        self.sampler.join()
+        hotspots = []
+        for phase, stats in self.stats.items():
+            stats.dump_stats(str(self.dir / f"{phase}.prof"))
+            for (filename, line, name), (_cc, calls, own, cumulative, _callers) in stats.stats.items():
+                where = name if filename == "~" else f"{name} ({os.path.basename(filename)}:{line})"
+                hotspots.append((own, cumulative, calls, phase, where))
+        # Sampler-only phases: estimate own time from the innermost sampled frames.
+        leaves = Counter()
+        for stack, n in self.samples.items():
+            phase, _sep, frames = stack.partition(";")
+            if phase not in self.stats and frames:
+                leaves[(phase, frames.rsplit(";", 1)[-1])] += n
+        hotspots += [(n * PROFILE_SAMPLE_INTERVAL, None, None, phase, where) for (phase, where), n in leaves.items()]
+        stacks = self.dir / "stacks.collapsed"
+        stacks.write_text("".join(f"{stack} {n}\n" for stack, n in sorted(self.samples.items())), encoding="utf-8")
+        print(f"[profile] {len(self.stats)} phase profile(s) in {self.dir}, sampled stacks in {stacks}")
+        print(f"[profile] top {self.top} by own time:")
+        print(f"  {'own s':>9} {'cum s':>9} {'calls':>10}  {'phase':<14} function")
+        for own, cumulative, calls, phase, where in sorted(hotspots, key=lambda h: h[0], reverse=True)[: self.top]:
+            cumulative = "-" if cumulative is None else f"{cumulative:.3f}"
+            calls = "-" if calls is None else calls
+            print(f"  {own:9.3f} {cumulative:>9} {calls:>10}  {phase:<14} {where}")
+
+
+class ProfiledExecutor:
+    """Runs every task of the wrapped export pool under _profiled and files its
+    stats under the phase the task belongs to."""
+
+    PHASES = {"export_slice": "export", "digest_slice": "verify_source"}
+
+    def __init__(self, inner, profiler: Profiler):
+        self.inner = inner
+        self.profiler = profiler
+
+    def submit(self, fn, *args):
+        target = args[0] if fn is _timed else fn
+        phase = self.PHASES.get(target.__name__, target.__name__)
+        inner = self.inner.submit(_profiled, fn, *args)
+        outer = Future()
+
+        def done(fut):
+            try:
+                if fut.cancelled():
+                    outer.cancel()
+                elif fut.exception() is not None:
+                    outer.set_exception(fut.exception())
+                else:
+                    stats, samples, result = fut.result()
+                    self.profiler.add(phase, None if stats is None else _WorkerStats(stats), samples)
+                    outer.set_result(result)
+            except InvalidStateError:
+                pass  # the consumer cancelled the outer future meanwhile
+
+        inner.add_done_callback(done)
+        outer.add_done_callback(lambda o: o.cancelled() and inner.cancel())
+        return outer
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        self.inner.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class NativeSession:
+    """One long-lived psycopg connection in autocommit mode."""
+
+    def __init__(self, conn_info, stats: PgStats):
+        self.stats = stats
+        started = time.perf_counter()
+        self.conn = psycopg.connect(
+            host=conn_info["host"],
+            port=conn_info["port"],
+            user=conn_info["user"],
+            password=conn_info["password"] or None,
+            dbname=conn_info["dbname"],
+            client_encoding="UTF8",
+            autocommit=True,
+        )
+        stats.add("connect_seconds", time.perf_counter() - started)
+
+    @property
+    def broken(self) -> bool:
+        return self.conn.closed
+
+    def execute(self, sql: str):
+        started = time.perf_counter()
+        try:
+            self.conn.execute(sql)
+        finally:
+            self.stats.add("query_seconds", time.perf_counter() - started)
+
+    def query(self, sql: str):
+        started = time.perf_counter()
+        try:
+            return self.conn.execute(sql).fetchall()
+        finally:
+            self.stats.add("query_seconds", time.perf_counter() - started)
+
+    def copy_in(self, sql: str, chunks, before: str = None, after: str = None):
+        """Run the COPY, with the optional `before` and `after` statements, in one transaction."""
+        elapsed, size = 0.0, 0
+        with self.conn.transaction():
+            if before:
+                self.execute(before)
+            with self.conn.cursor() as cur, cur.copy(sql) as copy:
+                for chunk in chunks:
+                    started = time.perf_counter()
+                    copy.write(chunk)
+                    elapsed += time.perf_counter() - started
+                    size += len(chunk)
+                started = time.perf_counter()
+            elapsed += time.perf_counter() - started
+            if after:
+                self.execute(after)
+        self.stats.add("copy_seconds", elapsed, size)
+
+    def close(self):
+        self.conn.close()
+
+
+class PsqlSession:
+    """Fallback session that runs every statement through its own psql process."""
+
+    broken = False
+
+    def __init__(self, conn_info, stats: PgStats):
+        self.conn_info = conn_info
+        self.stats = stats
+
+    def execute(self, sql: str):
+        self.stats.add("connect_seconds", 0.0)
+        started = time.perf_counter()
+        try:
+            run_psql(self.conn_info, sql)
+        finally:
+            self.stats.add("query_seconds", time.perf_counter() - started)
+
+    def query(self, sql: str):
+        self.stats.add("connect_seconds", 0.0)
+        started = time.perf_counter()
+        try:
+            out = run_psql_capture(self.conn_info, sql)
+        finally:
+            self.stats.add("query_seconds", time.perf_counter() - started)
+        return [tuple(record.split(PSQL_FIELD_SEP)) for record in out.rstrip("\n").split(PSQL_RECORD_SEP) if record]
+
+    def copy_in(self, sql: str, chunks, before: str = None, after: str = None):
+        """Run the COPY, with the optional `before` and `after` statements, in one transaction."""
+        elapsed, size = 0.0, 0
+        self.stats.add("connect_seconds", 0.0)
+        commands = [arg for statement in (before, sql, after) if statement for arg in ("-c", statement)]
+        proc = subprocess.Popen(
+            psql_command(self.conn_info, "-q", "-1", *commands), stdin=subprocess.PIPE, env=psql_env(self.conn_info)
+        )
+        try:
+            for chunk in chunks:
+                started = time.perf_counter()
+                proc.stdin.write(chunk)
+                elapsed += time.perf_counter() - started
+                size += len(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            started = time.perf_counter()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            code = proc.wait()
+            elapsed += time.perf_counter() - started
+            self.stats.add("copy_seconds", elapsed, size)
+        if code != 0:
+            raise RuntimeError(f"psql exited with code {code} during: {sql}")
+
+    def close(self):
+        pass
+
+
+class PgPool:
+    """Hands out reusable sessions so truncate, introspection, COPY and sequence
+    reset share connections instead of reconnecting per statement."""
+
+    def __init__(self, conn_info, driver: str, size: int):
+        self.conn_info = conn_info
+        self.driver = driver
+        self.size = size
+        self.stats = PgStats()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        if self.driver == "psycopg":
+            return NativeSession(self.conn_info, self.stats)
+        return PsqlSession(self.conn_info, self.stats)
+
+    @contextmanager
+    def session(self):
+        self.slots.acquire()
+        try:
+            with self.lock:
+                sess = self.idle.pop() if self.idle else None
+            if sess is None:
+                sess = self._open()
+            try:
+                yield sess
+            finally:
+                if sess.broken:
+                    sess.close()
+                else:
+                    with self.lock:
+                        self.idle.append(sess)
+        finally:
+            self.slots.release()
+
+    def execute(self, sql: str):
+        with self.session() as sess:
+            sess.execute(sql)
+
+    def query(self, sql: str):
+        with self.session() as sess:
+            return sess.query(sql)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sess in idle:
+            sess.close()
+
+
+def resolve_driver(requested: str) -> str:
+    if requested in ("auto", "psycopg") and psycopg is not None:
+        return "psycopg"
+    if requested == "psycopg":
+        raise RuntimeError("psycopg is not installed (pip install 'psycopg[binary]'), or use --driver psql")
+    check_psql()
+    return "psql"
+
+
+def fetch_pg_schema(db):
+    """Read columns (type, nullability, default, serial sequence, primary key) and
+    foreign keys for every table in TABLE_COLUMNS (and the visit rollups) with
+    two catalog queries."""
+    tables = [*TABLE_COLUMNS, *ROLLUP_TABLES]
+    names = ", ".join(f"'{t}'" for t in tables)
+    col_sql = (
+        "SELECT c.table_name, c.column_name, c.data_type, c.is_nullable, c.column_default, "
+        "pg_get_serial_sequence(format('%I.%I', c.table_schema, c.table_name), c.column_name), "
+        "EXISTS (SELECT 1 FROM information_schema.table_constraints tc "
+        "JOIN information_schema.key_column_usage k ON k.constraint_name = tc.constraint_name "
+        "AND k.table_schema = tc.table_schema AND k.table_name = tc.table_name "
+        "WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = c.table_schema "
+        "AND tc.table_name = c.table_name AND k.column_name = c.column_name) "
+        "FROM information_schema.columns c "
+        f"WHERE c.table_schema = 'public' AND c.table_name IN ({names}) "
+        "ORDER BY c.table_name, c.ordinal_position"
+    )
+    fk_sql = (
+        "SELECT DISTINCT child.relname, parent.relname "
+        "FROM pg_constraint con "
+        "JOIN pg_class child ON child.oid = con.conrelid "
+        "JOIN pg_class parent ON parent.oid = con.confrelid "
+        "JOIN pg_namespace n ON n.oid = con.connamespace "
+        "WHERE con.contype = 'f' AND n.nspname = 'public' "
+        "ORDER BY 1, 2"
     )
-    out = run_psql_capture(conn_info, sql)
-    return [line.strip() for line in out.splitlines() if line.strip()]
+    columns = {t: [] for t in tables}
+    for table, name, data_type, nullable, default, sequence, primary_key in db.query(col_sql):
+        columns[table].append(
+            {
+                "name": name,
+                "type": data_type,
+                "nullable": nullable == "YES",
+                "default": default or None,
+                "sequence": sequence or None,
+                "primary_key": primary_key in (True, "t"),
+            }
+        )
+    foreign_keys = [[child, parent] for child, parent in db.query(fk_sql)]
+    return {"columns": columns, "foreign_keys": foreign_keys}
+
+
+def schema_cache_key() -> str:
+    migrations = sorted(p.name for p in MIGRATIONS_DIR.glob("*.sql"))
+    return migrations[-1] if migrations else ""
+
+
+def load_pg_schema(db, cache_path, refresh: bool = False):
+    """Return the target schema snapshot, reusing the cached copy while the
+    latest migration file is unchanged."""
+    key = schema_cache_key()
+    if cache_path is not None and key and not refresh and cache_path.exists():
+        try:
+            cached = json.loads(cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cached = None
+        if (
+            cached
+            and cached.get("version") == SCHEMA_SNAPSHOT_VERSION
+            and cached.get("key") == key
+            and set(TABLE_COLUMNS) <= set(cached["schema"]["columns"])
+        ):
+            print(f"[schema] using cached snapshot {cache_path} ({key})")
+            return cached["schema"]
+
+    print("[schema] reading target catalog ...")
+    schema = fetch_pg_schema(db)
+    if cache_path is not None and key:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(
+            json.dumps({"version": SCHEMA_SNAPSHOT_VERSION, "key": key, "schema": schema}, indent=2), encoding="utf-8"
+        )
+    return schema
+
+
+def table_dependencies(schema, tables):
+    """Return {table: set(parent tables)} from the snapshot's foreign keys."""
+    wanted = set(tables)
+    deps = {t: set() for t in tables}
+    for child, parent in schema["foreign_keys"]:
+        if child in wanted and parent in wanted and child != parent:
+            deps[child].add(parent)
+    return deps
+
+
+def plan_import_waves(tables, deps):
+    """Group tables into waves whose members only depend on earlier waves.
+
+    Tables inside a wave keep their IMPORT_ORDER position; anything caught in a
+    foreign-key cycle falls back to one-table waves in IMPORT_ORDER.
+    """
+    order = {t: i for i, t in enumerate(IMPORT_ORDER)}
+    pending = sorted(tables, key=lambda t: order.get(t, len(order)))
+    waves = []
+    while pending:
+        remaining = set(pending)
+        wave = [t for t in pending if not deps.get(t, set()) & remaining]
+        if not wave:
+            waves.extend([t] for t in pending)
+            break
+        waves.append(wave)
+        pending = [t for t in pending if t not in wave]
+    return waves
 
 
-def truncate_target(conn_info):
+def truncate_target(db):
     sql = (
         "TRUNCATE TABLE "
         + ", ".join(quote_ident(t) for t in IMPORT_ORDER)
         + " RESTART IDENTITY CASCADE;"
     )
-    run_psql(conn_info, sql)
+    db.execute(sql)
 
 
-def copy_csv_to_postgres(conn_info, table: str, csv_path: Path):
+def copy_plan(schema, table: str):
+    """Return (target columns, projection indexes, converters) for COPYing `table`."""
     expected_cols = TABLE_COLUMNS[table]
-    target_cols = get_pg_table_columns(conn_info, table)
-    cols = [c for c in expected_cols if c in set(target_cols)]
+    target_types = {c["name"]: c["type"] for c in schema["columns"].get(table, [])}
+    cols = [c for c in expected_cols if c in target_types]
     if not cols:
         raise RuntimeError(f"target table {table} has no matching columns for import")
+    indexes = None if len(cols) == len(expected_cols) else [expected_cols.index(c) for c in cols]
+    return cols, indexes, column_converters([target_types[c] for c in cols])
 
-    projected_path = csv_path.with_name(f"{csv_path.stem}.projected.csv")
-    with csv_path.open("r", encoding="utf-8", newline="") as rf, projected_path.open("w", encoding="utf-8", newline="") as wf:
-        reader = csv.DictReader(rf)
-        writer = csv.DictWriter(wf, fieldnames=cols)
-        writer.writeheader()
-        for row in reader:
-            writer.writerow({c: row.get(c, r"\N") for c in cols})
 
-    file_posix = str(projected_path).replace("\\", "/")
-    sql = (
-        f"\\copy {quote_ident(table)} ({', '.join(quote_ident(c) for c in cols)}) "
-        f"FROM '{file_posix}' WITH (FORMAT csv, HEADER true, NULL '\\N', ENCODING 'UTF8')"
+def copy_into(sess, schema, table: str, cols, chunks, upsert: bool = False, binary: bool = False):
+    """COPY one chunk into `table`, or merge it through a staging table when upserting.
+
+    Either way the chunk is applied in one transaction, so a failure never
+    leaves part of a chunk behind. Upserts COPY into a temporary table that is
+    dropped at commit (or with the session, if the process dies) and merge it
+    with INSERT ... SELECT. With `binary` the chunks are encode_copy_rows_binary
+    tuples and get the binary header and trailer here.
+    """
+    col_list = ", ".join(quote_ident(c) for c in cols)
+    options = ""
+    if binary:
+        chunks = itertools.chain([BINARY_COPY_HEADER], chunks, [BINARY_COPY_TRAILER])
+        options = " (FORMAT binary)"
+    if not upsert:
+        sess.copy_in(f"COPY {quote_ident(table)} ({col_list}) FROM STDIN{options}", chunks)
+        return
+
+    keys = [c["name"] for c in schema["columns"][table] if c["primary_key"]]
+    if not keys:
+        raise RuntimeError(f"target table {table} has no primary key, cannot upsert")
+    stage = quote_ident(f"_migrate_stage_{table}")
+    updates = ", ".join(f"{quote_ident(c)} = EXCLUDED.{quote_ident(c)}" for c in cols if c not in keys)
+    conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    sess.copy_in(
+        f"COPY {stage} ({col_list}) FROM STDIN{options}",
+        chunks,
+        before=f"CREATE TEMP TABLE {stage} (LIKE {quote_ident(table)} INCLUDING DEFAULTS) ON COMMIT DROP",
+        after=(
+            f"INSERT INTO {quote_ident(table)} ({col_list}) SELECT {col_list} FROM {stage} "
+            f"ON CONFLICT ({', '.join(quote_ident(k) for k in keys)}) {conflict}"
+        ),
     )
-    run_psql(conn_info, sql)
 
 
-def _normalize_last_visit(value: str) -> str:
-    now = datetime.now(timezone.utc).isoformat()
+# Fallback for empty/unparseable visit timestamps; fixed once per run so a
+# chunk never mixes several "now" values.
+RUN_STARTED_AT = datetime.now(timezone.utc).isoformat()
+TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y/%m/%d %H:%M:%S")
+
+
+@functools.lru_cache(maxsize=65536)
+def _normalize_last_visit(value) -> str:
+    now = RUN_STARTED_AT
     if value is None:
         return now
     s = str(value).strip()
@@ -372,7 +1658,7 @@ def _normalize_last_visit(value: str) -> str:
         return datetime.fromisoformat(s.replace("Z", "+00:00")).astimezone(timezone.utc).isoformat()
     except Exception:
         pass
-    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y/%m/%d %H:%M:%S"):
+    for fmt in TIMESTAMP_FORMATS:
         try:
             dt = datetime.strptime(s, fmt).replace(tzinfo=timezone.utc)
             return dt.isoformat()
@@ -381,92 +1667,1249 @@ def _normalize_last_visit(value: str) -> str:
     return now
 
 
-def transform_unique_visitors_csv(src_path: Path, dst_path: Path):
-    with src_path.open("r", encoding="utf-8", newline="") as rf, dst_path.open("w", encoding="utf-8", newline="") as wf:
-        reader = csv.DictReader(rf)
-        fieldnames = ["id", "visitor_id", "last_visit", "visit_count"]
-        writer = csv.DictWriter(wf, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            id_v = (row.get("id") or "").strip()
-            visitor_id = (row.get("visitor_id") or "").strip()
-            last_visit = _normalize_last_visit(row.get("last_visit") or "")
-            vc_raw = (row.get("visit_count") or "").strip()
-            visit_count = vc_raw if vc_raw.isdigit() else "1"
-            writer.writerow(
-                {
-                    "id": id_v if id_v else r"\N",
-                    "visitor_id": visitor_id if visitor_id else r"\N",
-                    "last_visit": last_visit,
-                    "visit_count": visit_count,
-                }
+def _parse_epoch(s: str) -> str:
+    if not s.isdigit() or len(s) not in (10, 13):
+        raise ValueError(s)
+    return datetime.fromtimestamp(int(s) / 1000.0 if len(s) == 13 else int(s), tz=timezone.utc).isoformat()
+
+
+def _parse_iso(s: str) -> str:
+    return datetime.fromisoformat(s.replace("Z", "+00:00")).astimezone(timezone.utc).isoformat()
+
+
+def _strptime_parser(fmt: str):
+    def parse(s: str) -> str:
+        return datetime.strptime(s, fmt).replace(tzinfo=timezone.utc).isoformat()
+
+    return parse
+
+
+# Same order as _normalize_last_visit, so a detected parser that succeeds gives
+# the same answer the per-value path would have.
+TIMESTAMP_PARSERS = (_parse_epoch, _parse_iso, *(_strptime_parser(fmt) for fmt in TIMESTAMP_FORMATS))
+
+
+def _detect_timestamp_parser(sample: str):
+    for parser in TIMESTAMP_PARSERS:
+        try:
+            parser(sample)
+        except (ValueError, OverflowError, OSError):
+            continue
+        return parser
+    return None
+
+
+def normalize_timestamps(values):
+    """Normalize one column chunk of visit timestamps to UTC ISO strings.
+
+    The format is detected once from the chunk's first non-empty value and
+    applied to each distinct raw value, in order of first appearance; values it cannot handle (mixed
+    formats, bare digits the detected parser would misread) go through the
+    cached per-value path.
+    """
+    texts = ["" if v is None else str(v).strip() for v in values]
+    parser = None
+    memo = {"": RUN_STARTED_AT, r"\N": RUN_STARTED_AT}
+    for s in dict.fromkeys(texts):
+        if s in memo:
+            continue
+        if parser is None:
+            parser = _detect_timestamp_parser(s) or _normalize_last_visit
+        if s.isdigit() and parser is not _parse_epoch:
+            memo[s] = _normalize_last_visit(s)
+            continue
+        try:
+            memo[s] = parser(s)
+        except (ValueError, OverflowError, OSError):
+            memo[s] = _normalize_last_visit(s)
+    return [memo[s] for s in texts]
+
+
+def _epoch_to_iso(value) -> str:
+    seconds = value / 1000.0 if abs(value) >= 100_000_000_000 else value
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).isoformat()
+
+
+def _to_pg_timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return _epoch_to_iso(value)
+    if isinstance(value, str) and value.isdigit() and len(value) in (10, 13):
+        return _epoch_to_iso(int(value))
+    return value
+
+
+def _to_pg_integer(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _to_pg_boolean(value):
+    if isinstance(value, (int, float)):
+        return "t" if value else "f"
+    return value
+
+
+PG_TYPE_CONVERTERS = {
+    "smallint": _to_pg_integer,
+    "integer": _to_pg_integer,
+    "bigint": _to_pg_integer,
+    "boolean": _to_pg_boolean,
+    "timestamp with time zone": _to_pg_timestamp,
+    "timestamp without time zone": _to_pg_timestamp,
+}
+
+
+def column_converters(pg_types):
+    return [(i, PG_TYPE_CONVERTERS[t]) for i, t in enumerate(pg_types) if t in PG_TYPE_CONVERTERS]
+
+
+def _stripped_or_null(value):
+    # Visit ids and visitor ids lose surrounding whitespace; empty ones become NULL.
+    if isinstance(value, str):
+        value = value.strip()
+    return None if value == "" else value
+
+
+def transform_unique_visitors_rows(rows):
+    last_visits = normalize_timestamps([row[2] for row in rows])
+    out = []
+    for (id_v, visitor_id, _last_visit, visit_count), last_visit in zip(rows, last_visits):
+        vc_raw = "" if visit_count is None else str(visit_count).strip()
+        out.append(
+            (
+                _stripped_or_null(id_v),
+                _stripped_or_null(visitor_id),
+                last_visit,
+                int(vc_raw) if vc_raw.isdigit() else 1,
             )
+        )
+    return out
 
 
-def transform_site_visits_csv(src_path: Path, dst_path: Path):
-    now = datetime.now(timezone.utc).isoformat()
-    with src_path.open("r", encoding="utf-8", newline="") as rf, dst_path.open("w", encoding="utf-8", newline="") as wf:
-        reader = csv.DictReader(rf)
-        fieldnames = ["id", "visitor_id", "page_url", "user_agent", "ip_address", "created_at"]
-        writer = csv.DictWriter(wf, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            id_v = (row.get("id") or "").strip()
-            visitor_id = (row.get("visitor_id") or "").strip()
-            page_url = (row.get("page_url") or "").strip() or "/"
-            user_agent = (row.get("user_agent") or "").strip()
-            ip_address = (row.get("ip_address") or "").strip() or "unknown"
-            created_raw = (row.get("created_at") or "").strip()
-            created_at = _normalize_last_visit(created_raw) if created_raw else now
-            writer.writerow(
-                {
-                    "id": id_v if id_v else r"\N",
-                    "visitor_id": visitor_id if visitor_id else r"\N",
-                    "page_url": page_url,
-                    "user_agent": user_agent,
-                    "ip_address": ip_address,
-                    "created_at": created_at,
-                }
+def transform_site_visits_rows(rows):
+    created = normalize_timestamps([row[5] for row in rows])
+    return [
+        (
+            _stripped_or_null(id_v),
+            _stripped_or_null(visitor_id),
+            (page_url or "").strip() or "/",
+            (user_agent or "").strip(),
+            (ip_address or "").strip() or "unknown",
+            created_at,
+        )
+        for (id_v, visitor_id, page_url, user_agent, ip_address, _raw), created_at in zip(rows, created)
+    ]
+
+
+# Per-table transforms; each receives one fetch batch and returns the rewritten rows.
+ROW_TRANSFORMS = {
+    "unique_visitors": transform_unique_visitors_rows,
+    "site_visits": transform_site_visits_rows,
+}
+
+
+_export_local = threading.local()
+# Every cached export connection of this process, so close_export_conns() can
+# release the source files from whichever thread opened them.
+_export_conns = []
+_export_conns_lock = threading.Lock()
+
+
+def _init_export_worker(run_started_at: str):
+    # Spawned workers re-import this file; keep the parent's fallback timestamp.
+    global RUN_STARTED_AT
+    RUN_STARTED_AT = run_started_at
+
+
+def _export_conn(path: Path, immutable: bool) -> sqlite3.Connection:
+    conns = getattr(_export_local, "conns", None)
+    if conns is None:
+        conns = _export_local.conns = {}
+    if (path, immutable) not in conns:
+        conn = conns[(path, immutable)] = open_source_db(path, immutable, check_same_thread=False)
+        with _export_conns_lock:
+            _export_conns.append(conn)
+    return conns[(path, immutable)]
+
+
+def close_export_conns():
+    """Close the export connections cached in this process (export threads,
+    COPY threads streaming oversized values); worker processes release theirs
+    when the pool shuts down. Source files can only be deleted afterwards on
+    Windows."""
+    with _export_conns_lock:
+        conns = _export_conns[:]
+        _export_conns.clear()
+    for conn in conns:
+        conn.close()
+
+
+def iter_slice_rows(
+    conn: sqlite3.Connection,
+    table: str,
+    batch_size: int,
+    where,
+    params,
+    key,
+    lower,
+    upper,
+    timings=None,
+    oversized=None,
+    compact=(),
+):
+    """Yield (rows, first key, last key, left out) for the rows with
+    lower < key <= upper, in TABLE_COLUMNS order with the table's row transform
+    applied and the JSON columns at the `compact` positions compacted.
+
+    With `oversized` (see sqlite_select_sql) values above the threshold read
+    as NULL and "left out" maps the row's index in the batch to its rowid and
+    the positions of those values. Time spent in the transform is added to
+    timings["transform"] and JSON values that could not be compacted to
+    timings["json_invalid"] when a dict is passed.
+    """
+    expected_cols = TABLE_COLUMNS[table]
+    width = len(expected_cols)
+    key_pos = width if key == "rowid" else (expected_cols.index(key) if key else None)
+    extra = width + (key == "rowid")
+    transform = ROW_TRANSFORMS.get(table)
+    where, params = list(where), list(params)
+    if upper is not None:
+        where.append(f"{quote_ident(key) if key != 'rowid' else key} <= ?")
+        params.append(upper)
+    for rows in iter_table_batches(conn, table, batch_size, where, params, key, lower, oversized):
+        first = last = None
+        if key_pos is not None:
+            first, last = rows[0][key_pos], rows[-1][key_pos]
+        left_out = {}
+        if oversized is not None and oversized[0]:
+            for n, row in enumerate(rows):
+                if row[extra + 1]:
+                    left_out[n] = (row[extra], [i for i in range(width) if row[extra + 1] >> i & 1])
+        if len(rows[0]) > width:
+            rows = [row[:width] for row in rows]
+        if transform is not None:
+            started = time.perf_counter()
+            rows = transform(rows)
+            if timings is not None:
+                timings["transform"] = timings.get("transform", 0.0) + time.perf_counter() - started
+        if compact:
+            rows, invalid = compact_json_rows(rows, compact)
+            if timings is not None:
+                timings["json_invalid"] = timings.get("json_invalid", 0) + invalid
+        yield rows, first, last, left_out
+
+
+def export_slice(
+    path: Path,
+    immutable: bool,
+    table: str,
+    where,
+    params,
+    key,
+    lower,
+    upper,
+    batch_size: int,
+    indexes,
+    converters,
+    binary=None,
+    max_pos=None,
+    oversized=None,
+    compact=(),
+):
+    """Read the rows of `table` with lower < key <= upper, transform them and
+    encode them for COPY (binary tuples when `binary` is (target types, TimeZone)).
+    With `max_pos` the largest value of that column is returned as "max_id".
+
+    Values `oversized` leaves out are listed in "blobs" as (payload offset,
+    column, rowid) for the COPY writer to stream (see stream_oversized). Runs
+    in an export worker with its own read-only connection; returns the payload
+    with its row count, key range and the worker's read/encode and transform
+    seconds."""
+    started = time.perf_counter()
+    conn = _export_conn(path, immutable)
+    part = {"payload": b"", "rows": 0, "first": None, "last": None, "max_id": None, "blobs": []}
+    payloads = []
+    size = 0
+    timings = {}
+    encoders = binary_encoders(*binary) if binary else None
+    targets = indexes if indexes is not None else range(len(TABLE_COLUMNS[table]))
+    for rows, first, last, left_out in iter_slice_rows(
+        conn, table, batch_size, where, params, key, lower, upper, timings, oversized, compact
+    ):
+        if part["first"] is None:
+            part["first"] = first
+        part["last"] = last
+        part["rows"] += len(rows)
+        if max_pos is not None:
+            ids = [int(row[max_pos]) for row in rows if row[max_pos] is not None]
+            if ids:
+                part["max_id"] = max(part["max_id"] or ids[0], max(ids))
+        start = 0
+        for n in sorted(left_out) + [len(rows)]:
+            if n > start:
+                if encoders is not None:
+                    data = encode_copy_rows_binary(rows[start:n], indexes, converters, encoders)
+                else:
+                    data = encode_copy_rows(rows[start:n], indexes, converters)
+                payloads.append(data)
+                size += len(data)
+            if n == len(rows):
+                break
+            rowid, positions = left_out[n]
+            gaps = {targets.index(i): (TABLE_COLUMNS[table][i], rowid) for i in positions if i in targets}
+            data, blobs = encode_oversized_row(rows[n], indexes, converters, encoders, gaps, size)
+            payloads.append(data)
+            part["blobs"] += blobs
+            size += len(data)
+            start = n + 1
+    part["payload"] = b"".join(payloads)
+    part["json_invalid"] = timings.get("json_invalid", 0)
+    part["transform_seconds"] = timings.get("transform", 0.0)
+    part["export_seconds"] = time.perf_counter() - started - part["transform_seconds"]
+    part["peak_rss_kb"] = peak_rss_kb()
+    return part
+
+
+def capture_deferred_ddl(db, tables):
+    """Capture the secondary indexes and foreign keys of `tables`.
+
+    Indexes that back primary key or unique constraints stay in place: upserts
+    and the foreign keys of other tables depend on them.
+    """
+    names = ", ".join(f"'{t}'" for t in tables)
+    index_sql = (
+        "SELECT c.relname, i.relname, pg_get_indexdef(i.oid) "
+        "FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "JOIN pg_class c ON c.oid = x.indrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        f"WHERE n.nspname = 'public' AND c.relname IN ({names}) "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.oid AND k.contype IN ('p', 'u', 'x')) "
+        "ORDER BY 1, 2"
+    )
+    fk_sql = (
+        "SELECT c.relname, con.conname, parent.relname, pg_get_constraintdef(con.oid) "
+        "FROM pg_constraint con "
+        "JOIN pg_class c ON c.oid = con.conrelid "
+        "JOIN pg_class parent ON parent.oid = con.confrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        f"WHERE con.contype = 'f' AND n.nspname = 'public' AND c.relname IN ({names}) "
+        "ORDER BY 1, 2"
+    )
+    return {
+        "indexes": [list(row) for row in db.query(index_sql)],
+        "foreign_keys": [list(row) for row in db.query(fk_sql)],
+    }
+
+
+def drop_deferred_ddl(db, ddl):
+    with db.session() as sess:
+        for table, name, _parent, _definition in ddl["foreign_keys"]:
+            sess.execute(f"ALTER TABLE {quote_ident(table)} DROP CONSTRAINT IF EXISTS {quote_ident(name)}")
+        for _table, name, _definition in ddl["indexes"]:
+            sess.execute(f"DROP INDEX IF EXISTS {quote_ident(name)}")
+
+
+def existing_deferred_ddl(db, ddl):
+    """Return (index names, (table, constraint) pairs) of captured objects that exist now."""
+    current = capture_deferred_ddl(db, sorted({row[0] for row in ddl["indexes"] + ddl["foreign_keys"]}))
+    return {row[1] for row in current["indexes"]}, {(row[0], row[1]) for row in current["foreign_keys"]}
+
+
+def restore_deferred_ddl(db, ddl, workers: int):
+    """Rebuild the captured indexes, re-add the foreign keys (both in parallel)
+    and check that nothing is missing. Statistics are left to analyze_tables."""
+    indexes, fks = existing_deferred_ddl(db, ddl)
+    statements = [definition for _t, name, definition in ddl["indexes"] if name not in indexes]
+    constraints = [
+        f"ALTER TABLE {quote_ident(table)} ADD CONSTRAINT {quote_ident(name)} {definition}"
+        for table, name, _parent, definition in ddl["foreign_keys"]
+        if (table, name) not in fks
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        phases = (
+            ("rebuilding {} index(es)", statements),
+            ("re-adding {} foreign key(s)", constraints),
+        )
+        for label, batch in phases:
+            if batch:
+                print(f"[db] {label.format(len(batch))} ...")
+            for fut in as_completed([pool.submit(db.execute, sql) for sql in batch]):
+                fut.result()
+
+    indexes, fks = existing_deferred_ddl(db, ddl)
+    missing = [name for _t, name, _d in ddl["indexes"] if name not in indexes]
+    missing += [f"{table}.{name}" for table, name, _p, _d in ddl["foreign_keys"] if (table, name) not in fks]
+    if missing:
+        raise RuntimeError("deferred indexes/constraints were not restored: " + ", ".join(missing))
+
+
+def reset_sequences(db, schema, captured) -> int:
+    """Move every serial sequence of the migrated tables past its column's
+    largest value with one statement. `captured` maps (table, column) to the
+    maximum seen during export for tables loaded from scratch in this run
+    (None when empty); all other sequences read MAX() from the table."""
+    values = []
+    for table, columns in schema["columns"].items():
+        for c in columns:
+            if not c["sequence"]:
+                continue
+            if (table, c["name"]) in captured:
+                value = captured[(table, c["name"])]
+                expr = "NULL" if value is None else str(int(value))
+            else:
+                expr = f"(SELECT MAX({quote_ident(c['name'])}) FROM {quote_ident(table)})"
+            values.append(f"('{c['sequence'].replace(chr(39), chr(39) * 2)}', {expr}::bigint)")
+    if values:
+        # Empty tables restart at 1 (is_called = false) instead of failing on setval(0).
+        db.query(
+            "SELECT setval(s.seq::regclass, GREATEST(s.max_id, 1), COALESCE(s.max_id >= 1, false)) "
+            f"FROM (VALUES {', '.join(values)}) AS s(seq, max_id)"
+        )
+    return len(values)
+
+
+def analyze_tables(db, tables, workers: int, vacuum: bool = False):
+    """Refresh planner statistics of the loaded tables in parallel, largest first."""
+    command = "VACUUM (ANALYZE)" if vacuum else "ANALYZE"
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for fut in as_completed([pool.submit(db.execute, f"{command} {quote_ident(t)}") for t in tables]):
+            fut.result()
+
+
+class HighWaterMarks:
+    """Per-table incremental marks for one target database, persisted as JSON."""
+
+    def __init__(self, path: Path, target: str):
+        self.path = path
+        self.target = target
+        self.lock = threading.Lock()
+        self.data = {}
+        if path.exists():
+            self.data = json.loads(path.read_text(encoding="utf-8"))
+
+    def get(self, table: str, column: str):
+        mark = self.data.get(self.target, {}).get(table)
+        if mark and mark.get("column") == column:
+            return mark.get("value")
+        return None
+
+    def set(self, table: str, column: str, value):
+        with self.lock:
+            self.data.setdefault(self.target, {})[table] = {"column": column, "value": value}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.data, indent=2, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.path)
+
+
+class CheckpointJournal:
+    """Records every committed chunk so an interrupted run can be resumed.
+
+    A run is identified by target database, source directory and mode; the
+    journal is rewritten atomically after each chunk commits. It also names
+    the snapshot copies (db name -> path) a new run reads, so a resumed run
+    continues from the same point in time.
+    """
+
+    def __init__(self, path: Path, run_key: str, resume: bool, snapshot=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {
+            "run": run_key,
+            "tables": {},
+            "snapshot": {name: str(copy) for name, copy in (snapshot or {}).items()},
+        }
+        if resume:
+            self.data = self.load(path, run_key)
+        self._save()
+
+    @staticmethod
+    def load(path: Path, run_key: str) -> dict:
+        loaded = json.loads(path.read_text(encoding="utf-8")) if path.exists() else None
+        if not loaded or loaded.get("run") != run_key:
+            raise RuntimeError(f"no checkpoint to resume for this target and data dir in {path}")
+        return loaded
+
+    def table_state(self, table: str):
+        with self.lock:
+            return dict(self.data["tables"].get(table, {}))
+
+    def commit_chunk(self, table: str, key, first_key, last_key, rows: int):
+        with self.lock:
+            state = self.data["tables"].setdefault(
+                table, {"done": False, "rows": 0, "key": key, "last_key": None, "chunks": []}
             )
+            state["rows"] += rows
+            if last_key is not None:
+                state["last_key"] = last_key
+            state["chunks"].append([first_key, last_key, rows])
+            self._save()
+
+    def remember(self, name: str, value):
+        with self.lock:
+            self.data[name] = value
+            self._save()
+
+    def finish_table(self, table: str):
+        with self.lock:
+            state = self.data["tables"].setdefault(table, {"rows": 0, "last_key": None, "chunks": []})
+            state["done"] = True
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.data, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.path)
+
+
+def incremental_column(schema, table: str, source_cols):
+    if table in INCREMENTAL_COLUMNS:
+        column = INCREMENTAL_COLUMNS[table]
+    else:
+        column = None
+        for candidate in ("updated_at", "id", "created_at"):
+            if candidate == "id" and not has_integer_id(schema, table):
+                continue
+            if candidate in TABLE_COLUMNS[table]:
+                column = candidate
+                break
+    return column if column in source_cols else None
+
+
+def _progress(span, last) -> str:
+    if not span or not all(isinstance(v, int) for v in (span[0], span[1], last)) or span[1] <= span[0]:
+        return ""
+    return f" ({100.0 * (last - span[0]) / (span[1] - span[0]):.0f}%)"
+
+
+def has_integer_id(schema, table: str) -> bool:
+    types = {c["name"]: c["type"] for c in schema["columns"].get(table, [])}
+    return types.get("id") in ("smallint", "integer", "bigint")
+
+
+@dataclass(frozen=True)
+class ImportOptions:
+    """The command-line settings an ImportJob runs with."""
+
+    batch_size: int
+    chunk_rows: int
+    chunk_retries: int = 0
+    snapshot: bool = False
+    prefetch: int = 1
+    binary_tz: str = None
+    # fresh: the target was emptied for this run, so the maximum seen in a
+    # table's export is its sequence position (see reset_sequences).
+    fresh: bool = False
+    blob_threshold: int = 0
+    compact_json: bool = False
+
+
+class ImportJob:
+    """Everything the import workers of one run share."""
+
+    def __init__(
+        self,
+        db,
+        schema,
+        sources,
+        journal: CheckpointJournal,
+        options: ImportOptions,
+        marks: HighWaterMarks = None,
+        exporter=None,
+        metrics: Metrics = None,
+        profiler: Profiler = None,
+    ):
+        self.db = db
+        self.schema = schema
+        self.sources = sources
+        self.journal = journal
+        self.options = options
+        self.marks = marks
+        self.exporter = exporter
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler or Profiler()
+        self.json_invalid = Counter()
+        self.max_ids = {}
+        self.loaded_rows = {}
+        # Busy/blocked seconds per pipeline stage, for utilization().
+        self.usage = Counter()
+        self.usage_lock = threading.Lock()
+
+    def import_table(self, table: str) -> str:
+        plan = self.plan_table(table)
+        try:
+            return self.load_table(plan, self.prefetched(plan) if plan["copy"] else ())
+        finally:
+            if plan["conn"] is not None:
+                plan["conn"].close()
+
+    def plan_table(self, table: str) -> dict:
+        """Work out what is left to load of `table`: the journal state, the rows
+        still to copy (incremental range, resume point) and the COPY plan.
+
+        plan["result"] is set when there is nothing to do. Otherwise
+        plan["conn"] is an open source connection that the caller closes once
+        plan["bounds"], the generator of keyset slices, is no longer needed.
+        """
+        state = self.journal.table_state(table)
+        plan = {"table": table, "state": state, "result": None, "conn": None, "copy": False}
+        if state.get("done"):
+            plan["result"] = f"{state['rows']} (already committed)"
+            return plan
+        conn = open_source_db(self.sources[table], immutable=self.options.snapshot)
+        try:
+            if not sqlite_table_exists(conn, table):
+                conn.close()
+                plan["result"] = "0"
+                return plan
+            source_cols = set(sqlite_columns(conn, table))
+            key = sqlite_chunk_key(conn, table, has_integer_id(self.schema, table))
+            where, params, note = [], [], ""
+            column = upper = None
+            if self.marks is not None:
+                column = incremental_column(self.schema, table, source_cols)
+                if column is None:
+                    note = " (full upsert)"
+                else:
+                    col = quote_ident(column)
+                    upper = conn.execute(f"SELECT MAX({col}) FROM {quote_ident(table)}").fetchone()[0]
+                    previous = self.marks.get(table, column)
+                    where.append(f"{col} <= ?")
+                    params.append(upper)
+                    if previous is not None:
+                        # ids are strictly increasing; timestamps can repeat, so re-send the boundary rows.
+                        where.append(f"{col} {'>' if column == 'id' else '>='} ?")
+                        params.append(previous)
+                    note = f" ({column} {previous!r} -> {upper!r})"
+            after = None
+            if key is not None and state.get("key") == key and state.get("last_key") is not None:
+                after = state["last_key"]
+                note += f" (resumed after {key} {after})"
+            track_max = self.options.fresh and not state.get("rows")
+            plan.update(
+                conn=conn,
+                note=note,
+                column=column,
+                upper=upper,
+                track_max=track_max,
+                copy=upper is not None or column is None,
+            )
+            if plan["copy"]:
+                plan.update(self._copy_setup(conn, table, where, params, key, after, track_max))
+        except BaseException:
+            conn.close()
+            raise
+        return plan
+
+    def _copy_setup(self, conn: sqlite3.Connection, table: str, where, params, key, after, track_max: bool) -> dict:
+        cols, indexes, converters = copy_plan(self.schema, table)
+        binary = None
+        if self.options.binary_tz is not None:
+            types = {c["name"]: c["type"] for c in self.schema["columns"][table]}
+            pg_types = tuple(types[c] for c in cols)
+            if binary_copy_supported(pg_types):
+                binary = (pg_types, self.options.binary_tz)
+            else:
+                print(f"[copy] {table}: column types without a binary encoder, using text COPY")
+        max_pos = max_column = None
+        sequences = [c["name"] for c in self.schema["columns"][table] if c["sequence"]]
+        if track_max and len(sequences) == 1 and sequences[0] in TABLE_COLUMNS[table]:
+            max_column = sequences[0]
+            max_pos = TABLE_COLUMNS[table].index(max_column)
+        oversized = None
+        if self.options.blob_threshold:
+            oversized = (oversized_columns(self.schema, table, cols), self.options.blob_threshold)
+        compact = json_columns(table) if self.options.compact_json else []
+        span = None
+        if key is not None:
+            key_sql = quote_ident(key) if key != "rowid" else key
+            span = conn.execute(f"SELECT MIN({key_sql}), MAX({key_sql}) FROM {quote_ident(table)}").fetchone()
+            bounds = self._timed_bounds(keyset_slices(conn, table, self.options.batch_size, where, params, key, after))
+        else:
+            bounds = iter([(None, None)])
+
+        def submit(lower_upper):
+            lower, upper = lower_upper
+            return self.exporter.submit(
+                export_slice,
+                self.sources[table],
+                self.options.snapshot,
+                table,
+                where,
+                params,
+                key,
+                lower,
+                upper,
+                self.options.batch_size,
+                indexes,
+                converters,
+                binary,
+                max_pos,
+                oversized,
+                compact,
+            )
+
+        return {
+            "cols": cols,
+            "key": key,
+            "binary": binary,
+            "max_column": max_column,
+            "span": span,
+            "bounds": bounds,
+            "submit": submit,
+        }
+
+    def _timed_bounds(self, bounds):
+        while True:
+            started = time.perf_counter()
+            b = next(bounds, None)
+            self._use("read", time.perf_counter() - started)
+            if b is None:
+                return
+            yield b
+
+    def _use(self, stage: str, seconds: float):
+        with self.usage_lock:
+            self.usage[stage] += seconds
+
+    def prefetched(self, plan):
+        """Yield (slice bounds, export future) in key order, keeping a chunk
+        plus `prefetch` slices submitted to the export pool ahead of COPY."""
+        per_chunk = max(1, self.options.chunk_rows // self.options.batch_size)
+        ahead = deque()
+        try:
+            while True:
+                while len(ahead) < per_chunk + self.options.prefetch:
+                    b = next(plan["bounds"], None)
+                    if b is None:
+                        break
+                    ahead.append((b, plan["submit"](b)))
+                if not ahead:
+                    return
+                yield ahead.popleft()
+        finally:
+            for _b, fut in ahead:
+                fut.cancel()
+
+    def load_table(self, plan, slices) -> str:
+        """COPY the (bounds, export future) pairs `slices` yields and book the
+        table as done in the journal and the high-water marks."""
+        table, state = plan["table"], plan["state"]
+        if plan["result"] is not None:
+            if not state.get("done"):
+                self.journal.finish_table(table)
+            return plan["result"]
+        count = 0
+        with self.metrics.span("table", table) as span:
+            if plan["copy"]:
+                count = self.copy_chunks(plan, slices)
+            elif plan["track_max"]:
+                self.max_ids.update({(table, c["name"]): None for c in self.schema["columns"][table] if c["sequence"]})
+            span["rows"] = count
+        self.loaded_rows[table] = count + state.get("rows", 0)
+        self.journal.finish_table(table)
+        if plan["column"] is not None and plan["upper"] is not None:
+            self.marks.set(table, plan["column"], plan["upper"])
+        return f"{count + state.get('rows', 0)}{plan['note']}"
+
+    def copy_chunks(self, plan, slices) -> int:
+        """Commit the selected rows chunk by chunk.
+
+        The rows are cut into keyset slices of --batch-size rows that the
+        export pool reads and encodes ahead of time; this thread only streams
+        finished slices, in key order, into one COPY per chunk of about
+        --chunk-rows rows.
+        """
+        table, key, span = plan["table"], plan["key"], plan["span"]
+        per_chunk = max(1, self.options.chunk_rows // self.options.batch_size)
+        slices = iter(slices)
+        total = 0
+        max_id = None
+        with self.db.session() as sess:
+            while True:
+                started = time.perf_counter()
+                batch = list(itertools.islice(slices, per_chunk))
+                self._use("copy_wait", time.perf_counter() - started)
+                if not batch:
+                    break
+                chunk = self._copy_chunk(
+                    sess, table, plan["cols"], key, batch, plan["submit"], plan["binary"] is not None
+                )
+                if chunk is None:
+                    break
+                total += chunk["rows"]
+                if chunk["max_id"] is not None:
+                    max_id = max(max_id or chunk["max_id"], chunk["max_id"])
+                if len(batch) == per_chunk:
+                    print(
+                        f"[chunk] {table}: {total} rows committed, "
+                        f"{key} <= {chunk['last']}{_progress(span, chunk['last'])}"
+                    )
+        if plan["max_column"] is not None:
+            self.max_ids[(table, plan["max_column"])] = max_id
+        return total
+
+    def _copy_chunk(self, sess, table, cols, key, slices, submit, binary: bool = False):
+        futures = [fut for _b, fut in slices]
+        for attempt in range(self.options.chunk_retries + 1):
+            chunk = {"rows": 0, "first": None, "last": None, "max_id": None}
+            # Export/transform run in the pool; "wait" is how long COPY sat idle on them.
+            work = {
+                "bytes": 0,
+                "export": 0.0,
+                "transform": 0.0,
+                "wait": 0.0,
+                "peak": None,
+                "blobs": 0,
+                "json_invalid": 0,
+            }
+
+            def payloads():
+                for fut in futures:
+                    started = time.perf_counter()
+                    part = fut.result()
+                    work["wait"] += time.perf_counter() - started
+                    work["export"] += part["export_seconds"]
+                    work["transform"] += part["transform_seconds"]
+                    work["peak"] = max(work["peak"] or 0, part["peak_rss_kb"] or 0) or None
+                    if not part["rows"]:
+                        continue
+                    if chunk["first"] is None:
+                        chunk["first"] = part["first"]
+                    chunk["last"] = part["last"]
+                    chunk["rows"] += part["rows"]
+                    if part["max_id"] is not None:
+                        chunk["max_id"] = max(chunk["max_id"] or part["max_id"], part["max_id"])
+                    work["bytes"] += len(part["payload"])
+                    work["json_invalid"] += part["json_invalid"]
+                    start = 0
+                    for offset, column, rowid in part["blobs"]:
+                        yield part["payload"][start:offset]
+                        for piece in stream_oversized(
+                            self.sources[table],
+                            self.options.snapshot,
+                            table,
+                            column,
+                            rowid,
+                            binary,
+                            self.options.compact_json and column.endswith("_json"),
+                        ):
+                            work["bytes"] += len(piece)
+                            yield piece
+                        work["blobs"] += 1
+                        start = offset
+                    yield part["payload"][start:] if start else part["payload"]
+
+            try:
+                if len(futures) == 1 and not futures[0].result()["rows"]:
+                    return None
+                started = time.perf_counter()
+                copy_into(sess, self.schema, table, cols, payloads(), upsert=self.marks is not None, binary=binary)
+                copy_seconds = time.perf_counter() - started - work["wait"]
+            except Exception as exc:
+                if attempt == self.options.chunk_retries:
+                    raise
+                print(
+                    f"[retry] {table}: chunk after {key} {slices[0][0][0]} failed ({exc}), attempt "
+                    f"{attempt + 2}/{self.options.chunk_retries + 1}"
+                )
+                futures = [submit(b) for b, _fut in slices]
+                continue
+            self.journal.commit_chunk(table, key, chunk["first"], chunk["last"], chunk["rows"])
+            rows, size = chunk["rows"], work["bytes"]
+            with self.usage_lock:
+                self.usage.update(
+                    export=work["export"], transform=work["transform"], copy=copy_seconds, copy_wait=work["wait"]
+                )
+            self.metrics.record(
+                "export", table, work["export"], rows=rows, bytes=size, slices=len(futures), peak_rss_kb=work["peak"]
+            )
+            if table in ROW_TRANSFORMS:
+                self.metrics.record("transform", table, work["transform"], rows=rows)
+            self.metrics.record(
+                "copy",
+                table,
+                copy_seconds,
+                rows=rows,
+                bytes=size,
+                export_wait_seconds=round(work["wait"], 6),
+                streamed_values=work["blobs"],
+            )
+            if work["json_invalid"]:
+                self.json_invalid[table] += work["json_invalid"]
+            return chunk
+
+    def run_waves(self, waves, workers: int):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for n, wave in enumerate(waves, 1):
+                print(f"[wave {n}/{len(waves)}] {', '.join(wave)}")
+                futures = {pool.submit(self.profiler.call, "copy", self.import_table, t): t for t in wave}
+                errors = []
+                for fut in as_completed(futures):
+                    table = futures[fut]
+                    try:
+                        print(f"[copy] {table}: {fut.result()}")
+                    except Exception as exc:
+                        errors.append(f"{table}: {exc}")
+                if errors:
+                    raise RuntimeError("import failed for " + "; ".join(errors))
+
+    def run_pipeline(self, waves, workers: int):
+        """Load the waves through an asyncio pipeline of reader and COPY writer
+        stages joined by one bounded queue per table.
+
+        Readers plan each table and submit its slices to the export pool in
+        import order, so tables of later waves are read and encoded while
+        earlier ones are still streaming into Postgres; a full queue blocks its
+        reader until the writer catches up. Writers keep the wave order: a
+        table is only COPYed once every table of the previous waves is in.
+        SQLite and Postgres calls block, so both stages run in threads and
+        only the queues and the scheduling live on the event loop.
+        """
+        with ThreadPoolExecutor(max_workers=2 * workers) as threads:
+            asyncio.run(self._pipeline(waves, workers, threads))
+
+    async def _pipeline(self, waves, workers: int, threads):
+        loop = asyncio.get_running_loop()
+        read_slots = asyncio.Semaphore(workers)
+        write_slots = asyncio.Semaphore(workers)
+        # The first item is the plan, then (bounds, export future) pairs; None
+        # ends a table and an exception aborts it.
+        queues = {t: asyncio.Queue(maxsize=self.options.prefetch) for wave in waves for t in wave}
+        stop = threading.Event()
+
+        async def read(table):
+            # Semaphores are FIFO, so readers start in import order and a later
+            # wave can never hold every slot while an earlier one waits.
+            async with read_slots:
+                await loop.run_in_executor(
+                    threads, self.profiler.call, "read", self._read_stage, table, queues[table], loop, stop
+                )
+
+        async def write(table):
+            async with write_slots:
+                return await loop.run_in_executor(
+                    threads, self.profiler.call, "copy", self._write_stage, queues[table], loop
+                )
+
+        readers = [asyncio.create_task(read(t)) for t in queues]
+        try:
+            for n, wave in enumerate(waves, 1):
+                print(f"[wave {n}/{len(waves)}] {', '.join(wave)}")
+                results = await asyncio.gather(*(write(t) for t in wave), return_exceptions=True)
+                errors = []
+                for table, result in zip(wave, results):
+                    if isinstance(result, Exception):
+                        errors.append(f"{table}: {result}")
+                    else:
+                        print(f"[copy] {table}: {result}")
+                if errors:
+                    raise RuntimeError("import failed for " + "; ".join(errors))
+            # Failed readers already surfaced through their writers.
+            await asyncio.gather(*readers, return_exceptions=True)
+        finally:
+            # After a failure, readers may be blocked on full queues: drain
+            # them until every reader has seen `stop` and returned.
+            stop.set()
+            while not all(task.done() for task in readers):
+                for queue in queues.values():
+                    while not queue.empty():
+                        item = queue.get_nowait()
+                        if isinstance(item, tuple):
+                            item[1].cancel()
+                await asyncio.wait(readers, timeout=0.05)
+
+    def _read_stage(self, table: str, queue, loop, stop):
+        def put(item):
+            if stop.is_set():
+                if isinstance(item, tuple):
+                    item[1].cancel()
+                return
+            started = time.perf_counter()
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+            self._use("read_blocked", time.perf_counter() - started)
+
+        try:
+            started = time.perf_counter()
+            plan = self.plan_table(table)
+            self._use("read", time.perf_counter() - started)
+            try:
+                put(plan)
+                if plan["copy"]:
+                    for b in plan["bounds"]:
+                        if stop.is_set():
+                            break
+                        put((b, plan["submit"](b)))
+            finally:
+                if plan["conn"] is not None:
+                    plan["conn"].close()
+            put(None)
+        except Exception as exc:
+            put(exc)
+            raise
+
+    def _write_stage(self, queue, loop) -> str:
+        def items():
+            while True:
+                item = asyncio.run_coroutine_threadsafe(queue.get(), loop).result()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        slices = items()
+        return self.load_table(next(slices), slices)
+
+    def utilization(self, seconds: float, export_workers: int, workers: int) -> dict:
+        """Share of each stage's capacity (wall time x its workers) spent busy
+        or stalled on a neighbouring stage."""
+
+        def share(stages, slots):
+            return round(sum(self.usage[s] for s in stages) / (seconds * slots), 3) if seconds > 0 else 0.0
+
+        return {
+            "read": share(["read"], workers),
+            "read_blocked": share(["read_blocked"], workers),
+            "export": share(["export", "transform"], export_workers),
+            "transform": share(["transform"], export_workers),
+            "copy": share(["copy"], workers),
+            "copy_wait": share(["copy_wait"], workers),
+        }
+
+
+# The visit tables --rollup-visits rebuilds and the daily rollups of site_visits
+# (migrations/012) it builds with them; see migrate_rollup.py.
+VISIT_TABLES = ("site_visits", "unique_visitors")
+ROLLUP_TABLES = ("site_visit_daily_pages", "site_visit_daily_visitors")
 
 
-def reset_sequences(conn_info):
-    sql = """
-DO $$
-DECLARE r record;
-DECLARE max_id bigint;
-BEGIN
-  FOR r IN
-    SELECT
-      n.nspname AS schema_name,
-      c.relname AS table_name,
-      a.attname AS column_name,
-      pg_get_serial_sequence(format('%I.%I', n.nspname, c.relname), a.attname) AS seq_name
-    FROM pg_class c
-    JOIN pg_namespace n ON n.oid = c.relnamespace
-    JOIN pg_attribute a ON a.attrelid = c.oid
-    WHERE c.relkind = 'r'
-      AND a.attnum > 0
-      AND NOT a.attisdropped
-      AND n.nspname = 'public'
-      AND a.attname = 'id'
-  LOOP
-    IF r.seq_name IS NOT NULL THEN
-      EXECUTE format('SELECT COALESCE(MAX(%I), 0) FROM %I.%I', r.column_name, r.schema_name, r.table_name) INTO max_id;
-      EXECUTE format('SELECT setval(%L, %s, true)', r.seq_name, max_id);
-    END IF;
-  END LOOP;
-END
-$$;
-"""
-    run_psql(conn_info, sql)
 
 
 def main():
+    # The larger commands live in modules next to this script, which import
+    # the helpers above from it under its module name.
+    sys.modules.setdefault("migrate_sqlite_to_postgres", sys.modules[__name__])
+    from migrate_cdc import CHANGELOG_TABLE, install_cdc, remove_cdc, run_sync
+    from migrate_rollup import (
+        has_visit_rollups,
+        refresh_visit_rollups,
+        rollup_site_visits,
+        verify_visit_rollups,
+    )
+    from migrate_verify import session_timezone, verify_target
+
     parser = argparse.ArgumentParser(description="Migrate SQLite data files to PostgreSQL")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["migrate", "verify", "cdc-install", "sync", "cdc-remove"],
+        default="migrate",
+        help=(
+            "migrate (default); verify the target against the sources with bucketed checksums; "
+            "cdc-install / sync / cdc-remove capture source changes with triggers and replay them into the target "
+            "until cutover"
+        ),
+    )
     parser.add_argument("--data-dir", default=str((Path.cwd() / ".." / "data").resolve()), help="Directory containing users.db/blog.db/studio.db/messages.db")
     parser.add_argument("--keep-existing", action="store_true", help="Do not truncate target tables before import")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Copy only rows past each table's high-water mark and upsert them (implies --keep-existing)",
+    )
+    parser.add_argument(
+        "--hwm-file", default=str(DEFAULT_HWM_FILE), help="Where --incremental stores per-table high-water marks"
+    )
+    parser.add_argument(
+        "--chunk-rows", type=int, default=100000, help="Rows per keyset page; every page is committed as its own chunk"
+    )
+    parser.add_argument(
+        "--chunk-retries",
+        type=int,
+        default=0,
+        help="Times a failed chunk is re-read and retried before the table fails",
+    )
+    parser.add_argument(
+        "--checkpoint-file", default=str(DEFAULT_CHECKPOINT_FILE), help="Journal of committed tables and chunks"
+    )
+    parser.add_argument(
+        "--defer-indexes",
+        action="store_true",
+        help="Drop secondary indexes and foreign keys of the loaded tables before COPY and rebuild them afterwards",
+    )
+    parser.add_argument(
+        "--deferred-ddl-file",
+        default=str(DEFAULT_DEFERRED_DDL_FILE),
+        help="Where --defer-indexes keeps the captured definitions until they are restored",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the previous run from its checkpoint journal instead of starting over",
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        default=str(DEFAULT_SNAPSHOT_DIR),
+        help="Where the point-in-time copies of the source databases are taken before export",
+    )
+    parser.add_argument(
+        "--no-snapshot",
+        action="store_true",
+        help="Export straight from the live source files instead of a point-in-time copy",
+    )
+    parser.add_argument(
+        "--analyze",
+        choices=["analyze", "vacuum", "skip"],
+        default="analyze",
+        help="Statistics pass over the loaded tables after the load: ANALYZE, VACUUM (ANALYZE) or none",
+    )
+    parser.add_argument(
+        "--copy-format",
+        choices=["text", "binary"],
+        default="text",
+        help=(
+            "COPY wire format; binary encodes integers, floats, booleans and timestamps by target column type in the "
+            "export workers"
+        ),
+    )
+    parser.add_argument(
+        "--blob-threshold",
+        type=int,
+        default=DEFAULT_BLOB_THRESHOLD,
+        help=(
+            f"Text values larger than this many bytes are streamed into COPY in {BLOB_PIECE_BYTES // 1024} KB pieces "
+            "instead of travelling in the export payloads (0 = never)"
+        ),
+    )
+    parser.add_argument(
+        "--compact-json",
+        action="store_true",
+        help=(
+            "Strip insignificant whitespace from well-formed *_json values on the way in "
+            "(pass it to verify and sync as well)"
+        ),
+    )
+    parser.add_argument(
+        "--rollup-visits",
+        action="store_true",
+        help=(
+            "Load site_visits in one streaming pass that also builds the daily page/visitor rollups "
+            "and rebuilds unique_visitors from the visits (pass it to verify and sync as well)"
+        ),
+    )
+    parser.add_argument(
+        "--archive-visits-before",
+        type=date.fromisoformat,
+        help=(
+            "--rollup-visits: write visits on days before this date (YYYY-MM-DD) to gzipped CSV files "
+            "instead of loading them"
+        ),
+    )
+    parser.add_argument(
+        "--archive-dir",
+        default=str(DEFAULT_ARCHIVE_DIR),
+        help="--rollup-visits: where the archived visits go, one site_visits-YYYY-MM.csv.gz per month",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=5000,
+        help="Rows per export slice, read and encoded by one export worker and piped to COPY as a unit",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="Tables imported concurrently within a dependency wave"
+    )
+    parser.add_argument(
+        "--pipeline",
+        choices=["async", "waves"],
+        default="async",
+        help=(
+            "async reads and encodes later tables while earlier ones stream into COPY, "
+            "through bounded per-table queues; waves finishes every dependency wave before reading the next"
+        ),
+    )
+    parser.add_argument(
+        "--export-processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes that read and encode source rows (0 = export inside the import threads)",
+    )
+    parser.add_argument(
+        "--driver",
+        choices=["auto", "psycopg", "psql"],
+        default="auto",
+        help="Postgres client: native psycopg driver or the psql CLI (auto prefers psycopg)",
+    )
+    parser.add_argument(
+        "--schema-cache",
+        default=str(DEFAULT_SCHEMA_CACHE),
+        help="Target schema snapshot file, keyed by the latest migrations/*.sql (empty to disable)",
+    )
+    parser.add_argument(
+        "--refresh-schema", action="store_true", help="Ignore the cached schema snapshot and re-read the target catalog"
+    )
+    parser.add_argument(
+        "--bucket-rows", type=int, default=10000, help="verify: width of the id ranges digests are compared by"
+    )
+    parser.add_argument("--report", default=str(DEFAULT_VERIFY_REPORT), help="verify: where the JSON report is written")
+    parser.add_argument(
+        "--sync-batch", type=int, default=1000, help="sync: logged changes applied per source and transaction"
+    )
+    parser.add_argument(
+        "--sync-interval", type=float, default=1.0, help="sync: seconds to wait when there is nothing to apply"
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="sync: exit as soon as every changelog is empty instead of running until interrupted",
+    )
+    parser.add_argument(
+        "--sync-status",
+        default=str(DEFAULT_SYNC_STATUS),
+        help="sync: JSON file updated with pending changes and lag after every round",
+    )
+    parser.add_argument("--metrics", help="Write per-phase/per-table timings, rows, bytes and peak memory to this file")
+    parser.add_argument(
+        "--metrics-format",
+        choices=["jsonl", "openmetrics"],
+        default="jsonl",
+        help="JSON lines (one record per span) or OpenMetrics text (totals per phase and table)",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=str(DEFAULT_PROFILE_DIR),
+        help="Profile every phase (export workers included); writes <phase>.prof dumps and flamegraph stacks here",
+    )
+    parser.add_argument("--profile-top", type=int, default=20, help="--profile: hotspots listed in the summary")
     args = parser.parse_args()
+    if args.batch_size <= 0:
+        raise RuntimeError("--batch-size must be positive")
+    if args.workers <= 0:
+        raise RuntimeError("--workers must be positive")
+    if args.chunk_rows <= 0:
+        raise RuntimeError("--chunk-rows must be positive")
+    if args.export_processes < 0:
+        raise RuntimeError("--export-processes must not be negative")
+    if args.chunk_retries < 0:
+        raise RuntimeError("--chunk-retries must not be negative")
+    if args.bucket_rows <= 0:
+        raise RuntimeError("--bucket-rows must be positive")
+    if args.sync_batch <= 0:
+        raise RuntimeError("--sync-batch must be positive")
+    if args.blob_threshold < 0:
+        raise RuntimeError("--blob-threshold must not be negative")
+    if args.archive_visits_before and not args.rollup_visits:
+        raise RuntimeError("--archive-visits-before needs --rollup-visits")
+    if args.rollup_visits and (args.incremental or args.keep_existing):
+        raise RuntimeError(
+            "--rollup-visits rebuilds the visit tables from scratch "
+            "and cannot be combined with --incremental or --keep-existing"
+        )
 
     load_env_file(Path.cwd() / ".env.local")
     load_env_file(Path.cwd() / ".env")
@@ -474,55 +2917,297 @@ def main():
     if not database_url:
         raise RuntimeError("DATABASE_URL is required")
 
-    check_psql()
+    driver = resolve_driver(args.driver)
+    schema_cache = Path(args.schema_cache) if args.schema_cache else None
     conn_info = parse_database_url(database_url)
     data_dir = Path(args.data_dir)
     if not data_dir.exists():
         raise RuntimeError(f"data dir not found: {data_dir}")
 
-    with tempfile.TemporaryDirectory(prefix="witweb_migrate_") as td:
-        tmp_dir = Path(td)
-        exported = {}
-        for db_name, tables in SOURCE_GROUPS.items():
-            db_path = data_dir / db_name
-            if not db_path.exists():
-                print(f"[warn] source db not found, skip: {db_path}")
-                continue
-            print(f"[read] {db_path}")
-            conn = sqlite3.connect(str(db_path))
-            try:
-                for table in tables:
-                    csv_file = tmp_dir / f"{table}.csv"
-                    cnt = export_table_to_csv(conn, table, csv_file)
-                    if cnt > 0:
-                        exported[table] = csv_file
-                    print(f"  - {table}: {cnt}")
-            finally:
-                conn.close()
+    db_paths = {}
+    for db_name in SOURCE_GROUPS:
+        db_path = data_dir / db_name
+        if not db_path.exists():
+            print(f"[warn] source db not found, skip: {db_path}")
+            continue
+        print(f"[read] {db_path}")
+        db_paths[db_name] = db_path
+    metrics = Metrics(args.metrics, args.metrics_format)
+    profiler = Profiler(args.profile, args.profile_top)
+    target = f"{conn_info['host']}:{conn_info['port']}/{conn_info['dbname']}"
+    run_key = f"{target}|{data_dir.resolve()}|{'incremental' if args.incremental else 'full'}"
+    snapshot_dir = None if args.no_snapshot or args.command != "migrate" else Path(args.snapshot_dir)
+    if snapshot_dir is not None and args.resume:
+        # Resumed chunks must come from the same point in time as the journaled ones.
+        recorded = CheckpointJournal.load(Path(args.checkpoint_file), run_key).get("snapshot")
+        if not recorded:
+            print("[resume] the interrupted run read the live sources, continuing without a snapshot")
+            snapshot_dir = None
+        else:
+            gone = [copy for copy in recorded.values() if not Path(copy).exists()]
+            if gone:
+                raise RuntimeError(f"snapshot of the interrupted run is gone ({gone[0]}); start over without --resume")
+            db_paths = {name: Path(copy) for name, copy in recorded.items()}
+            print(f"[snapshot] reusing the snapshot of the interrupted run in {snapshot_dir}")
+    elif snapshot_dir is not None:
+        with metrics.span("snapshot", dbs=len(db_paths)) as span, profiler.phase("snapshot"):
+            copies = snapshot_sources(db_paths.values(), snapshot_dir)
+            span["bytes"] = sum(copy.stat().st_size for copy in copies.values())
+        db_paths = {name: copies[path] for name, path in db_paths.items()}
+    sources = {
+        table: db_paths[db_name] for db_name, tables in SOURCE_GROUPS.items() if db_name in db_paths for table in tables
+    }
 
-        if not args.keep_existing:
+    db = PgPool(conn_info, driver, args.workers + 1)
+    if args.export_processes:
+        exporter = ProcessPoolExecutor(
+            args.export_processes, initializer=_init_export_worker, initargs=(RUN_STARTED_AT,)
+        )
+    else:
+        exporter = ThreadPoolExecutor(max_workers=args.workers)
+    if args.profile:
+        exporter = ProfiledExecutor(exporter, profiler)
+    try:
+        if args.command == "verify":
+            started = time.perf_counter()
+            with metrics.span("schema"), profiler.phase("schema"):
+                schema = load_pg_schema(db, schema_cache, args.refresh_schema)
+            tables = [t for t in IMPORT_ORDER if t in sources and t in schema["columns"]]
+            if args.rollup_visits:
+                tables = [t for t in tables if t not in VISIT_TABLES]
+            with metrics.span("verify") as span, profiler.phase("verify"):
+                results = verify_target(
+                    db,
+                    schema,
+                    sources,
+                    tables,
+                    exporter,
+                    args.workers,
+                    args.batch_size,
+                    args.chunk_rows,
+                    args.bucket_rows,
+                    metrics,
+                    args.compact_json,
+                )
+                if args.rollup_visits and "site_visits" in sources:
+                    results.update(verify_visit_rollups(db, sources["site_visits"]))
+                span["rows"] = sum(r["source_rows"] for r in results.values())
+            failed = [t for t, r in results.items() if not r["ok"]]
+            report = {
+                "target": target,
+                "data_dir": str(data_dir.resolve()),
+                "bucket_rows": args.bucket_rows,
+                "seconds": round(time.perf_counter() - started, 3),
+                "ok": not failed,
+                "tables": results,
+            }
+            report_path = Path(args.report)
+            report_path.parent.mkdir(parents=True, exist_ok=True)
+            report_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+            print(f"[verify] report written to {report_path}")
+            if failed:
+                raise RuntimeError(f"verification failed for {', '.join(failed)}")
+            return
+        if args.command in ("cdc-install", "sync"):
+            schema = load_pg_schema(db, schema_cache, args.refresh_schema)
+        if args.command == "cdc-install":
+            for db_name, path in db_paths.items():
+                covered = install_cdc(path, SOURCE_GROUPS[db_name], schema)
+                print(f"[cdc] {db_name}: capturing changes of {len(covered)} table(s) into {CHANGELOG_TABLE}")
+            print("[cdc] now run the full migration, then `sync` to replay changes made since")
+            return
+        if args.command == "cdc-remove":
+            for db_name, path in db_paths.items():
+                pending = remove_cdc(path)
+                print(
+                    f"[cdc] {db_name}: triggers and changelog removed"
+                    f"{f' ({pending} change(s) were never synced)' if pending else ''}"
+                )
+            return
+        if args.command == "sync":
+            try:
+                total = run_sync(
+                    db,
+                    schema,
+                    db_paths,
+                    args.sync_batch,
+                    args.sync_interval,
+                    args.once,
+                    Path(args.sync_status),
+                    metrics,
+                    args.compact_json,
+                    args.rollup_visits,
+                )
+            except KeyboardInterrupt:
+                print("[sync] interrupted")
+                return
+            print(f"[sync] done, {total} change(s) applied")
+            return
+        journal = CheckpointJournal(
+            Path(args.checkpoint_file), run_key, args.resume, db_paths if snapshot_dir is not None else None
+        )
+        if args.resume:
+            print(f"[resume] continuing from {args.checkpoint_file}")
+        elif not (args.keep_existing or args.incremental):
             print("[db] truncating target tables ...")
-            truncate_target(conn_info)
+            with metrics.span("truncate"), profiler.phase("truncate"):
+                truncate_target(db)
 
-        for table in IMPORT_ORDER:
-            csv_file = exported.get(table)
-            if not csv_file:
-                continue
-            print(f"[copy] {table}")
-            if table == "unique_visitors":
-                transformed = tmp_dir / "unique_visitors_fixed.csv"
-                transform_unique_visitors_csv(csv_file, transformed)
-                copy_csv_to_postgres(conn_info, table, transformed)
-            elif table == "site_visits":
-                transformed = tmp_dir / "site_visits_fixed.csv"
-                transform_site_visits_csv(csv_file, transformed)
-                copy_csv_to_postgres(conn_info, table, transformed)
+        with metrics.span("schema"), profiler.phase("schema"):
+            schema = load_pg_schema(db, schema_cache, args.refresh_schema)
+        tables = [t for t in IMPORT_ORDER if t in sources]
+        rollup = args.rollup_visits and "site_visits" in sources
+        if args.rollup_visits and not rollup:
+            print("[warn] --rollup-visits: no source site_visits, visit tables are imported as usual")
+        if rollup:
+            tables = [t for t in tables if t not in VISIT_TABLES]
+        ddl_file = Path(args.deferred_ddl_file)
+        ddl = None
+        if args.defer_indexes:
+            if ddl_file.exists():
+                # A previous run dropped these and never restored them; the
+                # catalog no longer has them, so the saved copy is authoritative.
+                ddl = json.loads(ddl_file.read_text(encoding="utf-8"))
+                known = {tuple(fk) for fk in schema["foreign_keys"]}
+                schema["foreign_keys"] += [
+                    [t, parent] for t, _n, parent, _d in ddl["foreign_keys"] if (t, parent) not in known
+                ]
+            else:
+                ddl = capture_deferred_ddl(db, tables)
+                ddl_file.parent.mkdir(parents=True, exist_ok=True)
+                ddl_file.write_text(json.dumps(ddl, indent=2), encoding="utf-8")
+            print(
+                f"[db] deferring {len(ddl['indexes'])} index(es) and {len(ddl['foreign_keys'])} foreign key(s) "
+                "until after the load"
+            )
+            with metrics.span(
+                "index_drop", indexes=len(ddl["indexes"]), foreign_keys=len(ddl["foreign_keys"])
+            ), profiler.phase("index_drop"):
+                drop_deferred_ddl(db, ddl)
+        elif ddl_file.exists():
+            print(
+                f"[warn] {ddl_file} lists indexes/foreign keys dropped by an unfinished --defer-indexes run; rerun "
+                "with --defer-indexes to restore them"
+            )
+        if schema["foreign_keys"]:
+            waves = plan_import_waves(tables, table_dependencies(schema, tables))
+        else:
+            print("[warn] no foreign keys found on target, falling back to IMPORT_ORDER")
+            waves = [[t] for t in tables]
+        marks = HighWaterMarks(Path(args.hwm_file), target) if args.incremental else None
+        if not args.resume:
+            # Rows past this id get added to the rollups after the load; None rebuilds them.
+            visits_mark = None
+            if "site_visits" in tables and has_visit_rollups(schema) and (args.keep_existing or args.incremental):
+                visits_mark = db.query("SELECT COALESCE(MAX(id), 0) FROM site_visits")[0][0]
+            journal.remember("visits_mark", visits_mark)
+        binary_tz = None
+        if args.copy_format == "binary":
+            binary_tz = session_timezone(db)
+        options = ImportOptions(
+            batch_size=args.batch_size,
+            chunk_rows=args.chunk_rows,
+            chunk_retries=args.chunk_retries,
+            snapshot=snapshot_dir is not None,
+            prefetch=max(2, args.export_processes),
+            binary_tz=binary_tz,
+            fresh=not (args.keep_existing or args.incremental),
+            blob_threshold=args.blob_threshold,
+            compact_json=args.compact_json,
+        )
+        job = ImportJob(
+            db,
+            schema,
+            sources,
+            journal,
+            options,
+            marks=marks,
+            exporter=exporter,
+            metrics=metrics,
+            profiler=profiler,
+        )
+        with metrics.span("import", waves=len(waves), pipeline=args.pipeline) as span:
+            started = time.perf_counter()
+            if args.pipeline == "async":
+                job.run_pipeline(waves, args.workers)
             else:
-                copy_csv_to_postgres(conn_info, table, csv_file)
+                job.run_waves(waves, args.workers)
+            export_workers = args.export_processes or args.workers
+            usage = job.utilization(time.perf_counter() - started, export_workers, args.workers)
+            span.update(utilization=usage)
+        print(
+            f"[pipeline] {args.pipeline}: read {usage['read']:.0%} busy / "
+            f"{usage['read_blocked']:.0%} blocked on full queues, "
+            f"export {usage['export']:.0%} of {export_workers} worker(s) (transform {usage['transform']:.0%}), "
+            f"copy {usage['copy']:.0%} of {args.workers} writer(s) / {usage['copy_wait']:.0%} waiting for slices"
+        )
+        for table, n in job.json_invalid.items():
+            print(f"[json] {table}: {n} value(s) are not well-formed JSON, copied unchanged")
+        analyzed = dict(job.loaded_rows)
+        if rollup:
+            with metrics.span("rollup", "site_visits") as span, profiler.phase("rollup"):
+                r = rollup_site_visits(
+                    db, schema, sources["site_visits"], snapshot_dir is not None, args.batch_size, session_timezone(db),
+                    args.archive_visits_before, Path(args.archive_dir),
+                )
+                span.update(
+                    rows=r["visits"], bytes=r["bytes"], archived=r["archived"], pages=r["pages"], visitors=r["visitors"]
+                )
+            print(
+                f"[rollup] site_visits: {r['visits']} visit(s) -> "
+                f"{r['pages']} page-day and {r['day_visitors']} visitor-day row(s), "
+                f"{r['visitors']} unique visitor(s) (source unique_visitors had {r['source_visitors']}); "
+                f"loaded {r['loaded']}"
+            )
+            if r["archives"]:
+                print(
+                    f"[rollup] archived {r['archived']} visit(s) before {args.archive_visits_before} into "
+                    f"{len(r['archives'])} file(s) under {args.archive_dir}"
+                )
+            analyzed.update(
+                {
+                    "site_visits": r["loaded"],
+                    "unique_visitors": r["visitors"],
+                    ROLLUP_TABLES[0]: r["pages"],
+                    ROLLUP_TABLES[1]: r["day_visitors"],
+                }
+            )
+        elif "site_visits" in tables and has_visit_rollups(schema):
+            with metrics.span("rollup", "site_visits"), profiler.phase("rollup"):
+                refresh_visit_rollups(db, journal.data.get("visits_mark"))
+            analyzed.update(dict.fromkeys(ROLLUP_TABLES, 0))
+
+        if ddl is not None:
+            with metrics.span(
+                "index_rebuild", indexes=len(ddl["indexes"]), foreign_keys=len(ddl["foreign_keys"])
+            ), profiler.phase("index_rebuild"):
+                restore_deferred_ddl(db, ddl, args.workers)
+            ddl_file.unlink()
 
-        print("[db] resetting sequences ...")
-        reset_sequences(conn_info)
+        with metrics.span("sequence_reset") as span, profiler.phase("sequence_reset"):
+            span["sequences"] = reset_sequences(db, schema, job.max_ids)
+        print(f"[db] reset {span['sequences']} sequence(s) ({len(job.max_ids)} from export maxima)")
+        if args.analyze != "skip":
+            loaded = sorted(
+                (t for t in set(tables) | analyzed.keys() if schema["columns"].get(t)),
+                key=lambda t: analyzed.get(t, 0),
+                reverse=True,
+            )
+            print(f"[db] {'vacuum-analyzing' if args.analyze == 'vacuum' else 'analyzing'} {len(loaded)} table(s) ...")
+            with metrics.span("analyze", tables=len(loaded)), profiler.phase("analyze"):
+                analyze_tables(db, loaded, args.workers, vacuum=args.analyze == "vacuum")
+    finally:
+        exporter.shutdown(cancel_futures=True)
+        close_export_conns()
+        db.close()
+        print(db.stats.summary(driver))
+        metrics.close()
+        profiler.close()
 
+    # Only once the exporter is gone and no handle keeps the copies open.
+    if snapshot_dir is not None:
+        for copy in db_paths.values():
+            copy.unlink(missing_ok=True)
     print("[done] sqlite -> postgres migration complete")
 
 
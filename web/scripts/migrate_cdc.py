@@ -0,0 +1,320 @@
+"""The cdc-install, sync and cdc-remove commands of migrate-sqlite-to-postgres.py.
+
+Triggers on the source tables log the primary key of every changed row into
+CHANGELOG_TABLE; sync re-reads those rows and mirrors their current state (or
+absence) into Postgres, so applying a change twice is harmless.
+"""
+
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from migrate_rollup import has_visit_rollups, rollup_sync_statements
+from migrate_sqlite_to_postgres import (
+    IMPORT_ORDER,
+    ROW_TRANSFORMS,
+    TABLE_COLUMNS,
+    Metrics,
+    compact_json_rows,
+    copy_plan,
+    json_columns,
+    open_source_db,
+    quote_ident,
+    reset_sequences,
+    sql_literal,
+    sqlite_columns,
+    sqlite_select_sql,
+    sqlite_table_exists,
+)
+
+CHANGELOG_TABLE = "_migrate_changelog"
+CDC_TRIGGER_PREFIX = "_migrate_cdc_"
+CDC_NOW_SQL = "(julianday('now') - 2440587.5) * 86400.0"
+# Consecutive failed batches of one source before sync gives up; a batch can
+# fail transiently when it references a parent row another source has not
+# delivered yet.
+SYNC_MAX_FAILURES = 10
+
+
+def open_cdc_source(path: Path) -> sqlite3.Connection:
+    """Writable connection for installing triggers and consuming the changelog
+    next to the live app; transactions are managed explicitly."""
+    conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+
+def cdc_key_columns(schema, table: str):
+    return [c["name"] for c in schema["columns"].get(table, []) if c["primary_key"]]
+
+
+def install_cdc(path: Path, tables, schema):
+    """Create the changelog table and the capture triggers of `tables` in one
+    source DB; returns the tables now captured."""
+    conn = open_cdc_source(path)
+    covered = []
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {CHANGELOG_TABLE} ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, op TEXT NOT NULL, "
+            "pk TEXT NOT NULL, changed_at REAL NOT NULL)"
+        )
+        for table in tables:
+            if not sqlite_table_exists(conn, table):
+                continue
+            keys = cdc_key_columns(schema, table)
+            if not keys or not set(keys) <= set(sqlite_columns(conn, table)):
+                print(f"[warn] {table}: no primary key shared with the target, changes are not captured")
+                continue
+
+            def log(op: str, ref: str, where: str = "") -> str:
+                key = f"json_array({', '.join(f'{ref}.{quote_ident(k)}' for k in keys)})"
+                return (
+                    f"INSERT INTO {CHANGELOG_TABLE} (tbl, op, pk, changed_at) "
+                    f"SELECT '{table}', '{op}', {key}, {CDC_NOW_SQL}{f' WHERE {where}' if where else ''};"
+                )
+
+            key_changed = " OR ".join(f"OLD.{quote_ident(k)} IS NOT NEW.{quote_ident(k)}" for k in keys)
+            bodies = {
+                "insert": ("AFTER INSERT", log("I", "NEW")),
+                # A changed key also logs the old one, so its row is deleted on the target.
+                "update": ("AFTER UPDATE", log("U", "NEW") + " " + log("D", "OLD", key_changed)),
+                "delete": ("AFTER DELETE", log("D", "OLD")),
+            }
+            for name, (when, body) in bodies.items():
+                trigger = quote_ident(f"{CDC_TRIGGER_PREFIX}{table}_{name}")
+                conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+                conn.execute(f"CREATE TRIGGER {trigger} {when} ON {quote_ident(table)} BEGIN {body} END")
+            covered.append(table)
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return covered
+
+
+def remove_cdc(path: Path) -> int:
+    """Drop the capture triggers and the changelog of one source DB; returns
+    the number of changes that were still pending."""
+    conn = open_cdc_source(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        pending = 0
+        if sqlite_table_exists(conn, CHANGELOG_TABLE):
+            pending = conn.execute(f"SELECT COUNT(*) FROM {CHANGELOG_TABLE}").fetchone()[0]
+        triggers = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?", (CDC_TRIGGER_PREFIX + "%",)
+        ).fetchall()
+        for (name,) in triggers:
+            conn.execute(f"DROP TRIGGER IF EXISTS {quote_ident(name)}")
+        conn.execute(f"DROP TABLE IF EXISTS {CHANGELOG_TABLE}")
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return pending
+
+
+def fetch_rows_by_key(conn: sqlite3.Connection, table: str, keys, key_list, batch_size: int):
+    """Current source rows (TABLE_COLUMNS order) of the given key tuples."""
+    select = sqlite_select_sql(conn, table)
+    key_sql = quote_ident(keys[0]) if len(keys) == 1 else f"({', '.join(quote_ident(k) for k in keys)})"
+    # Stay well below SQLite's bound-variable limit.
+    step = max(1, min(batch_size, 900 // len(keys)))
+    rows = []
+    for i in range(0, len(key_list), step):
+        part = key_list[i : i + step]
+        if len(keys) == 1:
+            placeholders = ", ".join("?" * len(part))
+            params = [k[0] for k in part]
+        else:
+            placeholders = ", ".join(f"({', '.join('?' * len(keys))})" for _k in part)
+            params = [v for k in part for v in k]
+        rows.extend(conn.execute(f"{select} WHERE {key_sql} IN ({placeholders})", params).fetchall())
+    return rows
+
+
+def sync_statements(schema, table: str, keys, rows, deleted, compact: bool = False):
+    """Upsert and delete SQL mirroring `rows` and the `deleted` keys of `table`."""
+    cols, indexes, converters = copy_plan(schema, table)
+    upsert = delete = None
+    if rows:
+        transform = ROW_TRANSFORMS.get(table)
+        if transform is not None:
+            rows = transform(rows)
+        if compact:
+            rows, _invalid = compact_json_rows(rows, json_columns(table))
+        values = []
+        for row in rows:
+            if indexes is not None:
+                row = [row[i] for i in indexes]
+            row = list(row)
+            for i, convert in converters:
+                if row[i] is not None:
+                    row[i] = convert(row[i])
+            values.append("(" + ", ".join(sql_literal(v) for v in row) + ")")
+        col_list = ", ".join(quote_ident(c) for c in cols)
+        updates = ", ".join(f"{quote_ident(c)} = EXCLUDED.{quote_ident(c)}" for c in cols if c not in keys)
+        upsert = (
+            f"INSERT INTO {quote_ident(table)} ({col_list}) VALUES {', '.join(values)} "
+            f"ON CONFLICT ({', '.join(quote_ident(k) for k in keys)}) "
+            f"{f'DO UPDATE SET {updates}' if updates else 'DO NOTHING'}"
+        )
+    if deleted:
+        key_sql = f"({', '.join(quote_ident(k) for k in keys)})"
+        tuples = ", ".join("(" + ", ".join(sql_literal(v) for v in key) + ")" for key in deleted)
+        delete = f"DELETE FROM {quote_ident(table)} WHERE {key_sql} IN ({tuples})"
+    return upsert, delete
+
+
+def sync_batch(db, schema, path: Path, batch: int, compact: bool = False, rollup: bool = False):
+    """Apply up to `batch` logged changes of one source DB to Postgres in one
+    transaction, then drop them from the changelog; the visit rollups of the
+    touched days are recomputed in the same transaction. With `rollup`
+    (a --rollup-visits target) unique_visitors changes are dropped and its
+    rows re-derived from the rollups instead. Returns {table: changes}."""
+    skip = ("unique_visitors",) if rollup else ()
+    conn = open_cdc_source(path)
+    try:
+        # One read snapshot covers the log entries and the rows they point at.
+        conn.execute("BEGIN")
+        log = conn.execute(f"SELECT seq, tbl, pk FROM {CHANGELOG_TABLE} ORDER BY seq LIMIT ?", (batch,)).fetchall()
+        if not log:
+            conn.execute("COMMIT")
+            return {}
+        last_seq = log[-1][0]
+        changed, counts = {}, {}
+        for _seq, table, pk in log:
+            changed.setdefault(table, {})[tuple(json.loads(pk))] = None
+            counts[table] = counts.get(table, 0) + 1
+        upserts, deletes = [], []
+        for table in [t for t in IMPORT_ORDER if t in changed and t not in skip]:
+            keys = cdc_key_columns(schema, table)
+            key_list = list(changed[table])
+            rows = fetch_rows_by_key(conn, table, keys, key_list, batch)
+            positions = [TABLE_COLUMNS[table].index(k) for k in keys]
+            found = {tuple(row[i] for i in positions) for row in rows}
+            upsert, delete = sync_statements(
+                schema, table, keys, rows, [k for k in key_list if k not in found], compact
+            )
+            if upsert:
+                upserts.append(upsert)
+            if delete:
+                deletes.append(delete)
+        conn.execute("COMMIT")
+        before, after = [], []
+        if "site_visits" in changed and has_visit_rollups(schema):
+            before, after = rollup_sync_statements([k[0] for k in changed["site_visits"]], visitors=rollup)
+        # Deletes go first (children before parents) so a row re-created under
+        # the same unique key does not collide with its deleted predecessor;
+        # then parents are upserted before children. The multi-statement query
+        # runs as a single transaction.
+        db.execute(";\n".join(before + deletes[::-1] + upserts + after))
+        conn.execute(f"DELETE FROM {CHANGELOG_TABLE} WHERE seq <= ?", (last_seq,))
+        return counts
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+
+
+def cdc_lag(paths):
+    """(pending changes, seconds since the oldest pending change) over all sources."""
+    pending, oldest = 0, None
+    for path in paths:
+        conn = open_source_db(path)
+        try:
+            if not sqlite_table_exists(conn, CHANGELOG_TABLE):
+                continue
+            n, first = conn.execute(f"SELECT COUNT(*), MIN(changed_at) FROM {CHANGELOG_TABLE}").fetchone()
+        finally:
+            conn.close()
+        pending += n
+        if first is not None:
+            oldest = first if oldest is None else min(oldest, first)
+    return pending, (max(0.0, time.time() - oldest) if oldest is not None else 0.0)
+
+
+def run_sync(
+    db,
+    schema,
+    db_paths,
+    batch: int,
+    interval: float,
+    once: bool,
+    status_path: Path,
+    metrics: Metrics,
+    compact: bool = False,
+    rollup: bool = False,
+):
+    """Apply captured changes until interrupted (or, with `once`, until the
+    changelogs are empty), reporting replication lag after every round.
+
+    With `rollup` the target was loaded by --rollup-visits: unique_visitors
+    is re-derived from the visit rollups instead of mirrored by id (see
+    sync_batch)."""
+    missing = [name for name, path in db_paths.items() if not _has_changelog(path)]
+    if missing:
+        raise RuntimeError(f"no changelog in {', '.join(missing)}; run cdc-install first")
+    failures = {name: 0 for name in db_paths}
+    applied_total, caught_up, last_report = 0, None, 0.0
+    while True:
+        started = time.perf_counter()
+        applied = {}
+        for name, path in db_paths.items():
+            try:
+                counts = sync_batch(db, schema, path, batch, compact, rollup)
+            except Exception as exc:
+                failures[name] += 1
+                if failures[name] >= SYNC_MAX_FAILURES:
+                    raise RuntimeError(f"sync of {name} failed {failures[name]} times in a row: {exc}") from exc
+                print(f"[sync] {name}: batch failed ({exc}), retrying")
+                continue
+            failures[name] = 0
+            for table, n in counts.items():
+                applied[table] = applied.get(table, 0) + n
+        seconds = time.perf_counter() - started
+        pending, lag = cdc_lag(db_paths.values())
+        n = sum(applied.values())
+        applied_total += n
+        metrics.record("sync", None, seconds, rows=n, pending=pending, lag_seconds=round(lag, 3))
+        status = {
+            "ts": round(time.time(), 3),
+            "pending": pending,
+            "lag_seconds": round(lag, 3),
+            "applied_total": applied_total,
+        }
+        status_path.parent.mkdir(parents=True, exist_ok=True)
+        status_path.write_text(json.dumps(status), encoding="utf-8")
+        if n or time.monotonic() - last_report >= 10:
+            detail = ", ".join(f"{t} {c}" for t, c in applied.items())
+            print(
+                f"[sync] applied {n} change(s) in {seconds * 1000:.0f} ms{f' ({detail})' if detail else ''}; "
+                f"pending {pending}, lag {lag:.1f}s"
+            )
+            last_report = time.monotonic()
+        if pending == 0 and caught_up is not True:
+            # New rows arrived with ids past the sequences; keep them valid for cutover.
+            reset_sequences(db, schema, {})
+            print("[sync] caught up (lag 0); once the app has stopped writing and lag stays at 0, switch DATABASE_URL")
+        caught_up = pending == 0
+        if once and pending == 0:
+            return applied_total
+        if pending == 0 or not n:
+            time.sleep(interval)
+
+
+def _has_changelog(path: Path) -> bool:
+    conn = open_source_db(path)
+    try:
+        return sqlite_table_exists(conn, CHANGELOG_TABLE)
+    finally:
+        conn.close()
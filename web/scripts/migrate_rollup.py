@@ -0,0 +1,267 @@
+"""The --rollup-visits load of migrate-sqlite-to-postgres.py.
+
+The daily rollups of site_visits (migrations/012) are kept current by the app
+and read by analytics, so --rollup-visits can leave old raw visits out of the
+target and archive them instead.
+"""
+
+import csv
+import functools
+import gzip
+import itertools
+from collections import Counter
+from datetime import date, datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from migrate_sqlite_to_postgres import (
+    ROLLUP_TABLES,
+    TABLE_COLUMNS,
+    VISIT_TABLES,
+    copy_into,
+    copy_plan,
+    encode_copy_rows,
+    has_integer_id,
+    iter_slice_rows,
+    open_source_db,
+    quote_ident,
+    sql_literal,
+    sqlite_chunk_key,
+    sqlite_table_exists,
+)
+
+
+def has_visit_rollups(schema) -> bool:
+    return all(schema["columns"].get(t) for t in ROLLUP_TABLES)
+
+
+def refresh_visit_rollups(db, after_id=None):
+    """Bring the rollups up to date after site_visits was loaded, in one
+    transaction: rebuilt from the whole table when it was loaded from scratch
+    (`after_id` None), otherwise only the rows with id > `after_id` are added
+    to the counts of their days, so earlier days are never re-read."""
+    where = "" if after_id is None else f" WHERE id > {int(after_id)}"
+    statements = ["BEGIN"]
+    if after_id is None:
+        statements.append(f"TRUNCATE TABLE {', '.join(ROLLUP_TABLES)}")
+    statements += [
+        "INSERT INTO site_visit_daily_pages (day, page_url, visits) "
+        f"SELECT created_at::date, page_url, COUNT(*) FROM site_visits{where} GROUP BY 1, 2 "
+        "ON CONFLICT (day, page_url) DO UPDATE SET visits = site_visit_daily_pages.visits + EXCLUDED.visits",
+        "INSERT INTO site_visit_daily_visitors (day, visitor_id, visits, last_visit) "
+        f"SELECT created_at::date, visitor_id, COUNT(*), MAX(created_at) FROM site_visits{where} GROUP BY 1, 2 "
+        "ON CONFLICT (day, visitor_id) DO UPDATE SET visits = site_visit_daily_visitors.visits + EXCLUDED.visits, "
+        "last_visit = GREATEST(site_visit_daily_visitors.last_visit, EXCLUDED.last_visit)",
+        "COMMIT",
+    ]
+    db.execute(";\n".join(statements))
+
+
+def rollup_sync_statements(ids, visitors: bool = False):
+    """Statements to run before and after a sync batch's deletes and upserts
+    of these site_visits ids: they recompute the rollup rows of the days
+    those rows had before or have after the batch (days older than the
+    oldest raw visit are archived history and kept) and, with `visitors`,
+    re-derive the unique_visitors rows of their visitors from the rollups."""
+    touched = (
+        "SELECT created_at::date AS day, visitor_id FROM site_visits WHERE id IN "
+        f"({', '.join(sql_literal(i) for i in ids)})"
+    )
+    days = (
+        "(SELECT DISTINCT day FROM _sync_visits WHERE day >= (SELECT MIN(created_at)::date FROM site_visits)) d "
+        "JOIN site_visits v ON v.created_at >= d.day AND v.created_at < d.day + 1"
+    )
+    recent = "IN (SELECT day FROM _sync_visits WHERE day >= (SELECT MIN(created_at)::date FROM site_visits))"
+    before = [f"CREATE TEMP TABLE _sync_visits ON COMMIT DROP AS {touched}"]
+    after = [
+        f"INSERT INTO _sync_visits {touched}",
+        f"DELETE FROM site_visit_daily_pages WHERE day {recent}",
+        "INSERT INTO site_visit_daily_pages (day, page_url, visits) "
+        f"SELECT d.day, v.page_url, COUNT(*) FROM {days} GROUP BY 1, 2",
+        f"DELETE FROM site_visit_daily_visitors WHERE day {recent}",
+        "INSERT INTO site_visit_daily_visitors (day, visitor_id, visits, last_visit) "
+        f"SELECT d.day, v.visitor_id, COUNT(*), MAX(v.created_at) FROM {days} GROUP BY 1, 2",
+    ]
+    if visitors:
+        after.append(
+            "INSERT INTO unique_visitors (visitor_id, last_visit, visit_count) "
+            "SELECT visitor_id, MAX(last_visit), SUM(visits) FROM site_visit_daily_visitors "
+            "WHERE visitor_id IN (SELECT visitor_id FROM _sync_visits) GROUP BY visitor_id "
+            "ON CONFLICT (visitor_id) DO UPDATE SET "
+            "last_visit = EXCLUDED.last_visit, visit_count = EXCLUDED.visit_count"
+        )
+    return before, after
+
+
+@functools.lru_cache(maxsize=65536)
+def _visit_day(minute: str, tz_name: str) -> str:
+    # Normalized visit timestamps are UTC ISO strings; every zone offset is a
+    # whole number of minutes, so the minute prefix decides the local day.
+    return datetime.fromisoformat(minute + "+00:00").astimezone(ZoneInfo(tz_name)).date().isoformat()
+
+
+def _count_visit(counts: dict, key, created_at: str):
+    seen = counts.get(key)
+    if seen is None:
+        counts[key] = [1, created_at]
+        return
+    seen[0] += 1
+    # Same-format UTC ISO strings sort chronologically.
+    if created_at > seen[1]:
+        seen[1] = created_at
+
+
+def _copy_batches(rows, batch_size: int, indexes=None, converters=()):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, batch_size)):
+        yield encode_copy_rows(batch, indexes, converters)
+
+
+def rollup_site_visits(
+    db,
+    schema,
+    path: Path,
+    immutable: bool,
+    batch_size: int,
+    tz_name: str,
+    cutoff: date = None,
+    archive_dir: Path = None,
+) -> dict:
+    """Rebuild site_visits, unique_visitors and the daily rollups from one
+    streaming pass over the source visits.
+
+    Days are taken in the target's TimeZone, like created_at::date there.
+    Visits on days before `cutoff` go to one gzipped CSV per month under
+    `archive_dir` instead of being loaded, but still count towards the
+    rollups and unique_visitors, whose ids follow first-visit order. The
+    counters are held in memory: one entry per (day, page), (day, visitor)
+    and visitor, however many visits there are."""
+    missing = [t for t in VISIT_TABLES + ROLLUP_TABLES if not schema["columns"].get(t)]
+    if missing:
+        raise RuntimeError(
+            f"--rollup-visits needs {', '.join(missing)} on the target; "
+            "apply migrations/012_add_site_visit_rollups.sql first"
+        )
+    limit = cutoff.isoformat() if cutoff else None
+    pages, day_visitors, visitors = Counter(), {}, {}
+    archives = {}
+    result = {"visits": 0, "loaded": 0, "archived": 0, "bytes": 0, "archives": []}
+    cols, indexes, converters = copy_plan(schema, "site_visits")
+
+    def kept_chunks(conn):
+        key = sqlite_chunk_key(conn, "site_visits", has_integer_id(schema, "site_visits"))
+        for rows, _first, _last, _left in iter_slice_rows(conn, "site_visits", batch_size, (), (), key, None, None):
+            keep = []
+            for row in rows:
+                visitor_id, page_url, created_at = row[1], row[2], row[5]
+                day = _visit_day(created_at[:16], tz_name)
+                pages[(day, page_url)] += 1
+                if visitor_id is not None:
+                    _count_visit(day_visitors, (day, visitor_id), created_at)
+                    _count_visit(visitors, visitor_id, created_at)
+                if limit is None or day >= limit:
+                    keep.append(row)
+                    continue
+                month = day[:7]
+                if month not in archives:
+                    partial = archive_dir / f"site_visits-{month}.csv.gz.partial"
+                    out = gzip.open(partial, "wt", encoding="utf-8", newline="")
+                    archives[month] = (partial, out, csv.writer(out))
+                    archives[month][2].writerow(TABLE_COLUMNS["site_visits"])
+                archives[month][2].writerow(row)
+            result["visits"] += len(rows)
+            result["archived"] += len(rows) - len(keep)
+            if keep:
+                result["loaded"] += len(keep)
+                payload = encode_copy_rows(keep, indexes, converters)
+                result["bytes"] += len(payload)
+                yield payload
+
+    if limit is not None:
+        archive_dir.mkdir(parents=True, exist_ok=True)
+    conn = open_source_db(path, immutable)
+    try:
+        with db.session() as sess:
+            sess.execute(
+                f"TRUNCATE TABLE {', '.join(quote_ident(t) for t in VISIT_TABLES + ROLLUP_TABLES)} RESTART IDENTITY"
+            )
+            copy_into(sess, schema, "site_visits", cols, kept_chunks(conn))
+            # Files are only renamed into place once every row made it in.
+            for partial, out, _writer in archives.values():
+                out.close()
+            for partial, _out, _writer in archives.values():
+                final = partial.with_suffix("")
+                partial.replace(final)
+                result["archives"].append(final)
+            copy_into(
+                sess,
+                schema,
+                "site_visit_daily_pages",
+                ["day", "page_url", "visits"],
+                _copy_batches(((d, p, n) for (d, p), n in pages.items()), batch_size),
+            )
+            copy_into(
+                sess, schema, "site_visit_daily_visitors", ["day", "visitor_id", "visits", "last_visit"],
+                _copy_batches(((d, v, n, last) for (d, v), (n, last) in day_visitors.items()), batch_size),
+            )
+            cols, indexes, converters = copy_plan(schema, "unique_visitors")
+            copy_into(
+                sess,
+                schema,
+                "unique_visitors",
+                cols,
+                _copy_batches(
+                    ((n, v, last, count) for n, (v, (count, last)) in enumerate(visitors.items(), 1)),
+                    batch_size,
+                    indexes,
+                    converters,
+                ),
+            )
+        result["source_visitors"] = (
+            conn.execute("SELECT COUNT(*) FROM unique_visitors").fetchone()[0]
+            if sqlite_table_exists(conn, "unique_visitors")
+            else 0
+        )
+    finally:
+        conn.close()
+        for partial, out, _writer in archives.values():
+            out.close()
+            partial.unlink(missing_ok=True)
+    result.update(pages=len(pages), day_visitors=len(day_visitors), visitors=len(visitors))
+    return result
+
+
+def verify_visit_rollups(db, path: Path) -> dict:
+    """Totals check for a --rollup-visits target, whose site_visits may lack
+    archived rows: every source visit is counted once in the page rollups and
+    every source visitor has a unique_visitors row."""
+    conn = open_source_db(path)
+    try:
+        if sqlite_table_exists(conn, "site_visits"):
+            visits, visitors = conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT NULLIF(visitor_id, '')) FROM site_visits"
+            ).fetchone()
+        else:
+            visits = visitors = 0
+    finally:
+        conn.close()
+    target_visits, target_visitors = db.query(
+        "SELECT (SELECT COALESCE(SUM(visits), 0) FROM site_visit_daily_pages), (SELECT COUNT(*) FROM unique_visitors)"
+    )[0]
+    results = {}
+    for table, source, target in (
+        ("site_visit_daily_pages", visits, int(target_visits)),
+        ("unique_visitors", visitors, int(target_visitors)),
+    ):
+        results[table] = {
+            "ok": source == target,
+            "source_rows": source,
+            "target_rows": target,
+            "buckets": 0,
+            "mismatched": [],
+        }
+        print(
+            f"[verify] {table}: {'ok' if source == target else 'MISMATCH'} "
+            f"(rollup totals: source {source}, target {target})"
+        )
+    return results
@@ -0,0 +1,317 @@
+"""The verify command of migrate-sqlite-to-postgres.py.
+
+Both sides reduce every row to the same canonical text, hash it and sum the
+hashes per bucket, so the comparison is order-independent and only bucket
+aggregates ever leave Postgres.
+"""
+
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal
+from pathlib import Path
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from migrate_sqlite_to_postgres import (
+    Metrics,
+    _export_conn,
+    _parse_pg_datetime,
+    _timed,
+    copy_plan,
+    has_integer_id,
+    iter_slice_rows,
+    json_columns,
+    keyset_slices,
+    open_source_db,
+    quote_ident,
+    sqlite_chunk_key,
+    sqlite_table_exists,
+)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_FLOAT_QUANTUM = Decimal("0.000001")
+_JSONB_ESCAPES = {'"': '\\"', "\\": "\\\\", "\b": "\\b", "\f": "\\f", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_BOOL_TEXT = {v: "t" for v in ("t", "true", "1", "y", "yes", "on")} | {
+    v: "f" for v in ("f", "false", "0", "n", "no", "off")
+}
+
+
+def digest_kind(pg_type: str) -> str:
+    if pg_type in ("smallint", "integer", "bigint"):
+        return "int"
+    if pg_type in ("real", "double precision", "numeric"):
+        return "float"
+    if pg_type == "boolean":
+        return "bool"
+    if pg_type == "timestamp with time zone":
+        return "timestamptz"
+    if pg_type == "timestamp without time zone":
+        return "timestamp"
+    if pg_type == "jsonb":
+        return "jsonb"
+    return "text"
+
+
+def pg_canonical_sql(column: str, kind: str) -> str:
+    c = quote_ident(column)
+    if kind == "int":
+        expr = f"{c}::text"
+    elif kind == "float":
+        expr = f"round({c}::numeric, 6)::text"
+    elif kind == "bool":
+        expr = f"CASE WHEN {c} THEN 't' WHEN NOT {c} THEN 'f' END"
+    elif kind in ("timestamptz", "timestamp"):
+        expr = f"(extract(epoch FROM {c}) * 1000000)::bigint::text"
+    else:
+        expr = f"{c}::text"
+    return f"coalesce({expr}, '\\N')"
+
+
+def _jsonb_string(s: str) -> str:
+    out = []
+    for ch in s:
+        if ch in _JSONB_ESCAPES:
+            out.append(_JSONB_ESCAPES[ch])
+        elif ch < " ":
+            out.append(f"\\u{ord(ch):04x}")
+        else:
+            out.append(ch)
+    return '"' + "".join(out) + '"'
+
+
+def _jsonb_text(value) -> str:
+    """A parsed JSON value (numbers as Decimal) printed the way jsonb::text
+    prints it: keys deduplicated and ordered by byte length, then bytes."""
+    if isinstance(value, dict):
+        keys = sorted(value, key=lambda k: (len(k.encode("utf-8")), k.encode("utf-8")))
+        return "{" + ", ".join(f"{_jsonb_string(k)}: {_jsonb_text(value[k])}" for k in keys) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(_jsonb_text(v) for v in value) + "]"
+    if isinstance(value, str):
+        return _jsonb_string(value)
+    if value is None or isinstance(value, bool):
+        return {None: "null", True: "true", False: "false"}[value]
+    text = format(value, "f")
+    return text.lstrip("-") if not value else text
+
+
+def canonical_value(value, kind: str, tz) -> str:
+    """The text pg_canonical_sql produces for `value` once Postgres has stored it."""
+    if value is None:
+        return r"\N"
+    if kind == "int":
+        try:
+            return str(int(value))
+        except (TypeError, ValueError):
+            return str(value)
+    if kind == "float":
+        try:
+            # float8 -> numeric keeps 15 significant digits, then round(.., 6)
+            d = Decimal(f"{float(value):.15g}").quantize(_FLOAT_QUANTUM, ROUND_HALF_UP)
+        except (TypeError, ValueError, ArithmeticError):
+            return str(value)
+        return str(d if d else abs(d))
+    if kind == "bool":
+        return _BOOL_TEXT.get(str(value).strip().lower(), str(value))
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", errors="replace")
+    if kind == "jsonb":
+        try:
+            return _jsonb_text(json.loads(value, parse_float=Decimal, parse_int=Decimal))
+        except ValueError:
+            return str(value)
+    if kind in ("timestamptz", "timestamp"):
+        text = str(value).strip()
+        try:
+            # Same parsing as the binary encoder: ISO text or one of TIMESTAMP_FORMATS.
+            dt = _parse_pg_datetime(text)
+        except ValueError:
+            return text
+        if kind == "timestamp":
+            dt = dt.replace(tzinfo=timezone.utc)
+        elif dt.tzinfo is None:
+            dt = dt.replace(tzinfo=tz)
+        return str((dt - EPOCH) // timedelta(microseconds=1))
+    return str(value)
+
+
+def digest_plan(schema, table: str, compact: bool = False):
+    """What the digests of `table` are built from: the imported columns with
+    their converters and canonical kinds, and the primary key positions.
+    Rows are bucketed by id range for an integer key, else by key hash. With
+    `compact` the source side compacts JSON columns the way the import did."""
+    cols, indexes, converters = copy_plan(schema, table)
+    types = {c["name"]: c["type"] for c in schema["columns"][table]}
+    kinds = [digest_kind(types[c]) for c in cols]
+    key = [cols.index(c["name"]) for c in schema["columns"][table] if c["primary_key"] and c["name"] in cols]
+    return {
+        "cols": cols,
+        "indexes": indexes,
+        "converters": converters,
+        "kinds": kinds,
+        "key": key,
+        "ranged": len(key) == 1 and kinds[key[0]] == "int",
+        "compact": json_columns(table) if compact else [],
+    }
+
+
+def pg_digest_sql(table: str, plan, bucket_rows: int) -> str:
+    fields = [pg_canonical_sql(c, k) for c, k in zip(plan["cols"], plan["kinds"])]
+    if plan["ranged"]:
+        bucket = f"floor({quote_ident(plan['cols'][plan['key'][0]])}::numeric / {bucket_rows})::bigint"
+    elif plan["key"]:
+        bucket = f"('x' || left(md5(concat_ws(E'\\x1f', {', '.join(fields[i] for i in plan['key'])})), 2))::bit(8)::int"
+    else:
+        bucket = "0"
+    return (
+        f"SELECT b::text, count(*)::text, sum(h)::text FROM ("
+        f"SELECT {bucket} AS b, ('x' || left(md5(concat_ws(E'\\x1f', {', '.join(fields)})), 8))::bit(32)::bigint AS h "
+        f"FROM {quote_ident(table)}) d GROUP BY b"
+    )
+
+
+def digest_slice(path: Path, table: str, key, lower, upper, batch_size: int, plan, bucket_rows: int, tz_name: str):
+    """Per-bucket [rows, hash sum] of the source rows with lower < key <= upper,
+    built the way pg_digest_sql builds them on the target."""
+    conn = _export_conn(path, False)
+    tz = ZoneInfo(tz_name)
+    indexes, converters, kinds, key_pos = plan["indexes"], dict(plan["converters"]), plan["kinds"], plan["key"]
+    buckets = {}
+    for rows, _first, _last, _left_out in iter_slice_rows(
+        conn, table, batch_size, (), (), key, lower, upper, compact=plan["compact"]
+    ):
+        for row in rows:
+            if indexes is not None:
+                row = [row[i] for i in indexes]
+            fields = []
+            for i, value in enumerate(row):
+                if value is not None and i in converters:
+                    value = converters[i](value)
+                fields.append(canonical_value(value, kinds[i], tz))
+            if plan["ranged"]:
+                bucket = int(fields[key_pos[0]]) // bucket_rows
+            elif key_pos:
+                bucket = int(hashlib.md5("\x1f".join(fields[i] for i in key_pos).encode("utf-8")).hexdigest()[:2], 16)
+            else:
+                bucket = 0
+            entry = buckets.setdefault(bucket, [0, 0])
+            entry[0] += 1
+            entry[1] += int(hashlib.md5("\x1f".join(fields).encode("utf-8")).hexdigest()[:8], 16)
+    return buckets
+
+
+def session_timezone(db) -> str:
+    """The target's TimeZone setting; naive source timestamps are read in it."""
+    tz_name = db.query("SELECT current_setting('TimeZone')")[0][0]
+    try:
+        ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError) as exc:
+        raise RuntimeError(f"cannot interpret target TimeZone {tz_name!r}, set PGTZ to an IANA zone name") from exc
+    return tz_name
+
+
+def verify_target(
+    db,
+    schema,
+    sources,
+    tables,
+    exporter,
+    workers: int,
+    batch_size: int,
+    slice_rows: int,
+    bucket_rows: int,
+    metrics: Metrics = None,
+    compact_json: bool = False,
+):
+    """Compare per-bucket digests of every table on both sides; the Postgres
+    aggregates and the source slices are computed concurrently."""
+    tz_name = session_timezone(db)
+
+    plans = {t: digest_plan(schema, t, compact_json) for t in tables}
+    target_side, source_side = {}, {t: [] for t in tables}
+    with ThreadPoolExecutor(max_workers=workers) as pg:
+        for table in tables:
+            target_side[table] = pg.submit(_timed, db.query, pg_digest_sql(table, plans[table], bucket_rows))
+        for table in tables:
+            conn = open_source_db(sources[table])
+            try:
+                if not sqlite_table_exists(conn, table):
+                    continue
+                key = sqlite_chunk_key(conn, table, has_integer_id(schema, table))
+                bounds = keyset_slices(conn, table, slice_rows, key=key) if key else [(None, None)]
+                for lower, upper in bounds:
+                    source_side[table].append(
+                        exporter.submit(
+                            _timed,
+                            digest_slice,
+                            sources[table],
+                            table,
+                            key,
+                            lower,
+                            upper,
+                            batch_size,
+                            plans[table],
+                            bucket_rows,
+                            tz_name,
+                        )
+                    )
+            finally:
+                conn.close()
+
+        metrics = metrics or Metrics()
+        results = {}
+        for table in tables:
+            source = {}
+            source_seconds, source_peak = 0.0, None
+            for fut in source_side[table]:
+                seconds, peak, buckets = fut.result()
+                source_seconds += seconds
+                source_peak = max(source_peak or 0, peak or 0) or None
+                for bucket, (rows, digest) in buckets.items():
+                    entry = source.setdefault(bucket, [0, 0])
+                    entry[0] += rows
+                    entry[1] += digest
+            target_seconds, _peak, target_rows = target_side[table].result()
+            target = {int(b): [int(rows), int(digest)] for b, rows, digest in target_rows}
+            mismatched = []
+            for bucket in sorted(source.keys() | target.keys()):
+                if source.get(bucket) != target.get(bucket):
+                    item = {
+                        "bucket": bucket,
+                        "source": source.get(bucket, [0, 0]),
+                        "target": target.get(bucket, [0, 0]),
+                    }
+                    if plans[table]["ranged"]:
+                        item["ids"] = [bucket * bucket_rows, (bucket + 1) * bucket_rows - 1]
+                    mismatched.append(item)
+            results[table] = {
+                "ok": not mismatched,
+                "source_rows": sum(rows for rows, _d in source.values()),
+                "target_rows": sum(rows for rows, _d in target.values()),
+                "buckets": len(source.keys() | target.keys()),
+                "mismatched": mismatched,
+            }
+            r = results[table]
+            metrics.record(
+                "verify_source",
+                table,
+                source_seconds,
+                rows=r["source_rows"],
+                slices=len(source_side[table]),
+                peak_rss_kb=source_peak,
+            )
+            metrics.record("verify_target", table, target_seconds, rows=r["target_rows"])
+            if r["ok"]:
+                print(f"[verify] {table}: ok ({r['source_rows']} rows, {r['buckets']} buckets)")
+            else:
+                where = ", ".join(
+                    f"ids {m['ids'][0]}-{m['ids'][1]}" if "ids" in m else f"key hash {m['bucket']:02x}"
+                    for m in mismatched[:5]
+                )
+                more = f" (+{len(mismatched) - 5} more)" if len(mismatched) > 5 else ""
+                print(
+                    f"[verify] {table}: MISMATCH in {len(mismatched)} bucket(s): {where}{more} "
+                    f"(source {r['source_rows']} rows, target {r['target_rows']})"
+                )
+    return results
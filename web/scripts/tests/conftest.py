@@ -0,0 +1,49 @@
+import importlib
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parent.parent / "migrate-sqlite-to-postgres.py"
+TOOLS_DIR = Path(__file__).resolve().parents[3] / "tools"
+
+# The script imports its command modules as top-level modules, the way it runs from scripts/.
+sys.path.insert(0, str(SCRIPT.parent))
+
+
+@pytest.fixture(scope="session")
+def migrate():
+    """The migration script loaded as a module (its file name is not importable)."""
+    spec = importlib.util.spec_from_file_location("migrate_sqlite_to_postgres", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def cdc(migrate):
+    """migrate_cdc.py, which imports its helpers from the loaded script."""
+    return importlib.import_module("migrate_cdc")
+
+
+@pytest.fixture(scope="session")
+def verify(migrate):
+    """migrate_verify.py, which imports its helpers from the loaded script."""
+    return importlib.import_module("migrate_verify")
+
+
+@pytest.fixture(scope="session")
+def rollup(migrate):
+    """migrate_rollup.py, which imports its helpers from the loaded script."""
+    return importlib.import_module("migrate_rollup")
+
+
+@pytest.fixture(scope="session")
+def migration_metrics():
+    """tools/migration_metrics.py, whose record format the script's local recorder copies."""
+    spec = importlib.util.spec_from_file_location("migration_metrics", TOOLS_DIR / "migration_metrics.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,51 @@
+import sqlite3
+
+
+class SqliteTarget:
+    """Stands in for PgPool: runs the multi-statement sync SQL on SQLite."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.executescript(sql)
+
+
+def test_sync_deletes_before_reinserting_same_unique_key(tmp_path, migrate, cdc):
+    cols = migrate.TABLE_COLUMNS["likes"]
+    schema = {
+        "columns": {
+            "likes": [
+                {
+                    "name": c,
+                    "type": "bigint" if c in ("id", "post_id") else "text",
+                    "primary_key": c == "id",
+                    "sequence": None,
+                }
+                for c in cols
+            ]
+        },
+        "foreign_keys": [],
+    }
+    source = sqlite3.connect(str(tmp_path / "blog.db"))
+    source.execute("CREATE TABLE likes (id INTEGER PRIMARY KEY, post_id INTEGER, username TEXT, created_at TEXT)")
+    source.execute("INSERT INTO likes VALUES (1, 7, 'alice', '2024-01-01 00:00:00')")
+    source.commit()
+    target = sqlite3.connect(":memory:")
+    target.execute(
+        "CREATE TABLE likes (id INTEGER PRIMARY KEY, post_id INTEGER, username TEXT, created_at TEXT, "
+        "UNIQUE (post_id, username))"
+    )
+    target.execute("INSERT INTO likes VALUES (1, 7, 'alice', '2024-01-01 00:00:00')")
+    source.close()
+    cdc.install_cdc(tmp_path / "blog.db", ["likes"], schema)
+
+    source = sqlite3.connect(str(tmp_path / "blog.db"))
+    source.execute("DELETE FROM likes WHERE id = 1")
+    source.execute("INSERT INTO likes VALUES (2, 7, 'alice', '2024-01-02 00:00:00')")
+    source.commit()
+    source.close()
+
+    counts = cdc.sync_batch(SqliteTarget(target), schema, tmp_path / "blog.db", 100)
+    assert counts == {"likes": 2}
+    assert target.execute("SELECT id, post_id, username FROM likes").fetchall() == [(2, 7, "alice")]
@@ -0,0 +1,52 @@
+class StatementLog:
+    """Stands in for PgPool: records the SQL refresh_visit_rollups sends."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql):
+        self.statements += sql.split(";\n")
+
+
+def test_refresh_rebuilds_from_scratch_only_without_after_id(rollup):
+    full = StatementLog()
+    rollup.refresh_visit_rollups(full)
+    assert full.statements[0] == "BEGIN" and full.statements[-1] == "COMMIT"
+    assert full.statements[1] == "TRUNCATE TABLE site_visit_daily_pages, site_visit_daily_visitors"
+    assert all("WHERE id >" not in s for s in full.statements)
+
+    incremental = StatementLog()
+    rollup.refresh_visit_rollups(incremental, after_id="41")
+    assert not any(s.startswith("TRUNCATE") for s in incremental.statements)
+    inserts = [s for s in incremental.statements if s.startswith("INSERT")]
+    assert len(inserts) == 2
+    # New rows add to the counts already stored for their days.
+    for sql in inserts:
+        assert "FROM site_visits WHERE id > 41 GROUP BY 1, 2" in sql
+        assert ".visits + EXCLUDED.visits" in sql
+
+
+def test_sync_statements_recompute_touched_days(rollup):
+    before, after = rollup.rollup_sync_statements([3, 7])
+    touched = "SELECT created_at::date AS day, visitor_id FROM site_visits WHERE id IN ('3', '7')"
+    # The days the rows had before the batch are captured, and those they have after are added.
+    assert before == [f"CREATE TEMP TABLE _sync_visits ON COMMIT DROP AS {touched}"]
+    assert after[0] == f"INSERT INTO _sync_visits {touched}"
+    deletes = [s for s in after if s.startswith("DELETE")]
+    assert [s.split()[2] for s in deletes] == ["site_visit_daily_pages", "site_visit_daily_visitors"]
+    # Archived days, older than the oldest raw visit, keep their rollups.
+    assert all("day >= (SELECT MIN(created_at)::date FROM site_visits)" in s for s in deletes)
+    assert not any("unique_visitors" in s for s in after)
+
+    _before, after = rollup.rollup_sync_statements([3], visitors=True)
+    assert after[-1].startswith("INSERT INTO unique_visitors")
+    assert "WHERE visitor_id IN (SELECT visitor_id FROM _sync_visits)" in after[-1]
+
+
+def test_visit_day_follows_target_time_zone(rollup):
+    assert rollup._visit_day("2024-03-01T23:30", "UTC") == "2024-03-01"
+    assert rollup._visit_day("2024-03-01T23:30", "Asia/Tokyo") == "2024-03-02"
+    assert rollup._visit_day("2024-03-01T03:30", "America/New_York") == "2024-02-29"
+    # Zones with a half-hour offset still split the day on the minute.
+    assert rollup._visit_day("2024-03-01T18:29", "Asia/Kolkata") == "2024-03-01"
+    assert rollup._visit_day("2024-03-01T18:30", "Asia/Kolkata") == "2024-03-02"
@@ -0,0 +1,484 @@
+import json
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pytest
+
+
+def make_table(path, migrate, table, rows):
+    conn = sqlite3.connect(str(path))
+    cols = migrate.TABLE_COLUMNS[table]
+    conn.execute(
+        f"CREATE TABLE {table} ({', '.join(c + (' INTEGER PRIMARY KEY' if c == 'id' else ' TEXT') for c in cols)})"
+    )
+    conn.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", rows)
+    conn.commit()
+    return conn
+
+
+def video_task(migrate, id_, **values):
+    return tuple(values.get(c, f"{c}-{id_}" if c != "id" else id_) for c in migrate.TABLE_COLUMNS["video_tasks"])
+
+
+def test_oversized_mask_survives_null_columns(tmp_path, migrate):
+    big = "x" * 200
+    conn = make_table(tmp_path / "studio.db", migrate, "video_tasks", [
+        video_task(migrate, 1, result_json=big, error=None),
+        video_task(migrate, 2, result_json=big, error="boom"),
+        video_task(migrate, 3, result_json=None, error=None),
+    ])
+    cols = ["result_json", "error", "failure_reason"]
+    pos = migrate.TABLE_COLUMNS["video_tasks"].index("result_json")
+    batches = list(migrate.iter_slice_rows(conn, "video_tasks", 10, (), (), "id", None, None, oversized=(cols, 100)))
+    (rows, _first, _last, left_out), = batches
+    assert rows[0][pos] is None and rows[1][pos] is None
+    assert left_out == {0: (1, [pos]), 1: (2, [pos])}
+
+
+JSON_CASES = [
+    '{"a": 1, "b": [true, false, null, -0.5e+10, 0, 12.25E-3]}',
+    ' [ ] ',
+    '{}',
+    '{"k": "v \\" \\\\ \\/ \\b\\f\\n\\r\\t \\u00e9"}',
+    '[{"a": {"b": [[], {}]}}]',
+    '{"a": nul}',
+    '{"k":"v",}',
+    '[1,]',
+    '[,1]',
+    '{"a" 1}',
+    '{"a": tru e}',
+    '{"a": 1 2}',
+    '{"a":1,,"b":2}',
+    '{1: 2}',
+    '["a" "b"]',
+    '[01]',
+    '[1.]',
+    '[.5]',
+    '[+1]',
+    '[NaN]',
+    '["\\x"]',
+    '["\\u12g4"]',
+    '["a\nb"]',
+    '{"a": 1}{}',
+    '"str"',
+    '1',
+    '[}',
+    '{]',
+    '[1',
+    '["open',
+    '',
+]
+
+
+def well_formed(text):
+    import json
+
+    def reject(_constant):
+        raise ValueError(_constant)
+
+    try:
+        return isinstance(json.loads(text, parse_constant=reject), (dict, list))
+    except ValueError:
+        return False
+
+
+def test_compact_json_accepts_exactly_well_formed_containers(migrate):
+    import json
+
+    for text in JSON_CASES:
+        compacted = migrate.compact_json(text)
+        assert (compacted is not None) == well_formed(text), text
+        if compacted is not None:
+            assert json.loads(compacted) == json.loads(text)
+            assert migrate.compact_json(compacted) == compacted
+
+
+def test_json_minifier_is_independent_of_piece_boundaries(migrate):
+    for text in JSON_CASES:
+        whole = migrate.JsonMinifier()
+        expected = whole.feed(text), whole.finish()
+        pieces = migrate.JsonMinifier()
+        out = "".join(pieces.feed(c) for c in text)
+        assert (out, pieces.finish()) == expected, text
+
+
+def test_metrics_match_tools_migration_metrics(tmp_path, migrate, migration_metrics):
+    def run(metrics):
+        with metrics.span("copy", "posts", rows=3) as span:
+            span["bytes"] = 10
+        metrics.record("export", None, 1.5, rows=2, peak_rss_kb=1)
+        metrics.close()
+
+    out = {}
+    for fmt in migration_metrics.FORMATS:
+        local, shared = tmp_path / f"local.{fmt}", tmp_path / f"shared.{fmt}"
+        run(migrate.Metrics(local, fmt))
+        run(migration_metrics.Metrics("migrate-sqlite-to-postgres", shared, fmt))
+        out[fmt] = [p.read_text(encoding="utf-8").splitlines() for p in (local, shared)]
+
+    # Timings and peak memory differ between runs; keys, labels and counts must not.
+    def records(lines):
+        return [
+            {k: v for k, v in json.loads(line).items() if k not in ("ts", "seconds", "peak_rss_kb")} for line in lines
+        ]
+
+    def samples(lines):
+        return [line if "_seconds" not in line and "peak_rss" not in line else line.rsplit(" ", 1)[0] for line in lines]
+
+    assert records(out["jsonl"][0]) == records(out["jsonl"][1])
+    assert samples(out["openmetrics"][0]) == samples(out["openmetrics"][1])
+
+
+class RecordingSession:
+    """Stands in for a pooled session: records statements instead of running them."""
+
+    def __init__(self):
+        self.executed = []
+        self.copies = []
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def copy_in(self, sql, chunks, before=None, after=None):
+        self.copies.append((before, sql, b"".join(chunks), after))
+
+
+def test_upsert_stages_through_a_temp_table_in_the_copy_transaction(migrate):
+    schema = {"columns": {"likes": [{"name": c, "primary_key": c == "id"} for c in migrate.TABLE_COLUMNS["likes"]]}}
+    sess = RecordingSession()
+    migrate.copy_into(sess, schema, "likes", ["id", "username"], [b"1\talice\n"], upsert=True)
+    assert sess.executed == []
+    (before, copy, data, after), = sess.copies
+    assert before == 'CREATE TEMP TABLE "_migrate_stage_likes" (LIKE "likes" INCLUDING DEFAULTS) ON COMMIT DROP'
+    assert copy == 'COPY "_migrate_stage_likes" ("id", "username") FROM STDIN' and data == b"1\talice\n"
+    assert after.startswith(
+        'INSERT INTO "likes" ("id", "username") SELECT "id", "username" FROM "_migrate_stage_likes"'
+    )
+    assert after.endswith('ON CONFLICT ("id") DO UPDATE SET "username" = EXCLUDED."username"')
+
+
+def test_snapshot_warns_about_rollback_journal_sources(tmp_path, migrate, capsys):
+    paths = []
+    for name, mode in (("blog.db", "WAL"), ("users.db", "DELETE")):
+        conn = make_table(tmp_path / name, migrate, "likes", [(1, 7, "alice", "2024-01-01 00:00:00")])
+        conn.execute(f"PRAGMA journal_mode = {mode}")
+        conn.close()
+        paths.append(tmp_path / name)
+
+    copies = migrate.snapshot_sources(paths, tmp_path / "snapshot")
+
+    out = capsys.readouterr().out
+    assert "users.db uses journal_mode=delete" in out and "blog.db uses" not in out
+    for path in paths:
+        assert sqlite3.connect(str(copies[path])).execute("SELECT username FROM likes").fetchall() == [("alice",)]
+
+
+def test_timestamp_format_is_detected_from_the_first_value(migrate, monkeypatch):
+    samples = []
+    detect = migrate._detect_timestamp_parser
+    monkeypatch.setattr(migrate, "_detect_timestamp_parser", lambda s: samples.append(s) or detect(s))
+    values = [None, " 2024/01/02 03:04:05 ", "2024-01-02T03:04:05Z", "1704164645"] + [
+        f"2024-01-{d:02} 00:00:00" for d in range(3, 30)
+    ]
+    out = migrate.normalize_timestamps(values)
+    assert samples == ["2024/01/02 03:04:05"]
+    assert out[0] == migrate.RUN_STARTED_AT
+    assert out[1:4] == ["2024-01-02T03:04:05+00:00"] * 3
+
+
+def test_visit_transforms_strip_ids_like_the_csv_import(migrate):
+    visits = migrate.transform_site_visits_rows([(" 7 ", "  v1 ", " /a ", None, "", "2024-01-02 03:04:05")])
+    assert visits == [("7", "v1", "/a", "", "unknown", "2024-01-02T03:04:05+00:00")]
+    visitors = migrate.transform_unique_visitors_rows([(3, "   ", "2024-01-02 03:04:05", " 4 ")])
+    assert visitors == [(3, None, "2024-01-02T03:04:05+00:00", 4)]
+
+
+def test_transformed_tables_never_stream_oversized_values(tmp_path, migrate):
+    schema = {
+        "columns": {
+            t: [{"name": c, "type": "text"} for c in migrate.TABLE_COLUMNS[t]] for t in ("site_visits", "video_tasks")
+        }
+    }
+    assert migrate.oversized_columns(schema, "site_visits", migrate.TABLE_COLUMNS["site_visits"]) == []
+    assert migrate.oversized_columns(schema, "video_tasks", ["id", "result_json"]) == ["id", "result_json"]
+
+    agent = " agent ".ljust(300)
+    conn = make_table(
+        tmp_path / "blog.db", migrate, "site_visits", [(1, " " * 200 + "v1", "/", agent, "", "2024-01-02 03:04:05")]
+    )
+    oversized = (migrate.oversized_columns(schema, "site_visits", migrate.TABLE_COLUMNS["site_visits"]), 100)
+    ((rows, _first, _last, left_out),) = migrate.iter_slice_rows(
+        conn, "site_visits", 10, (), (), "id", None, None, oversized=oversized
+    )
+    assert left_out == {} and rows[0][1:4] == ("v1", "/", "agent")
+
+
+def test_import_waves_follow_foreign_keys(migrate):
+    schema = {
+        "foreign_keys": [
+            ("posts", "users"),
+            ("comments", "posts"),
+            ("comments", "users"),
+            ("comments", "comments"),
+            ("likes", "posts"),
+            ("favorites", "posts"),
+            ("posts", "categories"),
+        ]
+    }
+    tables = ["likes", "comments", "users", "posts", "follows"]
+    deps = migrate.table_dependencies(schema, tables)
+    # Self-references and parents outside the run do not hold a table back.
+    assert deps == {
+        "likes": {"posts"},
+        "comments": {"posts", "users"},
+        "users": set(),
+        "posts": {"users"},
+        "follows": set(),
+    }
+    assert migrate.plan_import_waves(tables, deps) == [["users", "follows"], ["posts"], ["comments", "likes"]]
+
+
+def test_import_waves_fall_back_to_import_order_on_a_cycle(migrate):
+    deps = {"users": set(), "posts": {"comments"}, "comments": {"posts"}, "likes": {"comments"}}
+    assert migrate.plan_import_waves(["likes", "comments", "posts", "users"], deps) == [
+        ["users"],
+        ["posts"],
+        ["comments"],
+        ["likes"],
+    ]
+
+
+class RecordingDb:
+    """Stands in for PgPool: every session is the same RecordingSession."""
+
+    def __init__(self):
+        self.sess = RecordingSession()
+
+    @contextmanager
+    def session(self):
+        yield self.sess
+
+
+def import_table(migrate, tmp_path, table, journal=None, marks=None, db=None, **options):
+    """Run one ImportJob.import_table against RecordingDb; returns its result and the COPYed rows."""
+    columns = [
+        {"name": c, "type": "bigint" if c in ("id", "post_id") else "text", "primary_key": c == "id", "sequence": None}
+        for c in migrate.TABLE_COLUMNS[table]
+    ]
+    schema = {"columns": {table: columns}, "foreign_keys": []}
+    journal = journal or migrate.CheckpointJournal(tmp_path / "checkpoint.json", "run", resume=False)
+    options = migrate.ImportOptions(**{"batch_size": 2, "chunk_rows": 4, **options})
+    db = db or RecordingDb()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        job = migrate.ImportJob(db, schema, {table: tmp_path / "blog.db"}, journal, options, marks=marks, exporter=pool)
+        result = job.import_table(table)
+    rows = [line.split("\t") for _before, _sql, data, _after in db.sess.copies for line in data.decode().splitlines()]
+    return result, rows
+
+
+def test_incremental_runs_copy_only_rows_past_the_high_water_mark(tmp_path, migrate):
+    likes = [(i, 7, f"user{i}", f"2024-01-0{i} 00:00:00") for i in range(1, 6)]
+    make_table(tmp_path / "blog.db", migrate, "likes", likes).close()
+    marks = migrate.HighWaterMarks(tmp_path / "hwm.json", "target-a")
+    result, rows = import_table(migrate, tmp_path, "likes", marks=marks)
+    assert [r[0] for r in rows] == ["1", "2", "3", "4", "5"] and result == "5 (id None -> 5)"
+
+    conn = sqlite3.connect(str(tmp_path / "blog.db"))
+    conn.executemany("INSERT INTO likes VALUES (?, ?, ?, ?)", [(6, 7, "user6", "x"), (7, 7, "user7", "x")])
+    conn.commit()
+    conn.close()
+    # The marks are persisted per target database.
+    marks = migrate.HighWaterMarks(tmp_path / "hwm.json", "target-a")
+    assert marks.get("likes", "id") == 5 and marks.get("likes", "created_at") is None
+    assert migrate.HighWaterMarks(tmp_path / "hwm.json", "target-b").get("likes", "id") is None
+    result, rows = import_table(migrate, tmp_path, "likes", marks=marks)
+    assert [r[0] for r in rows] == ["6", "7"] and result == "2 (id 5 -> 7)"
+
+    result, rows = import_table(migrate, tmp_path, "likes", marks=marks)
+    assert rows == [] and result == "0 (id 7 -> 7)"
+
+
+def test_timestamp_marks_resend_rows_on_the_boundary(tmp_path, migrate):
+    cols = migrate.TABLE_COLUMNS["friend_links"]
+
+    def row(id_, updated):
+        return tuple(id_ if c == "id" else updated if c == "updated_at" else f"{c}-{id_}" for c in cols)
+
+    make_table(tmp_path / "blog.db", migrate, "friend_links", [row(1, "2024-01-01"), row(2, "2024-01-02")]).close()
+    marks = migrate.HighWaterMarks(tmp_path / "hwm.json", "target")
+    import_table(migrate, tmp_path, "friend_links", marks=marks)
+
+    conn = sqlite3.connect(str(tmp_path / "blog.db"))
+    conn.execute("INSERT INTO friend_links (id, updated_at) VALUES (3, '2024-01-02')")
+    conn.commit()
+    conn.close()
+    # Another row can still arrive with the timestamp the last run stopped at.
+    result, rows = import_table(migrate, tmp_path, "friend_links", marks=marks)
+    assert sorted(r[0] for r in rows) == ["2", "3"] and result == "2 (updated_at '2024-01-02' -> '2024-01-02')"
+
+
+class DroppedConnection(RecordingSession):
+    """Loses the connection on the COPY after `ok` successful ones."""
+
+    def __init__(self, ok):
+        super().__init__()
+        self.ok = ok
+
+    def copy_in(self, sql, chunks, before=None, after=None):
+        if len(self.copies) == self.ok:
+            raise ConnectionError("server closed the connection unexpectedly")
+        super().copy_in(sql, chunks, before, after)
+
+
+def test_resume_continues_after_the_last_committed_chunk(tmp_path, migrate):
+    make_table(tmp_path / "blog.db", migrate, "likes", [(i, 7, f"user{i}", "x") for i in range(1, 6)]).close()
+    db = RecordingDb()
+    db.sess = DroppedConnection(ok=1)
+    with pytest.raises(ConnectionError):
+        import_table(migrate, tmp_path, "likes", db=db, chunk_rows=2)
+
+    with pytest.raises(RuntimeError, match="no checkpoint to resume"):
+        migrate.CheckpointJournal(tmp_path / "checkpoint.json", "another run", resume=True)
+    journal = migrate.CheckpointJournal(tmp_path / "checkpoint.json", "run", resume=True)
+    assert journal.table_state("likes") == {"done": False, "rows": 2, "key": "id", "last_key": 2, "chunks": [[1, 2, 2]]}
+    result, rows = import_table(migrate, tmp_path, "likes", journal=journal, chunk_rows=2)
+    assert [r[0] for r in rows] == ["3", "4", "5"] and result == "5 (resumed after id 2)"
+
+    journal = migrate.CheckpointJournal(tmp_path / "checkpoint.json", "run", resume=True)
+    assert import_table(migrate, tmp_path, "likes", journal=journal) == ("5 (already committed)", [])
+
+
+def test_keyset_slices_hold_step_rows_each(tmp_path, migrate):
+    ids = [1, 2, 3, 5, 8, 13, 21]
+    conn = make_table(tmp_path / "blog.db", migrate, "likes", [(i, 7, f"user{i}", "x") for i in ids])
+    assert list(migrate.keyset_slices(conn, "likes", 3)) == [(None, 3), (3, 13), (13, None)]
+    assert list(migrate.keyset_slices(conn, "likes", 2, ["id % 2 = ?"], [1], after=3)) == [(3, 13), (13, None)]
+    assert list(migrate.keyset_slices(conn, "likes", 7)) == [(None, 21), (21, None)]
+
+
+def test_tables_without_an_integer_id_are_paged_by_rowid(tmp_path, migrate):
+    conn = sqlite3.connect(str(tmp_path / "studio.db"))
+    conn.execute("CREATE TABLE studio_config (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT INTO studio_config VALUES (?, ?)", [(f"k{i}", str(i)) for i in (5, 3, 9, 1, 7)])
+    conn.execute("DELETE FROM studio_config WHERE key = 'k9'")
+    conn.execute("CREATE TABLE studio_task_times (task_id TEXT PRIMARY KEY, ts TEXT) WITHOUT ROWID")
+    assert migrate.sqlite_chunk_key(conn, "studio_config", integer_id=False) == "rowid"
+    assert migrate.sqlite_chunk_key(conn, "studio_task_times", integer_id=False) is None
+    blog = make_table(tmp_path / "blog.db", migrate, "likes", [])
+    assert migrate.sqlite_chunk_key(blog, "likes", integer_id=True) == "id"
+
+    # Every row lands in exactly one slice, in rowid order, without the rowid column.
+    pages = []
+    for lower, upper in migrate.keyset_slices(conn, "studio_config", 2, key="rowid"):
+        for rows, first, last, _left_out in migrate.iter_slice_rows(
+            conn, "studio_config", 10, (), (), "rowid", lower, upper
+        ):
+            pages.append((first, last, rows))
+    assert pages == [(1, 2, [("k5", "5"), ("k3", "3")]), (4, 5, [("k1", "1"), ("k7", "7")])]
+
+
+def binary_tuples(data):
+    """Split COPY binary tuples into their fields (None for NULL)."""
+    rows, pos = [], 0
+    while pos < len(data):
+        (count,) = struct.unpack_from("!h", data, pos)
+        pos += 2
+        row = []
+        for _ in range(count):
+            (size,) = struct.unpack_from("!i", data, pos)
+            pos += 4
+            row.append(None if size == -1 else data[pos : pos + size])
+            pos += max(size, 0)
+        rows.append(row)
+    return rows
+
+
+def test_binary_encoders_write_each_type_in_its_wire_format(migrate):
+    pg_types = (
+        "smallint",
+        "integer",
+        "bigint",
+        "double precision",
+        "real",
+        "boolean",
+        "text",
+        "timestamp with time zone",
+        "timestamp without time zone",
+        "json",
+    )
+    assert migrate.binary_copy_supported(pg_types)
+    assert not migrate.binary_copy_supported(("integer", "numeric")) and not migrate.binary_copy_supported(("jsonb",))
+    encoders = migrate.binary_encoders(pg_types, "Asia/Shanghai")
+    row = (-2, 70000, 2**40, 1.5, 0.25, " Yes", "h\u00e9llo")
+    row += ("2000-01-01 08:00:01", "2000-01-02T00:00:00+05:00", '{"a": 1}')
+    data = migrate.encode_copy_rows_binary([row, (None,) * len(pg_types)], None, (), encoders)
+    assert binary_tuples(data) == [
+        [
+            struct.pack("!h", -2),
+            struct.pack("!i", 70000),
+            struct.pack("!q", 2**40),
+            struct.pack("!d", 1.5),
+            struct.pack("!f", 0.25),
+            b"\x01",
+            "h\u00e9llo".encode(),
+            # Naive timestamptz input is in the session time zone; microseconds since 2000-01-01 UTC.
+            struct.pack("!q", 1_000_000),
+            # timestamp without time zone drops the offset.
+            struct.pack("!q", 86_400_000_000),
+            b'{"a": 1}',
+        ],
+        [None] * len(pg_types),
+    ]
+
+
+def test_binary_encoders_project_convert_and_reject_bad_values(migrate):
+    encoders = migrate.binary_encoders(("integer", "text"), "UTC")
+    data = migrate.encode_copy_rows_binary([("a", "x", 7)], [2, 0], [(1, str.upper)], encoders)
+    assert binary_tuples(data) == [[struct.pack("!i", 7), b"A"]]
+    bigint, boolean = migrate.binary_encoders(("bigint", "boolean"), "UTC")
+    for encode, value in ((bigint, 1.5), (bigint, "x"), (boolean, "maybe")):
+        with pytest.raises(ValueError):
+            encode(value)
+    assert bigint(3.0) == struct.pack("!iq", 8, 3) and boolean(0) == struct.pack("!ib", 1, 0)
+    (timestamptz,) = migrate.binary_encoders(("timestamp with time zone",), "UTC")
+    with pytest.raises(ValueError, match="--copy-format text"):
+        timestamptz("yesterday")
+
+
+class QueryLog:
+    """Stands in for PgPool: records the statements reset_sequences sends."""
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, sql):
+        self.queries.append(sql)
+
+
+def test_reset_sequences_sets_every_sequence_in_one_statement(migrate):
+    def column(name, sequence=None):
+        return {"name": name, "sequence": sequence}
+
+    schema = {
+        "columns": {
+            "likes": [column("id", "public.likes_id_seq"), column("post_id")],
+            "posts": [column("id", "o'brien.posts_id_seq")],
+            "comments": [column("id", "comments_id_seq")],
+            "studio_config": [column("key"), column("value")],
+        }
+    }
+    db = QueryLog()
+    captured = {("likes", "id"): 41, ("comments", "id"): None}
+    assert migrate.reset_sequences(db, schema, captured) == 3
+    assert db.queries == [
+        "SELECT setval(s.seq::regclass, GREATEST(s.max_id, 1), COALESCE(s.max_id >= 1, false)) FROM (VALUES "
+        "('public.likes_id_seq', 41::bigint), "
+        "('o''brien.posts_id_seq', (SELECT MAX(\"id\") FROM \"posts\")::bigint), "
+        "('comments_id_seq', NULL::bigint)) AS s(seq, max_id)"
+    ]
+
+    db = QueryLog()
+    assert migrate.reset_sequences(db, {"columns": {"studio_config": [column("key")]}}, {}) == 0
+    assert db.queries == []
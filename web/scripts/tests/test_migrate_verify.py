@@ -0,0 +1,32 @@
+def test_canonical_timestamps_parse_the_import_formats(verify):
+    from zoneinfo import ZoneInfo
+
+    tz = ZoneInfo("Asia/Shanghai")
+    iso = verify.canonical_value("2024-01-02T03:04:05", "timestamptz", tz)
+    for text in ("2024/01/02 03:04:05", "2024-01-02 03:04:05", "2024-01-02 03:04:05.000"):
+        assert verify.canonical_value(text, "timestamptz", tz) == iso
+    assert verify.canonical_value("2024/01/02 03:04:05", "timestamp", tz) == verify.canonical_value(
+        "2024-01-02 03:04:05", "timestamp", tz
+    )
+
+
+# jsonb::text of each source text, as printed by Postgres 16 (UTF8 database).
+JSONB_TEXT = [
+    (
+        '{"b": 1, "a": 2, "aa": [1.50, 1e2, -0, -0.0, 1E-2, 2.5e+3], "a": 3}',
+        '{"a": 3, "b": 1, "aa": [1.50, 100, 0, 0.0, 0.01, 2500]}',
+    ),
+    (
+        '{"k":"tab\\tquote\\"back\\\\slash\\u0001\\u00e9\\/ \\u2028","z":{"y":null,"x":true,"é":false}}',
+        '{"k": "tab\\tquote\\"back\\\\slash\\u0001é/ \u2028", "z": {"x": true, "y": null, "é": false}}',
+    ),
+    ("[ ]", "[]"),
+    ('[{"bb":1,"c":2}, "s", 0.000001]', '[{"c": 2, "bb": 1}, "s", 0.000001]'),
+    ("12345678901234567890.123", "12345678901234567890.123"),
+]
+
+
+def test_jsonb_columns_digest_the_way_postgres_prints_them(verify):
+    assert verify.digest_kind("jsonb") == "jsonb"
+    for source, printed in JSONB_TEXT:
+        assert verify.canonical_value(source, "jsonb", None) == printed
@@ -129,7 +129,7 @@ export class PostAdminRepository {
     const totalPosts = (await pgQueryOne<{ count: number }>("SELECT COUNT(*)::int AS count FROM posts"))?.count || 0;
     let totalVisits = 0;
     let totalVisitors = 0;
-    try { totalVisits = (await pgQueryOne<{ count: number }>("SELECT COUNT(*)::int AS count FROM site_visits"))?.count || 0; } catch {}
+    try { totalVisits = (await pgQueryOne<{ count: number }>("SELECT COALESCE(SUM(visits), 0)::int AS count FROM site_visit_daily_pages"))?.count || 0; } catch {}
     try { totalVisitors = (await pgQueryOne<{ count: number }>("SELECT COUNT(*)::int AS count FROM unique_visitors"))?.count || 0; } catch {}
     return { totalPosts, totalVisits, totalVisitors };
   }
@@ -143,6 +143,18 @@ export class PostAdminRepository {
         [visitorId],
         client
       );
+      await pgRun(
+        `INSERT INTO site_visit_daily_pages (day,page_url,visits) VALUES (CURRENT_DATE, ?, 1)
+         ON CONFLICT (day, page_url) DO UPDATE SET visits = site_visit_daily_pages.visits + 1`,
+        [pageUrl],
+        client
+      );
+      await pgRun(
+        `INSERT INTO site_visit_daily_visitors (day,visitor_id,visits,last_visit) VALUES (CURRENT_DATE, ?, 1, CURRENT_TIMESTAMP)
+         ON CONFLICT (day, visitor_id) DO UPDATE SET visits = site_visit_daily_visitors.visits + 1, last_visit = CURRENT_TIMESTAMP`,
+        [visitorId],
+        client
+      );
     });
   }
 